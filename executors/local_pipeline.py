@@ -0,0 +1,50 @@
+"""
+Runs every executor stage and the retry relay in this one process on the
+in-memory broker, e.g. for load tests and profiling:
+
+    BROKER_BACKEND=memory SECRETS_FILE=local_secrets.json python executors/local_pipeline.py
+
+Stages still talk to the AI server and OpenAI as configured in the secrets;
+add STORAGE_BACKEND=memory (or local) to keep the S3 artifacts in this process too.
+"""
+import os
+import signal
+import threading
+
+os.environ.setdefault("BROKER_BACKEND", "memory")
+
+from config.logconfig import get_logger
+from services.kafka.retry import RetryRelay
+from utils import heconstants
+
+logger = get_logger()
+
+
+def run_pipeline():
+    from executors import ai_preds_executor, asr_executor, file_downloader_executor, final_executor, soap_executor
+
+    if heconstants.BROKER_BACKEND != "memory":
+        raise RuntimeError("local_pipeline needs BROKER_BACKEND=memory")
+
+    relay = RetryRelay(group_id="retry")
+    runtimes = [module.runtime for module in
+                (file_downloader_executor, asr_executor, ai_preds_executor, soap_executor, final_executor)]
+    threads = [threading.Thread(target=runtime.run, name=f"{runtime.group_id}-executor") for runtime in runtimes]
+    threads.append(threading.Thread(target=relay.run, name="retry-relay"))
+
+    def stop(*args):
+        for runtime in runtimes:
+            runtime.stop()
+        relay.stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for thread in threads:
+        thread.start()
+    logger.info("Local pipeline running on the in-memory broker")
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == "__main__":
+    run_pipeline()
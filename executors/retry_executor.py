@@ -0,0 +1,5 @@
+from services.kafka.retry import RetryRelay
+
+
+if __name__ == "__main__":
+    RetryRelay(group_id="retry").run()
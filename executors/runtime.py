@@ -0,0 +1,332 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Optional
+
+from config.logconfig import get_logger
+from services.kafka.dispatcher import InFlightDispatcher, RedeliveryRequired
+from services.kafka.idempotency import create_idempotency_store, task_key
+from services.kafka.kafka_service import KafkaService, flush_producer, wait_for_delivery
+from services.kafka import metrics
+from services.kafka.task_message import decode_message, running_task
+from utils import heconstants
+
+logger = get_logger()
+num_of_workers = lambda: (multiprocessing.cpu_count() * 2) + 1
+num_of_processes = lambda: multiprocessing.cpu_count()
+
+
+def _init_process_worker(warmup: Optional[Callable]):
+    # runs once in every pool process, before it accepts tasks
+    if warmup is not None:
+        warmup()
+    logger.info(f"Process worker {os.getpid()} ready")
+
+
+def _ping():
+    return os.getpid()
+
+
+def _await_publishes(task):
+    # the messages a task handed to the next stage must be on the broker before its offset is committed
+    for future in task.publishes:
+        try:
+            wait_for_delivery(future)
+        except Exception as exc:
+            raise RedeliveryRequired(f"a message published by the task was not delivered :: {exc}") from exc
+
+
+def _timed(handler, message, *args):
+    # returns the wall-clock start so the parent can split queue wait from run time, also across processes,
+    # and whether the handler caught its failure and scheduled a retry instead of completing the task
+    started = time.time()
+    with running_task(message) as task:
+        handler(message, *args)
+    _await_publishes(task)
+    return started, task.rescheduled
+
+
+def _timed_in_process(handler, *args):
+    # pool processes skip atexit and have their own metrics registry: hand the messages the task
+    # published to the broker before the parent commits its offset, and return its counter increments
+    before = metrics.handler_counter_values()
+    try:
+        started, rescheduled = _timed(handler, *args)
+    finally:
+        flush_producer()
+    return started, rescheduled, metrics.handler_counter_increments(before)
+
+
+async def _timed_async(handler, message, *args):
+    started = time.time()
+    with running_task(message) as task:
+        await handler(message, *args)
+    await asyncio.get_running_loop().run_in_executor(None, _await_publishes, task)
+    return started, task.rescheduled
+
+
+class AsyncioPool:
+    """
+    Runs handlers on an event loop owned by a background thread.
+
+    Coroutine handlers are awaited directly, plain functions are pushed to the
+    loop's default executor. At most ``max_workers`` handlers run at once.
+    """
+
+    def __init__(self, max_workers: int):
+        self.loop = asyncio.new_event_loop()
+        self.semaphore = asyncio.Semaphore(max_workers)
+        self.thread = threading.Thread(target=self.loop.run_forever, name="executor-asyncio", daemon=True)
+        self.thread.start()
+
+    async def _run(self, fn, *args):
+        async with self.semaphore:
+            if asyncio.iscoroutinefunction(fn):
+                return await fn(*args)
+            return await self.loop.run_in_executor(None, fn, *args)
+
+    def submit(self, fn, *args):
+        return asyncio.run_coroutine_threadsafe(self._run(fn, *args), self.loop)
+
+    def shutdown(self, wait: bool = True, cancel_futures: bool = False):
+        async def _close():
+            pending = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            if cancel_futures:
+                for task in pending:
+                    task.cancel()
+            if wait and pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+            await self.loop.shutdown_default_executor()
+            self.loop.stop()
+
+        asyncio.run_coroutine_threadsafe(_close(), self.loop)
+        if wait:
+            self.thread.join()
+
+
+class ExecutorRuntime:
+    """
+    Shared poll/decode/dispatch loop for the executors.
+
+    A stage registers a handler per ``state`` (optionally per ``req_type``); the
+    runtime owns the consumer, the worker pools, the in-flight window and shutdown.
+    Handlers are called as ``handler(message_dict, start_time)``.
+
+    Each handler runs in a pool of the given mode: threads for I/O-bound work,
+    an event loop for coroutine handlers, or processes for CPU-bound work.
+    Process-mode handlers must be module-level functions so they can be pickled;
+    ``warmup`` runs once in every pool process before it takes tasks.
+
+    A task that already completed (same request, state, chunk, attempt and run) is
+    skipped when it is redelivered; see ``services.kafka.idempotency``. A task whose
+    handler scheduled a retry of it instead is not marked completed. A task is only done,
+    and its offset committed, once the broker acked every message it published.
+    """
+
+    modes = {"thread", "asyncio", "process"}
+
+    def __init__(self, group_id: str, mode: str = "thread", max_workers: Optional[int] = None,
+                 max_in_flight: Optional[int] = None, warmup: Optional[Callable] = None):
+        if mode not in self.modes:
+            raise ValueError(f"mode must be one of {sorted(self.modes)}")
+        self.group_id = group_id
+        self.mode = mode
+        self.max_workers = max_workers
+        self.max_in_flight = max_in_flight
+        self.warmup = warmup
+        self.handlers = {}
+        self.kafka_service = None
+        self.dispatcher = None
+        self.pools = {}
+        self.idempotency_store = None
+        self._running_keys = set()
+        self._keys_lock = threading.Lock()
+        self._running = False
+
+    def register(self, state: str, handler: Callable, req_type: Optional[str] = None, mode: Optional[str] = None,
+                 ack_on_start: bool = False):
+        """
+        Route messages of ``state`` to ``handler``; ``req_type=None`` is the fallback for that state.
+
+        ``ack_on_start`` commits the offset as soon as the task starts instead of when it completes,
+        for tasks that run as long as a live session and would otherwise hold back the commits of
+        every later task on their partition. Such a task is not redelivered if the executor dies.
+        """
+        mode = heconstants.STAGE_EXECUTION_MODES.get(state) or mode or self.mode
+        if mode not in self.modes:
+            raise ValueError(f"mode must be one of {sorted(self.modes)}")
+        if mode == "process" and heconstants.BROKER_BACKEND == "memory":
+            # pool processes would publish to their own copy of the in-memory broker
+            mode = "thread"
+        self.handlers.setdefault(state, {})[req_type] = (handler, mode, ack_on_start)
+        return handler
+
+    def _max_workers(self, mode):
+        if self.max_workers:
+            return self.max_workers
+        configured = [int(heconstants.STAGE_MAX_WORKERS.get(s, 0)) for s in self.handlers]
+        if any(configured):
+            return max(configured)
+        return num_of_processes() if mode == "process" else num_of_workers()
+
+    def _create_pool(self, mode):
+        max_workers = self._max_workers(mode)
+        logger.info(f"{self.group_id} executor starting {max_workers} {mode} workers")
+        if mode == "asyncio":
+            return AsyncioPool(max_workers)
+        if mode == "process":
+            # spawn, not fork: the parent already runs Kafka client threads
+            pool = ProcessPoolExecutor(max_workers=max_workers,
+                                       mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=_init_process_worker,
+                                       initargs=(self.warmup,))
+            # start and warm every process now instead of on the first tasks
+            for future in [pool.submit(_ping) for _ in range(max_workers)]:
+                future.result()
+            return pool
+        return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{self.group_id}-worker")
+
+    def _resolve_handler(self, message):
+        routes = self.handlers.get(message.get("state"))
+        if not routes:
+            return None, None, False
+        return routes.get(message.get("req_type"), routes.get(None, (None, None, False)))
+
+    def dispatch(self, record):
+        message = decode_message(record.value)
+        if message is None or message.completed:
+            return None
+        handler, mode, ack_on_start = self._resolve_handler(message)
+        if handler is None:
+            return None
+
+        key = task_key(message)
+        if self._is_duplicate(key):
+            logger.info(f"Skipping duplicate {message.state} task :: {key}")
+            metrics.TASKS_TOTAL.labels(message.state, "skipped").inc()
+            return None
+
+        start_time = datetime.utcnow()
+        message_dict = message.to_dict()
+        request_id = message_dict.get("care_req_id") or message_dict.get("request_id")
+        logger.info(f"Starting {message_dict.get('state')} ({message_dict.get('req_type')}) :: "
+                    f"{request_id} :: {message_dict.get('file_path')}")
+        logger.info(f"Output language :: {message_dict.get('output_language')}")
+        # handlers get a plain dict: cheap to pickle for process pools and free to mutate
+        if asyncio.iscoroutinefunction(handler):
+            runner = _timed_async
+        else:
+            runner = _timed_in_process if mode == "process" else _timed
+        # record.timestamp is the producer's send time in ms
+        published_at = record.timestamp / 1000.0 if record.timestamp and record.timestamp > 0 else None
+        try:
+            future = self.pools[mode].submit(runner, handler, message_dict, start_time)
+        except Exception:
+            self._finish(key, None)
+            raise
+        future.add_done_callback(lambda f: self._finish(key, f, message.state, published_at))
+        if ack_on_start:
+            logger.info(f"Acknowledged long-running {message.state} task on start :: {key}")
+            return None
+        return future
+
+    def _is_duplicate(self, key):
+        with self._keys_lock:
+            # the same task redelivered while it is still running here
+            if key in self._running_keys:
+                return True
+            self._running_keys.add(key)
+        try:
+            if self.idempotency_store is not None and self.idempotency_store.is_done(key):
+                self._finish(key, None)
+                return True
+        except Exception as exc:
+            # a store outage must not stop the pipeline, run the task
+            logger.error(f"Idempotency lookup failed :: {exc}")
+        return False
+
+    def _finish(self, key, future, state=None, published_at=None):
+        with self._keys_lock:
+            self._running_keys.discard(key)
+        if future is None:
+            return
+        if future.cancelled() or future.exception() is not None:
+            # a failed run stays unmarked so a redelivery runs it again
+            metrics.TASKS_TOTAL.labels(state, "failed").inc()
+            return
+        started, rescheduled, *increments = future.result()
+        if increments:
+            metrics.apply_counter_increments(increments[0])
+        if published_at is not None:
+            metrics.QUEUE_WAIT_SECONDS.labels(state).observe(max(0.0, started - published_at))
+        metrics.PROCESSING_SECONDS.labels(state).observe(time.time() - started)
+        if rescheduled:
+            # the retry (or dead letter) carries the task on, a redelivery of this attempt runs it again
+            metrics.TASKS_TOTAL.labels(state, "retried").inc()
+            return
+        metrics.TASKS_TOTAL.labels(state, "completed").inc()
+        try:
+            if self.idempotency_store is not None:
+                self.idempotency_store.mark_done(key)
+        except Exception as exc:
+            logger.error(f"Idempotency update failed :: {exc}")
+
+    def stop(self, *args):
+        logger.info(f"Stopping {self.group_id} executor")
+        self._running = False
+
+    def run(self):
+        modes = {mode for routes in self.handlers.values() for _, mode, _ in routes.values()}
+        self.pools = {mode: self._create_pool(mode) for mode in modes}
+        self.idempotency_store = create_idempotency_store()
+        max_in_flight = self.max_in_flight or int(
+            heconstants.MAX_IN_FLIGHT_TASKS or max(self._max_workers(mode) for mode in modes) * 2)
+
+        self.kafka_service = KafkaService(group_id=self.group_id, state=list(self.handlers))
+        self.dispatcher = InFlightDispatcher(self.kafka_service.post_consumer, max_in_flight=max_in_flight)
+        logger.info(f"{self.group_id} executor consuming {self.kafka_service.topics}")
+        metrics.IN_FLIGHT.labels(self.group_id).set_function(lambda: self.dispatcher.in_flight)
+        metrics.start_metrics_server()
+        lag_recorded_at = 0
+
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+
+        self._running = True
+        try:
+            while self._running:
+                if time.time() - lag_recorded_at >= heconstants.METRICS_LAG_INTERVAL_SECONDS:
+                    metrics.record_lag(self.group_id, self.kafka_service.consumer_lag())
+                    lag_recorded_at = time.time()
+                for record in self.dispatcher.poll(timeout_ms=int(heconstants.CONSUMER_POLL_TIMEOUT)):
+                    future = None
+                    try:
+                        future = self.dispatch(record)
+                    except Exception as exc:
+                        msg = "Failed to dispatch message :: {}".format(exc)
+                        trace = traceback.format_exc()
+                        logger.error(msg, trace)
+                    self.dispatcher.track(record, future)
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        # stop taking work, give running tasks a bounded time to finish, then commit what they completed
+        drained = self.dispatcher.drain(timeout=heconstants.EXECUTOR_DRAIN_TIMEOUT_SECONDS)
+        if not drained:
+            logger.info(f"{self.group_id} executor stopping with {self.dispatcher.in_flight} tasks still running, "
+                        f"they are redelivered from the last commit")
+        for pool in self.pools.values():
+            # acked live sessions can run for hours: do not wait for them here, the orchestrator's
+            # kill at the end of the grace period ends them
+            pool.shutdown(wait=False, cancel_futures=True)
+        self.kafka_service.post_consumer.close(autocommit=False)
+        self.kafka_service.flush()
+        logger.info(f"{self.group_id} executor stopped")
@@ -2,16 +2,20 @@ import gc
 import json
 import logging
 import traceback
-from datetime import datetime
 import requests
 import openai
 from utils import heconstants
 from utils.s3_operation import S3SERVICE
+from utils.chunk_manifest import ChunkManifest
 from services.kafka.kafka_service import KafkaService
+from services.kafka.task_message import TaskMessage
+from services.kafka.retry import RetryScheduler
 from config.logconfig import get_logger
 
 s3 = S3SERVICE()
-producer = KafkaService(group_id="aipreds")
+manifest = ChunkManifest(s3)
+producer = KafkaService()
+retries = RetryScheduler(producer)
 openai.api_key = heconstants.OPENAI_APIKEY
 logger = get_logger()
 logger.setLevel(logging.INFO)
@@ -254,8 +258,7 @@ class aiPreds:
 
             if req_type == "encounter":
                 conversation_id = message.get("request_id")
-                conversation_datas = s3.get_files_matching_pattern(
-                    pattern=f"{conversation_id}/{conversation_id}_*json")
+                conversation_datas = manifest.get_chunk_datas(conversation_id)
             else:
                 # Check if call is from platform
                 if api_type == "clinical_notes":
@@ -319,8 +322,9 @@ class aiPreds:
             }
 
             ai_preds_file_path = f"{conversation_id}/ai_preds.json"
-            if s3.check_file_exists(ai_preds_file_path):
-                entities = s3.get_json_file(ai_preds_file_path)
+            ai_preds = s3.get_json_if_exists(ai_preds_file_path)
+            if ai_preds is not None:
+                entities = ai_preds
 
             if merged_segments or text:
                 if merged_segments:
@@ -342,8 +346,7 @@ class aiPreds:
                     s3.upload_to_s3(f"{conversation_id}/translated_transcript.json", transcript_data, is_json=True)
 
                 triage_key = f"{conversation_id}/triage_ai_suggestion.json"
-                if s3.check_file_exists(triage_key):
-                    triage_ai_suggestion = s3.get_json_file(triage_key)
+                triage_ai_suggestion = s3.get_json_if_exists(triage_key)
 
                 if "clinical_ner" in api_path:
                     extracted_info = self.get_preds_from_open_ai(text)
@@ -488,30 +491,19 @@ class aiPreds:
                 s3.upload_to_s3(f"{conversation_id}/ai_preds.json", entities, is_json=True)
 
                 if api_type in {"clinical_notes", "soap"}:
-                    data = {
-                        "es_id": f"{conversation_id}_SOAP",
-                        "chunk_no": chunk_no,
-                        "file_path": file_path,
-                        "webhook_url": webhook_url,
-                        "api_path": api_path,
-                        "api_type": api_type,
-                        "req_type": req_type,
-                        "executor_name": "SOAP_EXECUTOR",
-                        "state": "Analytics",
-                        "retry_count": 0,
-                        "uid": None,
-                        "request_id": conversation_id,
-                        "care_req_id": conversation_id,
-                        "encounter_id": None,
-                        "provider_id": None,
-                        "review_provider_id": None,
-                        "language": language,
-                        "output_language": output_language,
-                        "completed": False,
-                        "exec_duration": 0.0,
-                        "start_time": str(start_time),
-                        "end_time": str(datetime.utcnow()),
-                    }
+                    data = TaskMessage(
+                        state="Analytics",
+                        request_id=conversation_id,
+                        start_time=start_time,
+                        chunk_no=chunk_no,
+                        file_path=file_path,
+                        webhook_url=webhook_url,
+                        api_path=api_path,
+                        api_type=api_type,
+                        req_type=req_type,
+                        language=language,
+                        output_language=output_language,
+                    )
                     producer.publish_executor_message(data)
                 elif api_type == "ai_pred":
                     self.create_delivery_task(message=message)
@@ -520,34 +512,20 @@ class aiPreds:
             msg = "Failed to get AI PREDICTION :: {}".format(exc)
             trace = traceback.format_exc()
             logger.error(msg, trace)
-            data = {
-                "es_id": f"{conversation_id}_AI_PRED",
-                "file_path": file_path,
-                "webhook_url": webhook_url,
-                "api_path": api_path,
-                "api_type": api_type,
-                "req_type": req_type,
-                "executor_name": "AI_PRED",
-                "state": "AiPred",
-                "retry_count": retry_count,
-                "uid": None,
-                "request_id": conversation_id,
-                "care_req_id": conversation_id,
-                "encounter_id": None,
-                "provider_id": None,
-                "review_provider_id": None,
-                "language": language,
-                "output_language": output_language,
-                "completed": False,
-                "exec_duration": 0.0,
-                "start_time": str(start_time),
-                "end_time": str(datetime.utcnow()),
-            }
-            if retry_count <= 2:
-                retry_count += 1
-                data["retry_count"] = retry_count
-                producer.publish_executor_message(data)
-            else:
+            data = TaskMessage(
+                state="AiPred",
+                request_id=conversation_id,
+                start_time=start_time,
+                file_path=file_path,
+                webhook_url=webhook_url,
+                api_path=api_path,
+                api_type=api_type,
+                req_type=req_type,
+                retry_count=retry_count,
+                language=language,
+                output_language=output_language,
+            )
+            if not retries.schedule(data, exc):
                 response_json = {"request_id": conversation_id,
                                  "status": "Failed"}
                 merged_json_key = f"{conversation_id}/All_Preds.json"
@@ -788,31 +766,20 @@ class aiPreds:
             language = message.get("language", "en")
             output_language = message.get("output_language", "en")
 
-            data = {
-                "es_id": f"{request_id}_FINAL_EXECUTOR",
-                "chunk_no": chunk_no,
-                "file_path": file_path,
-                "webhook_url": webhook_url,
-                "api_path": api_path,
-                "api_type": api_type,
-                "req_type": req_type,
-                "executor_name": "FINAL_EXECUTOR",
-                "state": "Final",
-                "failed_state": failed_state,
-                "retry_count": retry_count,
-                "uid": None,
-                "request_id": request_id,
-                "care_req_id": request_id,
-                "encounter_id": None,
-                "provider_id": None,
-                "review_provider_id": None,
-                "language": language,
-                "output_language": output_language,
-                "completed": False,
-                "exec_duration": 0.0,
-                "start_time": str(datetime.utcnow()),
-                "end_time": str(datetime.utcnow()),
-            }
+            data = TaskMessage(
+                state="Final",
+                request_id=request_id,
+                chunk_no=chunk_no,
+                file_path=file_path,
+                webhook_url=webhook_url,
+                api_path=api_path,
+                api_type=api_type,
+                req_type=req_type,
+                failed_state=failed_state,
+                retry_count=retry_count,
+                language=language,
+                output_language=output_language,
+            )
             producer.publish_executor_message(data)
 
         except Exception as exc:
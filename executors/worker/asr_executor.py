@@ -1,25 +1,38 @@
 import logging
 import os
 import traceback
-from datetime import datetime
-from io import BytesIO
+import uuid
+from contextlib import closing, contextmanager
 
 import av
 import time
 import requests
 from utils import heconstants
 from utils.s3_operation import S3SERVICE
+from utils.chunk_manifest import ChunkManifest
+from utils.wav import read_wav_header
+from utils.transcription_batcher import transcription_batcher
 from pydub.utils import mediainfo
 from services.kafka.kafka_service import KafkaService
+from services.kafka.task_message import TaskMessage
+from services.kafka.retry import RetryScheduler
 from config.logconfig import get_logger
-from pydub import AudioSegment
 
 s3 = S3SERVICE()
-producer = KafkaService(group_id="asr")
+manifest = ChunkManifest(s3)
+producer = KafkaService()
+retries = RetryScheduler(producer)
 logger = get_logger()
 logger.setLevel(logging.INFO)
 
 
+def multipart_file_stream(field, filename, chunks, boundary):
+    # the same single file part requests builds for files={field: fileobj}, without holding the file
+    yield (f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n\r\n').encode()
+    yield from chunks
+    yield f"\r\n--{boundary}--\r\n".encode()
+
+
 class ASRExecutor:
     def __init__(self):
         self.AUDIO_DIR = "AUDIOS"
@@ -27,6 +40,37 @@ class ASRExecutor:
     def get_wav_duration(self, wav_file_path):
         return float(mediainfo(wav_file_path)["duration"])
 
+    @contextmanager
+    def open_wav(self, file_path):
+        """The S3 body of a WAV past its header, the header and the duration it states (None when unset)."""
+        with closing(s3.get_audio_file(file_path)['Body']) as body:
+            header, byte_rate, data_size = read_wav_header(body)
+            yield body, header, byte_rate, (data_size / byte_rate if data_size else None)
+
+    def transcribe_stream(self, body, header, filename, unique_id):
+        """
+        Posts the WAV to /transcribe/infer as a chunked multipart upload, reading ``body`` as
+        it goes. Returns the prediction and the number of frame bytes sent.
+        """
+        sent = [0]
+
+        def chunks():
+            yield header
+            while True:
+                chunk = body.read(heconstants.ASR_STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                sent[0] += len(chunk)
+                yield chunk
+
+        boundary = uuid.uuid4().hex
+        prediction = requests.post(
+            heconstants.AI_SERVER + f"/transcribe/infer?unique_id={unique_id}",
+            data=multipart_file_stream("f1", filename, chunks(), boundary),
+            headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+        ).json()["prediction"][0]
+        return prediction, sent[0]
+
     def get_audio_video_duration_and_extension(self, file_path):
         try:
             container = av.open(file_path)
@@ -59,15 +103,7 @@ class ASRExecutor:
             output_language = message.get("output_language", "en")
 
             received_at = time.time()
-            # previous_conversation_ids_datas = []
-            previous_conversation_ids_datas = s3.get_files_matching_pattern(
-                pattern=f"{conversation_id}/{conversation_id}_*json")
-
-            total_duration_until_now = 0
-            if previous_conversation_ids_datas:
-                total_duration_until_now = sum(
-                    [v["duration"] for v in previous_conversation_ids_datas]
-                )
+            total_duration_until_now = manifest.duration_before(conversation_id, chunk_no)
 
             logger.info(f"total_duration_until_now :: {total_duration_until_now}")
 
@@ -84,18 +120,9 @@ class ASRExecutor:
             # audio_path = os.path.join(conversation_directory, file_path.split("/")[1])
             logger.info(f"audio_path :: {file_path}")
 
-            audio_stream = BytesIO()
             if file_path:
-                # Read the object from S3 in chunks
-                # with open(audio_path, 'wb') as file:
-                s3_object = s3.get_audio_file(file_path)
-                stream = s3_object['Body']
-                while True:
-                    chunk = stream.read(2048)
-                    if not chunk:
-                        break
-                    audio_stream.write(chunk)
-                    # file.write(chunk)
+                with self.open_wav(file_path) as (audio_body, audio_header, byte_rate, duration):
+                    frames = audio_body.read()
             else:
                 raise Exception("No audio file found")
 
@@ -127,19 +154,13 @@ class ASRExecutor:
             raise ex
 
         try:
-            audio_file = audio_stream
-            # Read audio data with pydub
-            audio = AudioSegment.from_file(audio_file, format="wav")
-            duration_in_milliseconds = len(audio)
-            duration = duration_in_milliseconds / 1000.0
-            audio_stream.name = file_path.split("/")[1]
             filename = file_path.split("/")[1]
             unique_id = filename.split(".")[0] + "___" + language
-            audio_stream.seek(0)
-            transcription_result = requests.post(
-                heconstants.AI_SERVER + f"/transcribe/infer?unique_id={unique_id}",
-                files={"f1": audio_stream},
-            ).json()["prediction"][0]
+            # encounter chunks are a few seconds long, they are batched with the other workers' chunks
+            transcription_result = transcription_batcher.transcribe(audio_header + frames, filename,
+                                                                    language=language, unique_id=unique_id)
+            if duration is None:
+                duration = len(frames) / byte_rate
             # todo change fixed ip to DNS
             # transcription_result = requests.post(
             #     heconstants.AI_SERVER + "/transcribe/infer",
@@ -192,32 +213,22 @@ class ASRExecutor:
                     "retry_count": 0
                     }
             s3.upload_to_s3(file_path.replace("wav", "json"), data, is_json=True)
-            data = {
-                "es_id": f"{conversation_id}_AI_PRED",
-                "chunk_no": chunk_no,
-                "file_path": file_path,
-                "api_path": "clinical_notes",
-                "api_type": "clinical_notes",
-                "req_type": "encounter",
-                "executor_name": "AI_PRED",
-                "state": "AiPred",
-                "retry_count": None,
-                "uid": None,
-                "request_id": conversation_id,
-                "care_req_id": conversation_id,
-                "encounter_id": None,
-                "provider_id": None,
-                "review_provider_id": None,
-                "language": language,
-                "output_language": output_language,
-                "completed": False,
-                "exec_duration": 0.0,
-                "start_time": str(start_time),
-                "end_time": str(datetime.utcnow()),
-            }
+            manifest.append(conversation_id, chunk_no, duration, language, file_path.replace("wav", "json"))
+            data = TaskMessage(
+                state="AiPred",
+                request_id=conversation_id,
+                start_time=start_time,
+                chunk_no=chunk_no,
+                file_path=file_path,
+                api_path="clinical_notes",
+                api_type="clinical_notes",
+                req_type="encounter",
+                language=language,
+                output_language=output_language,
+            )
             producer.publish_executor_message(data)
 
-        except:
+        except Exception as exc:
             data = {"received_at": received_at,
                     "chunk_no": chunk_no,
                     "conversation_id": conversation_id,
@@ -233,32 +244,20 @@ class ASRExecutor:
                     }
             s3.upload_to_s3(file_path.replace("wav", "json"), data, is_json=True)
 
-            if retry_count <= 2:
-                retry_count += 1
-                data = {
-                    "es_id": f"{conversation_id}_ASR_EXECUTOR",
-                    "chunk_no": chunk_no,
-                    "file_path": file_path,
-                    "api_path": "clinical_notes",
-                    "api_type": "clinical_notes",
-                    "req_type": "encounter",
-                    "executor_name": "ASR_EXECUTOR",
-                    "state": "SpeechToText",
-                    "retry_count": retry_count,
-                    "uid": None,
-                    "request_id": conversation_id,
-                    "care_req_id": conversation_id,
-                    "encounter_id": None,
-                    "provider_id": None,
-                    "review_provider_id": None,
-                    "language": language,
-                    "output_language": output_language,
-                    "completed": False,
-                    "exec_duration": 0.0,
-                    "start_time": str(start_time),
-                    "end_time": str(datetime.utcnow()),
-                }
-                producer.publish_executor_message(data)
+            data = TaskMessage(
+                state="SpeechToText",
+                request_id=conversation_id,
+                start_time=start_time,
+                chunk_no=chunk_no,
+                file_path=file_path,
+                api_path="clinical_notes",
+                api_type="clinical_notes",
+                req_type="encounter",
+                retry_count=retry_count,
+                language=language,
+                output_language=output_language,
+            )
+            retries.schedule(data, exc)
 
     def speechToText(self, message, start_time):
         try:
@@ -275,40 +274,26 @@ class ASRExecutor:
 
             received_at = time.time()
 
-            audio_stream = BytesIO()
-            s3_object = s3.get_audio_file(file_path)
-            stream = s3_object['Body']
-            while True:
-                chunk = stream.read(2048)
-                if not chunk:
-                    break
-                audio_stream.write(chunk)
-
-            try:
-                audio_file = audio_stream
-                audio = AudioSegment.from_file(audio_file, format="wav")
-                duration_in_milliseconds = len(audio)
-                duration = duration_in_milliseconds / 1000.0
-                audio_stream.name = file_path.split("/")[1]
-                filename = file_path.split("/")[1]
-                unique_id = filename.split(".")[0] + "___" + language
-                audio_stream.seek(0)
-                transcription_result = requests.post(
-                    heconstants.AI_SERVER + f"/transcribe/infer?unique_id={unique_id}",
-                    files={"f1": audio_stream},
-                ).json()["prediction"][0]
-
-            except Exception as ex:
-                data = {
-                    "received_at": received_at,
-                    "conversation_id": request_id,
-                    "user_name": user_name,
-                    "duration": duration,
-                    "success": False,
-                    "audio_path": file_path,
-                }
-                s3.upload_to_s3(file_path.replace("wav", "json"), data, is_json=True)
-                logger.error(f"An unexpected error occurred in transcribe {request_id} :: {ex}")
+            with self.open_wav(file_path) as (audio_body, audio_header, byte_rate, duration):
+                try:
+                    filename = file_path.split("/")[1]
+                    unique_id = filename.split(".")[0] + "___" + language
+                    transcription_result, data_size = self.transcribe_stream(audio_body, audio_header, filename,
+                                                                             unique_id)
+                    if duration is None:
+                        duration = data_size / byte_rate
+
+                except Exception as ex:
+                    data = {
+                        "received_at": received_at,
+                        "conversation_id": request_id,
+                        "user_name": user_name,
+                        "duration": duration,
+                        "success": False,
+                        "audio_path": file_path,
+                    }
+                    s3.upload_to_s3(file_path.replace("wav", "json"), data, is_json=True)
+                    logger.error(f"An unexpected error occurred in transcribe {request_id} :: {ex}")
 
             current_segments = transcription_result.get("segments")
             language = transcription_result.get("language")
@@ -328,29 +313,18 @@ class ASRExecutor:
             s3.upload_to_s3(file_path.replace("wav", "json"), data, is_json=True)
 
             if api_type == "clinical_notes":
-                data = {
-                    "es_id": f"{request_id}_AI_PRED",
-                    "file_path": file_path,
-                    "webhook_url": webhook_url,
-                    "api_path": api_path,
-                    "api_type": api_type,
-                    "req_type": "platform",
-                    "executor_name": "AI_PRED",
-                    "state": "AiPred",
-                    "retry_count": 0,
-                    "uid": None,
-                    "request_id": request_id,
-                    "care_req_id": request_id,
-                    "encounter_id": None,
-                    "provider_id": None,
-                    "review_provider_id": None,
-                    "language": language,
-                    "output_language": output_language,
-                    "completed": False,
-                    "exec_duration": 0.0,
-                    "start_time": str(start_time),
-                    "end_time": str(datetime.utcnow()),
-                }
+                data = TaskMessage(
+                    state="AiPred",
+                    request_id=request_id,
+                    start_time=start_time,
+                    file_path=file_path,
+                    webhook_url=webhook_url,
+                    api_path=api_path,
+                    api_type=api_type,
+                    req_type="platform",
+                    language=language,
+                    output_language=output_language,
+                )
                 producer.publish_executor_message(data)
             elif api_type == "transcription":
                 self.create_delivery_task(message=message)
@@ -369,34 +343,20 @@ class ASRExecutor:
                     "retry_count": 0
                     }
             s3.upload_to_s3(file_path.replace("wav", "json"), data, is_json=True)
-            data = {
-                "es_id": f"{request_id}_ASR_EXECUTOR",
-                "file_path": file_path,
-                "webhook_url": webhook_url,
-                "api_path": api_path,
-                "api_type": api_type,
-                "req_type": "platform",
-                "executor_name": "ASR_EXECUTOR",
-                "state": "SpeechToText",
-                "retry_count": retry_count,
-                "uid": None,
-                "request_id": request_id,
-                "care_req_id": request_id,
-                "encounter_id": None,
-                "provider_id": None,
-                "review_provider_id": None,
-                "language": language,
-                "output_language": output_language,
-                "completed": False,
-                "exec_duration": 0.0,
-                "start_time": str(start_time),
-                "end_time": str(datetime.utcnow()),
-            }
-            if retry_count <= 2:
-                retry_count += 1
-                data["retry_count"] = retry_count
-                producer.publish_executor_message(data)
-            else:
+            data = TaskMessage(
+                state="SpeechToText",
+                request_id=request_id,
+                start_time=start_time,
+                file_path=file_path,
+                webhook_url=webhook_url,
+                api_path=api_path,
+                api_type=api_type,
+                req_type="platform",
+                retry_count=retry_count,
+                language=language,
+                output_language=output_language,
+            )
+            if not retries.schedule(data, ex):
                 response_json = {"request_id": request_id,
                                  "status": "Failed"}
                 merged_json_key = f"{request_id}/All_Preds.json"
@@ -418,30 +378,18 @@ class ASRExecutor:
             language = message.get("language", "en")
             output_language = message.get("output_language", "en")
 
-            data = {
-                "es_id": f"{request_id}_FINAL_EXECUTOR",
-                "chunk_no": chunk_no,
-                "file_path": file_path,
-                "webhook_url": webhook_url,
-                "api_path": api_path,
-                "api_type": api_type,
-                "req_type": req_type,
-                "executor_name": "FINAL_EXECUTOR",
-                "state": "Final",
-                "retry_count": 0,
-                "uid": None,
-                "request_id": request_id,
-                "care_req_id": request_id,
-                "encounter_id": None,
-                "provider_id": None,
-                "review_provider_id": None,
-                "language": language,
-                "output_language": output_language,
-                "completed": False,
-                "exec_duration": 0.0,
-                "start_time": str(datetime.utcnow()),
-                "end_time": str(datetime.utcnow()),
-            }
+            data = TaskMessage(
+                state="Final",
+                request_id=request_id,
+                chunk_no=chunk_no,
+                file_path=file_path,
+                webhook_url=webhook_url,
+                api_path=api_path,
+                api_type=api_type,
+                req_type=req_type,
+                language=language,
+                output_language=output_language,
+            )
             producer.publish_executor_message(data)
 
         except Exception as exc:
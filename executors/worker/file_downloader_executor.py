@@ -3,6 +3,7 @@ import logging
 import os
 import subprocess
 import traceback
+import uuid
 from datetime import datetime
 import av
 import time
@@ -14,12 +15,17 @@ import yt_dlp
 from pydub import AudioSegment
 from utils import heconstants
 from utils.s3_operation import S3SERVICE
+from utils.session_state import create_session_store
 from utils.send_logs import push_logs
 from services.kafka.kafka_service import KafkaService
+from services.kafka.task_message import TaskMessage
+from services.kafka.retry import RetryScheduler
 from config.logconfig import get_logger
 
 s3 = S3SERVICE()
-producer = KafkaService(group_id="filedownloader")
+sessions = create_session_store()
+producer = KafkaService()
+retries = RetryScheduler(producer)
 logger = get_logger()
 logger.setLevel(logging.INFO)
 
@@ -188,6 +194,8 @@ class fileDownloader:
             if rtmp_iterator is not None:
                 started = False
                 chunk_count = 1
+                # chunk numbers restart with every recording, so its chunks are a run of their own
+                recording_run_id = uuid.uuid4().hex
                 frames_per_chunk = 16000 * heconstants.chunk_duration  # 5 seconds of frames at 16000 Hz
                 bytes_per_frame = 2  # Assuming 16-bit audio (2 bytes per frame)
 
@@ -207,9 +215,7 @@ class fileDownloader:
                             data = {"stream_key": stream_key,
                                     "last_processed_end_time": 0,
                                     "stage": "rtmp_saving_started"}
-                            s3_file = f"{stream_key}/{stream_key}.json"
-                            if not s3.check_file_exists(s3_file):
-                                s3.upload_to_s3(s3_file, data, is_json=True)
+                            sessions.update(stream_key, data, expected={"version": None})
                             logger.info(f"Writing chunks started :: {stream_key}")
                             started = True
 
@@ -232,29 +238,19 @@ class fileDownloader:
                     wav_buffer.seek(0)  # Reset buffer pointer to the beginning
                     # Upload the finished chunk to S3
                     s3.upload_to_s3(key, wav_buffer.read())
-                    data = {
-                        "es_id": f"{stream_key}_ASR_EXECUTOR",
-                        "chunk_no": chunk_count,
-                        "file_path": key,
-                        "api_path": "clinical_notes",
-                        "api_type": "clinical_notes",
-                        "req_type": "encounter",
-                        "executor_name": "ASR_EXECUTOR",
-                        "state": "SpeechToText",
-                        "retry_count": 0,
-                        "uid": None,
-                        "request_id": stream_key,
-                        "care_req_id": stream_key,
-                        "encounter_id": None,
-                        "provider_id": None,
-                        "review_provider_id": None,
-                        "language": language,
-                        "output_language": output_language,
-                        "completed": False,
-                        "exec_duration": 0.0,
-                        "start_time": str(chunk_start_datetime),
-                        "end_time": str(datetime.utcnow()),
-                    }
+                    data = TaskMessage(
+                        state="SpeechToText",
+                        request_id=stream_key,
+                        start_time=chunk_start_datetime,
+                        chunk_no=chunk_count,
+                        file_path=key,
+                        api_path="clinical_notes",
+                        api_type="clinical_notes",
+                        req_type="encounter",
+                        language=language,
+                        output_language=output_language,
+                        run_id=recording_run_id,
+                    )
                     producer.publish_executor_message(data)
 
                     chunk_count += 1
@@ -266,41 +262,25 @@ class fileDownloader:
 
             # esquery
             logger.info("Stopped writing chunks")
-            key = f"{stream_key}/{stream_key}.json"
-            data = s3.get_json_file(key)
-            if data:
-                data["stage"] = "rtmp_saving_done"
-                s3.upload_to_s3(key, data, is_json=True)
+            sessions.update(stream_key, {"stage": "rtmp_saving_done"}, create=False)
 
         except Exception as exc:
             msg = "Failed rtmp loop saver :: {}".format(exc)
             trace = traceback.format_exc()
             logger.error(msg, trace)
-            if retry_count <= 2:
-                retry_count += 1
-                data = {
-                    "es_id": f"{stream_key}_FILE_DOWNLOADER",
-                    "file_path": file_path,
-                    "api_path": "clinical_notes",
-                    "api_type": "clinical_notes",
-                    "req_type": "encounter",
-                    "executor_name": "FILE_DOWNLOADER",
-                    "state": "Init",
-                    "retry_count": retry_count,
-                    "uid": None,
-                    "request_id": stream_key,
-                    "care_req_id": stream_key,
-                    "encounter_id": None,
-                    "provider_id": None,
-                    "review_provider_id": None,
-                    "language": language,
-                    "output_language": output_language,
-                    "completed": False,
-                    "exec_duration": 0.0,
-                    "start_time": str(start_time),
-                    "end_time": str(datetime.utcnow()),
-                }
-                producer.publish_executor_message(data)
+            data = TaskMessage(
+                state="Init",
+                request_id=stream_key,
+                start_time=start_time,
+                file_path=file_path,
+                api_path="clinical_notes",
+                api_type="clinical_notes",
+                req_type="encounter",
+                retry_count=retry_count,
+                language=language,
+                output_language=output_language,
+            )
+            retries.schedule(data, exc)
 
     def convert_to_wav(self, input_file):
         try:
@@ -361,7 +341,8 @@ class fileDownloader:
             else:
                 wav_filename = self.convert_to_wav(local_filename)
             s3_path = f"{request_id}/{request_id}.wav"
-            s3.upload_to_s3(s3_filename=s3_path, data=open(wav_filename, "rb"))
+            with open(wav_filename, "rb") as wav_file:
+                s3.upload_stream(s3_path, wav_file)
 
             try:
                 if os.path.exists(local_filename):
@@ -379,63 +360,37 @@ class fileDownloader:
             except OSError as e:
                 logger.error(f"Error:: {e.strerror}")
 
-            data = {
-                "es_id": f"{request_id}_ASR_EXECUTOR",
-                "file_path": s3_path,
-                "webhook_url": webhook_url,
-                "api_path": api_path,
-                "api_type": api_type,
-                "req_type": "platform",
-                "user_type": "Provider",
-                "executor_name": "ASR_EXECUTOR",
-                "state": "SpeechToText",
-                "retry_count": 0,
-                "uid": None,
-                "request_id": request_id,
-                "care_req_id": request_id,
-                "encounter_id": None,
-                "provider_id": None,
-                "review_provider_id": None,
-                "language": language,
-                "output_language": output_language,
-                "completed": False,
-                "exec_duration": 0.0,
-                "start_time": str(start_time),
-                "end_time": str(datetime.utcnow()),
-            }
+            data = TaskMessage(
+                state="SpeechToText",
+                request_id=request_id,
+                start_time=start_time,
+                file_path=s3_path,
+                webhook_url=webhook_url,
+                api_path=api_path,
+                api_type=api_type,
+                req_type="platform",
+                user_type="Provider",
+                language=language,
+                output_language=output_language,
+            )
             producer.publish_executor_message(data)
 
         except Exception as e:
             logger.error(f"An unexpected error occurred  {e}")
-            data = {
-                "es_id": f"{request_id}_FILE_DOWNLOADER",
-                "file_path": file_path,
-                "webhook_url": webhook_url,
-                "api_path": api_path,
-                "api_type": api_type,
-                "req_type": "platform",
-                "user_type": "Provider",
-                "executor_name": "FILE_DOWNLOADER",
-                "state": "Init",
-                "retry_count": retry_count,
-                "uid": None,
-                "request_id": request_id,
-                "care_req_id": request_id,
-                "encounter_id": None,
-                "provider_id": None,
-                "review_provider_id": None,
-                "language": language,
-                "output_language": output_language,
-                "completed": False,
-                "exec_duration": 0.0,
-                "start_time": str(datetime.utcnow()),
-                "end_time": str(datetime.utcnow()),
-            }
-            if retry_count <= 2:
-                retry_count += 1
-                data["retry_count"] = retry_count
-                producer.publish_executor_message(data)
-            else:
+            data = TaskMessage(
+                state="Init",
+                request_id=request_id,
+                file_path=file_path,
+                webhook_url=webhook_url,
+                api_path=api_path,
+                api_type=api_type,
+                req_type="platform",
+                user_type="Provider",
+                retry_count=retry_count,
+                language=language,
+                output_language=output_language,
+            )
+            if not retries.schedule(data, e):
                 response_json = {"request_id": request_id,
                                  "status": "Failed"}
                 merged_json_key = f"{request_id}/All_Preds.json"
@@ -20,7 +20,7 @@ from services.kafka.kafka_service import KafkaService
 from config.logconfig import get_logger
 
 s3 = S3SERVICE()
-producer = KafkaService(group_id="final")
+producer = KafkaService()
 logger = get_logger()
 logger.setLevel(logging.INFO)
 
@@ -97,6 +97,8 @@ class finalExecutor:
                     text = input_text.get("transcript")
 
                 if conversation_datas or text:
+                    artifacts = s3.get_jsons_if_exist([ai_preds_file_path, f"{request_id}/soap.json",
+                                                       f"{request_id}/translated_transcript.json"])
                     if conversation_datas:
                         audio_metas = []
                         for conversation_data in conversation_datas:
@@ -112,20 +114,18 @@ class finalExecutor:
                             response_json["segments"] = merged_segments
                             response_json["meta"] = audio_metas
 
-                    if s3.check_file_exists(ai_preds_file_path):
-                        merged_ai_preds = s3.get_json_file(ai_preds_file_path)
-                        summary_file = f"{request_id}/soap.json"
-                        if s3.check_file_exists(summary_file):
-                            summary_content = s3.get_json_file(s3_filename=summary_file)
-                            if summary_content:
-                                summary = {
-                                    "summaries": {}
-                                }
-                                for summary_type in ["subjectiveClinicalSummary", "objectiveClinicalSummary",
-                                                     "clinicalAssessment", "carePlanSuggested", "chiefComplaints",
-                                                     "presentIllness", "pastMedicalHistory", "reviewOfSystems"]:
-                                    summary["summaries"][summary_type] = summary_content.get(summary_type)
-                                merged_ai_preds.update(summary)
+                    if artifacts[ai_preds_file_path] is not None:
+                        merged_ai_preds = artifacts[ai_preds_file_path]
+                        summary_content = artifacts[f"{request_id}/soap.json"]
+                        if summary_content:
+                            summary = {
+                                "summaries": {}
+                            }
+                            for summary_type in ["subjectiveClinicalSummary", "objectiveClinicalSummary",
+                                                 "clinicalAssessment", "carePlanSuggested", "chiefComplaints",
+                                                 "presentIllness", "pastMedicalHistory", "reviewOfSystems"]:
+                                summary["summaries"][summary_type] = summary_content.get(summary_type)
+                            merged_ai_preds.update(summary)
 
                         if api_type in {"clinical_notes", "ai_pred"}:
                             response_json["ai_preds"] = merged_ai_preds
@@ -161,11 +161,9 @@ class finalExecutor:
                         #     if punc_transcript:
                         #         response_json["transcript"] = punc_transcript
 
-                    if s3.check_file_exists(key=f"{request_id}/translated_transcript.json"):
-                        translated_transcript_content = s3.get_json_file(
-                            s3_filename=f"{request_id}/translated_transcript.json")
-                        if translated_transcript_content:
-                            response_json["translated_transcript"] = translated_transcript_content.get("transcript")
+                    translated_transcript_content = artifacts[f"{request_id}/translated_transcript.json"]
+                    if translated_transcript_content:
+                        response_json["translated_transcript"] = translated_transcript_content.get("transcript")
 
                     response_json["success"] = True
 
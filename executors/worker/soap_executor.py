@@ -1,7 +1,6 @@
 import json
 import logging
 import traceback
-from datetime import datetime
 from typing import Optional
 import nltk
 
@@ -10,13 +9,18 @@ import requests
 
 from utils import heconstants
 from utils.s3_operation import S3SERVICE
+from utils.chunk_manifest import ChunkManifest
 from services.kafka.kafka_service import KafkaService
+from services.kafka.task_message import TaskMessage
+from services.kafka.retry import RetryScheduler
 from config.logconfig import get_logger
 
 # The default language is 'english'
 nltk.download('punkt')
 s3 = S3SERVICE()
-producer = KafkaService(group_id="soap")
+manifest = ChunkManifest(s3)
+producer = KafkaService()
+retries = RetryScheduler(producer)
 openai.api_key = heconstants.OPENAI_APIKEY
 logger = get_logger()
 logger.setLevel(logging.INFO)
@@ -316,8 +320,7 @@ class soap:
             dominant_language = None
 
             if req_type == "encounter":
-                conversation_datas = s3.get_files_matching_pattern(
-                    pattern=f"{conversation_id}/{conversation_id}_*json")
+                conversation_datas = manifest.get_chunk_datas(conversation_id)
             else:
                 # Check if call is from platform
                 if api_type == "clinical_notes":
@@ -344,8 +347,9 @@ class soap:
                         break
 
             ai_preds_file_path = f"{conversation_id}/ai_preds.json"
-            if s3.check_file_exists(ai_preds_file_path):
-                merged_ai_preds = s3.get_json_file(s3_filename=ai_preds_file_path)
+            ai_preds = s3.get_json_if_exists(ai_preds_file_path)
+            if ai_preds is not None:
+                merged_ai_preds = ai_preds
 
             return merged_segments, merged_ai_preds, dominant_language
 
@@ -474,8 +478,8 @@ class soap:
             # if interest_texts and len(" ".join(interest_texts).split()) >= 20:
             if interest_texts and len(interest_texts.split()) >= 20:
                 triage_ai_preds_key = f"{conversation_id}/triage_ai_preds.json"
-                if s3.check_file_exists(triage_ai_preds_key):
-                    preds = s3.get_json_file(triage_ai_preds_key)
+                preds = s3.get_json_if_exists(triage_ai_preds_key)
+                if preds is not None:
                     triage_ai_preds = preds.get("ai_preds")
 
                 # summaries = self.get_clinical_summaries_from_openai("\n".join(interest_texts), triage_ai_preds)
@@ -716,35 +720,21 @@ class soap:
 
         except Exception as e:
             self.logger.error(f"An unexpected error occurred while generating SOAP summary ::  {e}")
-            data = {
-                "es_id": f"{conversation_id}_SOAP",
-                "chunk_no": chunk_no,
-                "file_path": file_path,
-                "webhook_url": webhook_url,
-                "api_path": api_path,
-                "api_type": api_type,
-                "req_type": req_type,
-                "executor_name": "SOAP_EXECUTOR",
-                "state": "Analytics",
-                "retry_count": retry_count,
-                "uid": None,
-                "request_id": conversation_id,
-                "care_req_id": conversation_id,
-                "encounter_id": None,
-                "provider_id": None,
-                "review_provider_id": None,
-                "language": language,
-                "output_language": output_language,
-                "completed": False,
-                "exec_duration": 0.0,
-                "start_time": str(start_time),
-                "end_time": str(datetime.utcnow()),
-            }
-            if retry_count <= 2:
-                retry_count += 1
-                data["retry_count"] = retry_count
-                producer.publish_executor_message(data)
-            else:
+            data = TaskMessage(
+                state="Analytics",
+                request_id=conversation_id,
+                start_time=start_time,
+                chunk_no=chunk_no,
+                file_path=file_path,
+                webhook_url=webhook_url,
+                api_path=api_path,
+                api_type=api_type,
+                req_type=req_type,
+                retry_count=retry_count,
+                language=language,
+                output_language=output_language,
+            )
+            if not retries.schedule(data, e):
                 response_json = {"request_id": conversation_id,
                                  "status": "Failed"}
                 merged_json_key = f"{conversation_id}/All_Preds.json"
@@ -980,29 +970,18 @@ class soap:
             api_path = message.get("api_path")
             language = message.get("language", "en")
 
-            data = {
-                "es_id": f"{request_id}_FINAL_EXECUTOR",
-                "chunk_no": chunk_no,
-                "file_path": file_path,
-                "webhook_url": webhook_url,
-                "api_path": api_path,
-                "api_type": api_type,
-                "req_type": req_type,
-                "executor_name": "FINAL_EXECUTOR",
-                "state": "Final",
-                "retry_count": retry_count,
-                "uid": None,
-                "request_id": request_id,
-                "care_req_id": request_id,
-                "encounter_id": None,
-                "provider_id": None,
-                "review_provider_id": None,
-                "language": language,
-                "completed": False,
-                "exec_duration": 0.0,
-                "start_time": str(datetime.utcnow()),
-                "end_time": str(datetime.utcnow()),
-            }
+            data = TaskMessage(
+                state="Final",
+                request_id=request_id,
+                chunk_no=chunk_no,
+                file_path=file_path,
+                webhook_url=webhook_url,
+                api_path=api_path,
+                api_type=api_type,
+                req_type=req_type,
+                retry_count=retry_count,
+                language=language,
+            )
             producer.publish_executor_message(data)
 
         except Exception as exc:
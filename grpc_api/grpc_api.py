@@ -5,17 +5,21 @@ import traceback
 import uuid
 import wave
 from concurrent import futures
-from datetime import datetime
+from functools import partial
 import time
 from typing import Optional
 import grpc
-import requests
 import transcription_service_pb2 as pb2
 import transcription_service_pb2_grpc as pb2_grpc
 from config.logconfig import get_logger
 from services.kafka.kafka_service import KafkaService
+from services.kafka.task_message import TaskMessage
 from utils import heconstants
 from utils.s3_operation import S3SERVICE
+from utils.async_s3 import AsyncS3SERVICE
+from utils.write_behind import WriteBehindBuffer
+from utils.transcription_batcher import transcription_batcher
+from utils.chunk_manifest import ChunkManifest
 
 pattern = re.compile(
     r'(?:\b(?:thanks|thank you|you|bye|yeah|beep|okay|peace)\b[.!?,-]*\s*){2,}',
@@ -23,6 +27,9 @@ pattern = re.compile(
 word_pattern = re.compile(r'\b(?:Thank you|Bye|You)\.')
 
 s3 = S3SERVICE()
+async_s3 = AsyncS3SERVICE(s3)
+write_behind = WriteBehindBuffer(s3)
+manifest = ChunkManifest(s3)
 producer = KafkaService(group_id="grpc")
 
 logger = get_logger()
@@ -70,8 +77,13 @@ class TranscriptionService(pb2_grpc.TranscriptionServiceServicer):
             }
             response_json = {}
 
-            conversation_datas = s3.get_files_matching_pattern(
-                pattern=f"{conversation_id}/{conversation_id}_*json")
+            ai_preds_file_path = f"{conversation_id}/ai_preds.json"
+            summary_file = f"{conversation_id}/soap.json"
+            translated_file = f"{conversation_id}/translated_transcript.json"
+            keys = [translated_file] if only_transcribe else [ai_preds_file_path, summary_file, translated_file]
+            # both reads run on the storage pool at once, a server thread waits for one round of S3 latency
+            artifacts_read = async_s3.submit("get_jsons_if_exist", keys)
+            conversation_datas = async_s3.call(manifest.get_chunk_datas, conversation_id).result()
 
             if conversation_datas:
                 audio_metas = []
@@ -87,22 +99,21 @@ class TranscriptionService(pb2_grpc.TranscriptionServiceServicer):
 
                     response_json["segments"] = merged_segments
 
+                artifacts = artifacts_read.result()
+
                 if not only_transcribe:
-                    ai_preds_file_path = f"{conversation_id}/ai_preds.json"
-                    if s3.check_file_exists(ai_preds_file_path):
-                        merged_ai_preds = s3.get_json_file(ai_preds_file_path)
-                        summary_file = f"{conversation_id}/soap.json"
-                        if s3.check_file_exists(summary_file):
-                            summary_content = s3.get_json_file(s3_filename=summary_file)
-                            if summary_content:
-                                summary = {
-                                    "summaries": {}
-                                }
-                                for summary_type in ["subjectiveClinicalSummary", "objectiveClinicalSummary",
-                                                     "clinicalAssessment",
-                                                     "carePlanSuggested"]:
-                                    summary["summaries"][summary_type] = summary_content.get(summary_type)
-                                merged_ai_preds.update(summary)
+                    if artifacts[ai_preds_file_path] is not None:
+                        merged_ai_preds = artifacts[ai_preds_file_path]
+                        summary_content = artifacts[summary_file]
+                        if summary_content:
+                            summary = {
+                                "summaries": {}
+                            }
+                            for summary_type in ["subjectiveClinicalSummary", "objectiveClinicalSummary",
+                                                 "clinicalAssessment",
+                                                 "carePlanSuggested"]:
+                                summary["summaries"][summary_type] = summary_content.get(summary_type)
+                            merged_ai_preds.update(summary)
                         response_json["ai_preds"] = merged_ai_preds
 
                 response_json["meta"] = audio_metas
@@ -111,11 +122,9 @@ class TranscriptionService(pb2_grpc.TranscriptionServiceServicer):
                 if merged_segments:
                     response_json["transcript"] = " ".join([_["text"] for _ in merged_segments])
 
-                if s3.check_file_exists(key=f"{conversation_id}/translated_transcript.json"):
-                    translated_transcript_content = s3.get_json_file(
-                        s3_filename=f"{conversation_id}/translated_transcript.json")
-                    if translated_transcript_content:
-                        response_json["translated_transcript"] = translated_transcript_content.get("transcript")
+                translated_transcript_content = artifacts[translated_file]
+                if translated_transcript_content:
+                    response_json["translated_transcript"] = translated_transcript_content.get("transcript")
 
                 return response_json
 
@@ -145,6 +154,8 @@ class TranscriptionService(pb2_grpc.TranscriptionServiceServicer):
             WAV_F_combined.setframerate(16000)
             combined_frames = 0
             chunk_start_time_10s = time.time()
+            # chunk uploads run in the background, each queued behind the previous one of this stream
+            chunk_upload = None
             while True:
                 chunk_start_time = time.time()
                 wav_buffer = io.BytesIO()
@@ -173,10 +184,7 @@ class TranscriptionService(pb2_grpc.TranscriptionServiceServicer):
                 wav_buffer.seek(0)  # Reset buffer pointer to the beginning
 
                 # logger.info(f"sending chunks for transcription :: {key}")
-                transcription_result = requests.post(
-                    heconstants.AI_SERVER + "/transcribe/infer",
-                    files={"f1": wav_buffer},
-                ).json()["prediction"][0]
+                transcription_result = transcription_batcher.transcribe(wav_buffer.getvalue(), wav_buffer.name)
                 # print("transcription_result", transcription_result)
                 segments = transcription_result.get("segments")
                 if segments:
@@ -194,36 +202,25 @@ class TranscriptionService(pb2_grpc.TranscriptionServiceServicer):
                     transcript = re.sub(' +', ' ', transcript).strip()
                 transcript_key = f"{stream_key}/transcript.json"
                 transcript_data = {"transcript": transcript}
-                s3.upload_to_s3(transcript_key, transcript_data, is_json=True)
+                write_behind.put(transcript_key, transcript_data)
                 yield pb2.TranscriptionResult(cc=transcript, conversation_id=stream_key, success=True)
 
                 if iterations >= 1:
                     WAV_F_combined.close()
                     wav_buffer_combined.seek(0)
                     chunk_audio_key = f"{stream_key}/{stream_key}_chunk{chunk_count}.wav"
-                    s3.upload_to_s3(chunk_audio_key, wav_buffer_combined.read())
-                    data = {
-                        "es_id": f"{stream_key}_ASR_EXECUTOR",
-                        "chunk_no": chunk_count,
-                        "file_path": chunk_audio_key,
-                        "api_path": "clinical_notes",
-                        "api_type": "clinical_notes",
-                        "req_type": "encounter",
-                        "executor_name": "ASR_EXECUTOR",
-                        "state": "SpeechToText",
-                        "retry_count": 0,
-                        "uid": None,
-                        "request_id": stream_key,
-                        "care_req_id": stream_key,
-                        "encounter_id": None,
-                        "provider_id": None,
-                        "review_provider_id": None,
-                        "completed": False,
-                        "exec_duration": 0.0,
-                        "start_time": str(datetime.utcnow()),
-                        "end_time": str(datetime.utcnow()),
-                    }
-                    producer.publish_executor_message(data)
+                    data = TaskMessage(
+                        state="SpeechToText",
+                        request_id=stream_key,
+                        chunk_no=chunk_count,
+                        file_path=chunk_audio_key,
+                        api_path="clinical_notes",
+                        api_type="clinical_notes",
+                        req_type="encounter",
+                    )
+                    chunk_upload = async_s3.upload_then(chunk_audio_key, wav_buffer_combined.read(),
+                                                        then=partial(producer.publish_executor_message, data),
+                                                        previous=chunk_upload)
                     iterations = 0
                     wav_buffer_combined = io.BytesIO()
                     WAV_F_combined = wave.open(wav_buffer_combined, "wb")
@@ -236,6 +233,7 @@ class TranscriptionService(pb2_grpc.TranscriptionServiceServicer):
                 if current_time - chunk_start_time < heconstants.quick_loop_chunk_duration:
                     # Break the while loop if the last chunk duration is less than 5 seconds
                     break
+            write_behind.flush(f"{stream_key}/transcript.json")
 
     def FetchAIPredictions(self, request, context):
         response_data = self.get_merge_ai_preds(conversation_id=request.conversation_id,
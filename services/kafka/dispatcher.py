@@ -0,0 +1,131 @@
+import threading
+from typing import Optional
+
+from config.logconfig import get_logger
+from services.kafka.structs import OffsetAndMetadata, TopicPartition
+
+logger = get_logger()
+
+
+class RedeliveryRequired(Exception):
+    """
+    Raised by a task whose message must be read again, e.g. because its retry could not be
+    published. Its offset, and with it every later offset of the partition, stays uncommitted
+    until the partition is re-read after a restart or rebalance.
+    """
+
+
+class InFlightDispatcher:
+    """
+    Bounds the number of tasks a consumer has in flight and commits offsets only
+    once every task up to that offset has completed (at-least-once delivery).
+
+    Offsets are tracked per partition in poll order. The committed offset of a
+    partition is the lowest offset that is still running, so a crash never skips
+    a task that was polled but not finished.
+    """
+
+    def __init__(self, consumer, max_in_flight: int, resume_at: Optional[int] = None):
+        self.consumer = consumer
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.resume_at = resume_at if resume_at is not None else self.max_in_flight // 2
+        self._lock = threading.Lock()
+        self._drained = threading.Condition(self._lock)
+        self._pending = {}  # TopicPartition -> {offset: done}
+        self._in_flight = 0
+        self._paused = False
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def poll(self, timeout_ms: int):
+        self.commit()
+        self._forget_revoked()
+        self._apply_backpressure()
+        records = self.consumer.poll(timeout_ms=timeout_ms)
+        with self._lock:
+            for tp, partition_records in records.items():
+                offsets = self._pending.setdefault(tp, {})
+                for record in partition_records:
+                    offsets[record.offset] = False
+        return [record for partition_records in records.values() for record in partition_records]
+
+    def track(self, record, future=None):
+        """Attach the future running ``record``; records without a future are done immediately."""
+        if future is None:
+            self._complete(record, None)
+            return
+        with self._lock:
+            self._in_flight += 1
+        future.add_done_callback(lambda f: self._complete(record, f, counted=True))
+
+    def _complete(self, record, future, counted: bool = False):
+        redeliver = False
+        if future is not None and not future.cancelled() and future.exception() is not None:
+            redeliver = isinstance(future.exception(), RedeliveryRequired)
+            logger.error(f"Task at {record.topic}[{record.partition}]@{record.offset} failed"
+                         f"{', leaving it uncommitted' if redeliver else ''} :: {future.exception()}")
+        with self._lock:
+            offsets = self._pending.get(TopicPartition(record.topic, record.partition))
+            if offsets is not None and record.offset in offsets and not redeliver:
+                offsets[record.offset] = True
+            if counted:
+                self._in_flight -= 1
+                if self._in_flight == 0:
+                    self._drained.notify_all()
+
+    def commit(self):
+        offsets = {}
+        with self._lock:
+            for tp, pending in self._pending.items():
+                committable = None
+                while pending:
+                    offset = next(iter(pending))
+                    if not pending[offset]:
+                        break
+                    del pending[offset]
+                    committable = offset + 1
+                if committable is not None:
+                    offsets[tp] = OffsetAndMetadata(committable, None)
+        if not offsets:
+            return
+        try:
+            self.consumer.commit(offsets=offsets)
+        except Exception as exc:
+            # happens when partitions were revoked by a rebalance; the new owner re-reads from the last commit
+            logger.error(f"Offset commit failed :: {exc}")
+
+    def _forget_revoked(self):
+        assigned = set(self.consumer.assignment())
+        with self._lock:
+            for tp in list(self._pending):
+                if tp not in assigned:
+                    del self._pending[tp]
+
+    def _apply_backpressure(self):
+        if not self._paused and self._in_flight >= self.max_in_flight:
+            partitions = self.consumer.assignment()
+            if partitions:
+                self.consumer.pause(*partitions)
+                self._paused = True
+                logger.info(f"Paused consumption, {self._in_flight} tasks in flight")
+        elif self._paused and self._in_flight <= self.resume_at:
+            self.consumer.resume(*self.consumer.paused())
+            self._paused = False
+            logger.info(f"Resumed consumption, {self._in_flight} tasks in flight")
+        elif self._paused:
+            # partitions assigned by a rebalance while paused start out unpaused
+            unpaused = set(self.consumer.assignment()) - set(self.consumer.paused())
+            if unpaused:
+                self.consumer.pause(*unpaused)
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait up to ``timeout`` seconds for in-flight tasks to finish and commit what they completed.
+        Returns False when tasks were still running.
+        """
+        with self._lock:
+            drained = self._drained.wait_for(lambda: self._in_flight == 0, timeout=timeout)
+        self.commit()
+        return drained
@@ -0,0 +1,65 @@
+import argparse
+import uuid
+
+from config.logconfig import get_logger
+from services.kafka.kafka_service import KafkaService, create_consumer
+from services.kafka.task_message import decode_message
+from utils import heconstants
+
+logger = get_logger()
+
+DEAD_LETTER_FIELDS = ("dead_lettered_at", "error", "error_type", "last_error", "retry_at")
+
+
+def read_dead_letters(state=None, request_id=None, limit=None):
+    # a throw-away group so replays always start from the beginning and never move a shared offset
+    consumer = create_consumer(heconstants.DEAD_LETTER_TOPIC,
+                               group_id=f"dlq-replay-{uuid.uuid4()}",
+                               auto_offset_reset="earliest",
+                               enable_auto_commit=False,
+                               consumer_timeout_ms=5000)
+    count = 0
+    try:
+        for record in consumer:
+            message = decode_message(record.value).to_dict()
+            if state and message.get("state") != state:
+                continue
+            if request_id and request_id not in (message.get("request_id"), message.get("care_req_id")):
+                continue
+            yield message
+            count += 1
+            if limit and count >= limit:
+                break
+    finally:
+        consumer.close(autocommit=False)
+
+
+def replay(state=None, request_id=None, limit=None, dry_run=False):
+    kafka_service = KafkaService()
+    replayed = 0
+    for message in read_dead_letters(state, request_id, limit):
+        logger.info(f"Replaying {message.get('state')} for {message.get('request_id')} "
+                    f"(failed with {message.get('error_type')})")
+        if dry_run:
+            replayed += 1
+            continue
+        for field in DEAD_LETTER_FIELDS:
+            message.pop(field, None)
+        message["retry_count"] = 0
+        # a new run, or the idempotency store would skip it as the attempt that already ran
+        message["run_id"] = uuid.uuid4().hex
+        kafka_service.publish_executor_message(message)
+        replayed += 1
+    kafka_service.flush()
+    logger.info(f"Replayed {replayed} dead-lettered tasks")
+    return replayed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-publish dead-lettered executor tasks to their stage topic")
+    parser.add_argument("--state", help="only replay tasks of this state, e.g. SpeechToText")
+    parser.add_argument("--request-id", help="only replay tasks of this request")
+    parser.add_argument("--limit", type=int, help="replay at most this many tasks")
+    parser.add_argument("--dry-run", action="store_true", help="list the tasks without publishing them")
+    args = parser.parse_args()
+    replay(args.state, args.request_id, args.limit, args.dry_run)
@@ -0,0 +1,109 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from config.logconfig import get_logger
+from utils import heconstants
+
+logger = get_logger()
+
+
+def task_key(message) -> str:
+    # a scheduled retry bumps retry_count and so is a new task, a redelivery of the same attempt is not.
+    # The run tells a re-published Init, the chunks of a new recording and a replayed dead letter apart
+    # from the earlier tasks of the same request; messages from before run_id use their publish time
+    chunk_no = message.get("chunk_no")
+    return "{}:{}:{}:{}:{}".format(message.get("care_req_id") or message.get("request_id"), message.get("state"),
+                                   chunk_no if chunk_no is not None else "", message.get("retry_count") or 0,
+                                   message.get("run_id") or message.get("end_time"))
+
+
+class MemoryIdempotencyStore:
+    """Completion markers for this process only, evicted by TTL and then least recently used."""
+
+    def __init__(self, ttl: int = heconstants.IDEMPOTENCY_TTL_SECONDS,
+                 max_entries: int = heconstants.IDEMPOTENCY_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> expires_at
+        self._lock = threading.Lock()
+
+    def is_done(self, key: str) -> bool:
+        with self._lock:
+            expires_at = self._entries.get(key)
+            if expires_at is None:
+                return False
+            if expires_at < time.time():
+                del self._entries[key]
+                return False
+            self._entries.move_to_end(key)
+            return True
+
+    def mark_done(self, key: str):
+        with self._lock:
+            self._entries[key] = time.time() + self.ttl
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class SQLiteIdempotencyStore:
+    """Completion markers that survive a restart of the executor on the same host."""
+
+    def __init__(self, path: str = heconstants.IDEMPOTENCY_SQLITE_PATH, ttl: int = heconstants.IDEMPOTENCY_TTL_SECONDS):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS completed_tasks (key TEXT PRIMARY KEY, expires_at REAL)")
+        self._writes = 0
+
+    def is_done(self, key: str) -> bool:
+        with self._lock:
+            row = self._conn.execute("SELECT expires_at FROM completed_tasks WHERE key = ?", (key,)).fetchone()
+        return row is not None and row[0] >= time.time()
+
+    def mark_done(self, key: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO completed_tasks (key, expires_at) VALUES (?, ?)",
+                               (key, now + self.ttl))
+            self._writes += 1
+            if self._writes % 1000 == 0:
+                self._conn.execute("DELETE FROM completed_tasks WHERE expires_at < ?", (now,))
+
+
+class RedisIdempotencyStore:
+    """Completion markers shared by every executor replica."""
+
+    def __init__(self, url: str = heconstants.IDEMPOTENCY_REDIS_URL, ttl: int = heconstants.IDEMPOTENCY_TTL_SECONDS,
+                 prefix: str = "task-done:"):
+        import redis
+
+        self.ttl = ttl
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+
+    def is_done(self, key: str) -> bool:
+        return bool(self._client.exists(self.prefix + key))
+
+    def mark_done(self, key: str):
+        self._client.set(self.prefix + key, 1, ex=self.ttl)
+
+
+IDEMPOTENCY_STORES = {
+    "memory": MemoryIdempotencyStore,
+    "sqlite": SQLiteIdempotencyStore,
+    "redis": RedisIdempotencyStore,
+}
+
+
+def create_idempotency_store(backend: Optional[str] = None):
+    backend = backend or heconstants.IDEMPOTENCY_BACKEND
+    if not backend or backend == "none":
+        return None
+    if backend not in IDEMPOTENCY_STORES:
+        raise ValueError(f"idempotency backend must be one of {sorted(IDEMPOTENCY_STORES)} or 'none'")
+    return IDEMPOTENCY_STORES[backend]()
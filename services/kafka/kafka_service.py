@@ -1,11 +1,14 @@
-import json
+import atexit
 import logging
+import os
+import threading
 import time
 import traceback
+from typing import Callable, List, Optional, Union
 
-from kafka import KafkaConsumer, KafkaProducer
 from config.logconfig import get_logger
 import multiprocessing
+from services.kafka.task_message import current_task, encode_message
 from utils import heconstants
 
 logger = get_logger()
@@ -14,26 +17,86 @@ logger = get_logger()
 
 max_poll_records = (multiprocessing.cpu_count() * 2) + 1
 
+_producer = None
+_producer_pid = None
+_producer_lock = threading.Lock()
+
+
+def get_stage_topic(state: Optional[str]):
+    return heconstants.STAGE_TOPICS.get(state, heconstants.EXECUTOR_TOPIC)
+
+
+def _client_classes():
+    if heconstants.BROKER_BACKEND == "memory":
+        from services.kafka.memory_broker import MemoryConsumer, MemoryProducer
+        return MemoryConsumer, MemoryProducer
+    from kafka import KafkaConsumer, KafkaProducer
+    return KafkaConsumer, KafkaProducer
+
+
+def create_consumer(*topics, **configs):
+    consumer_class, _ = _client_classes()
+    return consumer_class(*topics, bootstrap_servers=heconstants.BOOTSTRAP_SERVERS, **configs)
+
+
+def get_producer():
+    # one producer per process, shared by the executor runtime and every worker module
+    global _producer, _producer_pid
+    with _producer_lock:
+        if _producer is None or _producer_pid != os.getpid():
+            _, producer_class = _client_classes()
+            _producer = producer_class(bootstrap_servers=heconstants.BOOTSTRAP_SERVERS,
+                                       key_serializer=lambda x: x.encode('utf-8') if x else None,
+                                       linger_ms=heconstants.PRODUCER_LINGER_MS,
+                                       batch_size=heconstants.PRODUCER_BATCH_SIZE,
+                                       compression_type=heconstants.PRODUCER_COMPRESSION_TYPE)
+            _producer_pid = os.getpid()
+            # messages still sitting in the producer batch are lost if the process exits without a flush
+            atexit.register(_producer.flush, heconstants.PRODUCER_FLUSH_TIMEOUT)
+        return _producer
+
+
+def flush_producer(timeout: Optional[float] = None):
+    """Flushes the producer of this process, if it created one; raises when the flush times out."""
+    with _producer_lock:
+        producer = _producer if _producer_pid == os.getpid() else None
+    if producer is not None:
+        producer.flush(timeout=timeout or heconstants.PRODUCER_FLUSH_TIMEOUT)
+
+
+def wait_for_delivery(future, timeout: Optional[float] = None):
+    """Blocks until the broker acked a ``publish``; raises when the send failed or timed out."""
+    if isinstance(future, tuple):
+        # publish reports a send that failed right away as (message, 500)
+        raise RuntimeError(future[0])
+    return future.get(timeout=timeout or heconstants.PRODUCER_FLUSH_TIMEOUT)
+
 
 class KafkaService:
-    def __init__(self, group_id: str):
-        self.post_consumer = self.create_clients(group_id)
-        self.producer = KafkaProducer(bootstrap_servers=heconstants.BOOTSTRAP_SERVERS,
-                                      value_serializer=lambda x: x.encode('utf-8'))
+    def __init__(self, group_id: Optional[str] = None, state: Optional[Union[str, List[str]]] = None,
+                 topics: Optional[List[str]] = None):
+        # only executors pass the state(s) or raw topics they consume; everyone else just publishes
+        states = [state] if isinstance(state, str) else (state or [])
+        self.topics = topics or [get_stage_topic(s) for s in states]
+        self.topic = self.topics[0] if self.topics else heconstants.EXECUTOR_TOPIC
+        self.post_consumer = self.create_clients(group_id) if group_id and self.topics else None
+
+    @property
+    def producer(self):
+        return get_producer()
 
     def create_clients(self, group_id: str):
         kafka_ping = False
         while kafka_ping == False:
             try:
-                consumer_post_message = KafkaConsumer(heconstants.EXECUTOR_TOPIC,
-                                                      bootstrap_servers=heconstants.BOOTSTRAP_SERVERS,
-                                                      group_id=group_id,
-                                                      enable_auto_commit=False,
-                                                      reconnect_backoff_ms=int(heconstants.RECONNECT_BACKOFF_MS),
-                                                      retry_backoff_ms=int(heconstants.RETRY_BACKOFF_MS),
-                                                      heartbeat_interval_ms=int(heconstants.HEARTBEAT_INTERVAL_MS),
-                                                      max_poll_records=int(max_poll_records),
-                                                      session_timeout_ms=int(heconstants.SESSION_TIMEOUT_MS))
+                consumer_post_message = create_consumer(*self.topics,
+                                                        group_id=group_id,
+                                                        enable_auto_commit=False,
+                                                        reconnect_backoff_ms=int(heconstants.RECONNECT_BACKOFF_MS),
+                                                        retry_backoff_ms=int(heconstants.RETRY_BACKOFF_MS),
+                                                        heartbeat_interval_ms=int(heconstants.HEARTBEAT_INTERVAL_MS),
+                                                        max_poll_records=int(max_poll_records),
+                                                        session_timeout_ms=int(heconstants.SESSION_TIMEOUT_MS))
 
                 topic = consumer_post_message.topics()
                 if not topic:
@@ -64,16 +127,66 @@ class KafkaService:
             # SentryUtilFunctions().send_event(exc, trace)
             return msg, 500
 
-    def publish_executor_message(self, data):
+    def consumer_lag(self):
+        """
+        Messages behind the partition end for every assigned partition.
+
+        Uses the high watermark cached from the last fetch, so it does not hit the
+        broker; call it from the polling thread, the consumer is not thread safe.
+        """
+        lag = {}
+        if self.post_consumer is None:
+            return lag
+        for tp in self.post_consumer.assignment():
+            highwater = self.post_consumer.highwater(tp)
+            if highwater is None:
+                continue
+            lag[tp] = max(0, highwater - self.post_consumer.position(tp))
+        return lag
+
+    def publish_executor_message(self, data, on_delivery: Optional[Callable] = None):
+        """
+        Queue ``data`` on its stage topic without waiting for the broker.
+
+        The outcome is reported asynchronously; ``on_delivery(data, record_metadata, exc)``
+        is called from the producer I/O thread once the broker acks or the send fails.
+        """
+        return self.publish(get_stage_topic(data.get("state")), data, on_delivery)
+
+    def publish(self, topic: str, data, on_delivery: Optional[Callable] = None):
+        # a handler's publishes are part of its task, the runtime waits for them before committing it
+        task = current_task.get()
         try:
-            self.producer.send(heconstants.EXECUTOR_TOPIC, value=json.dumps(data))
-            logger.info("Message sent")
+            # care_req_id as key keeps every chunk of a conversation on one partition
+            future = self.producer.send(topic, key=data.get("care_req_id"), value=encode_message(data))
+            future.add_callback(self._on_send_success, data, on_delivery)
+            future.add_errback(self._on_send_error, data, on_delivery)
         except Exception as exc:
-            msg = "producer failed to push message in {} :: {}".format(heconstants.EXECUTOR_TOPIC, exc)
+            msg = "producer failed to push message in {} :: {}".format(topic, exc)
             logger.error(msg)
             trace = traceback.format_exc()
             # SentryUtilFunctions().send_event(exc, trace)
-            return msg, 500
+            future = msg, 500
+        if task is not None:
+            task.publishes.append(future)
+        return future
+
+    def _on_send_success(self, data, on_delivery, record_metadata):
+        logger.info(f"Message delivered :: {data.get('es_id')} :: "
+                    f"{record_metadata.topic}[{record_metadata.partition}]@{record_metadata.offset}")
+        if on_delivery:
+            on_delivery(data, record_metadata, None)
+
+    def _on_send_error(self, data, on_delivery, exc):
+        logger.error(f"Message delivery failed :: {data.get('es_id')} :: {data.get('state')} :: {exc}")
+        if on_delivery:
+            on_delivery(data, None, exc)
+
+    def flush(self, timeout: Optional[float] = None):
+        try:
+            self.producer.flush(timeout=timeout or heconstants.PRODUCER_FLUSH_TIMEOUT)
+        except Exception as exc:
+            logger.error(f"Producer flush failed :: {exc}")
 
 
 # if __name__ == "__main__":
@@ -0,0 +1,267 @@
+import itertools
+import threading
+import time
+import zlib
+from typing import Optional
+
+from config.logconfig import get_logger
+from services.kafka.structs import ConsumerRecord, OffsetAndMetadata, RecordMetadata, TopicPartition
+
+logger = get_logger()
+
+
+class CommitFailedError(Exception):
+    pass
+
+
+class MemoryBroker:
+    """
+    In-process stand-in for the Kafka cluster: keyed partitions, consumer groups
+    with committed offsets and a round-robin rebalance on every join/leave.
+    Nothing is persisted, a new process starts with an empty broker.
+    """
+
+    def __init__(self, num_partitions: int = 4):
+        self.num_partitions = num_partitions
+        self._condition = threading.Condition()
+        self._logs = {}  # topic -> [[ConsumerRecord] per partition]
+        self._committed = {}  # group_id -> {TopicPartition: offset}
+        self._members = {}  # group_id -> [MemoryConsumer]
+        self._round_robin = itertools.count()
+
+    def _ensure_topic(self, topic):
+        if topic not in self._logs:
+            self._logs[topic] = [[] for _ in range(self.num_partitions)]
+        return self._logs[topic]
+
+    def topics(self):
+        with self._condition:
+            return set(self._logs)
+
+    def append(self, topic, key, value) -> RecordMetadata:
+        with self._condition:
+            partitions = self._ensure_topic(topic)
+            if key is None:
+                partition = next(self._round_robin) % len(partitions)
+            else:
+                partition = zlib.crc32(key) % len(partitions)
+            log = partitions[partition]
+            timestamp = int(time.time() * 1000)
+            log.append(ConsumerRecord(topic, partition, len(log), timestamp, key, value))
+            self._condition.notify_all()
+            return RecordMetadata(topic, partition, len(log) - 1, timestamp)
+
+    def highwater(self, tp):
+        with self._condition:
+            return len(self._ensure_topic(tp.topic)[tp.partition])
+
+    def committed(self, group_id, tp):
+        with self._condition:
+            return self._committed.get(group_id, {}).get(tp)
+
+    def commit(self, consumer, offsets):
+        with self._condition:
+            revoked = [tp for tp in offsets if tp not in consumer.assignment()]
+            if revoked:
+                raise CommitFailedError(f"partitions {revoked} are no longer assigned to this consumer")
+            self._committed.setdefault(consumer.group_id, {}).update(offsets)
+
+    def join(self, consumer):
+        with self._condition:
+            for topic in consumer.subscription():
+                self._ensure_topic(topic)
+            self._members.setdefault(consumer.group_id, []).append(consumer)
+            self._rebalance(consumer.group_id)
+
+    def leave(self, consumer):
+        with self._condition:
+            members = self._members.get(consumer.group_id, [])
+            if consumer in members:
+                members.remove(consumer)
+                consumer._assign(set())
+                self._rebalance(consumer.group_id)
+
+    def _rebalance(self, group_id):
+        members = self._members.get(group_id, [])
+        topics = sorted({topic for member in members for topic in member.subscription()})
+        partitions = [TopicPartition(topic, p) for topic in topics for p in range(len(self._logs[topic]))]
+        assignments = {id(member): set() for member in members}
+        for i, tp in enumerate(partitions):
+            candidates = [m for m in members if tp.topic in m.subscription()]
+            if candidates:
+                assignments[id(candidates[i % len(candidates)])].add(tp)
+        for member in members:
+            member._assign(assignments[id(member)])
+        self._condition.notify_all()
+
+    def fetch(self, consumer, timeout_ms, max_records):
+        deadline = time.time() + timeout_ms / 1000.0
+        with self._condition:
+            while True:
+                records = {}
+                budget = max_records
+                for tp in sorted(consumer.assignment() - consumer.paused()):
+                    position = consumer._positions[tp]
+                    batch = self._logs[tp.topic][tp.partition][position:position + budget]
+                    if batch:
+                        records[tp] = batch
+                        consumer._positions[tp] = position + len(batch)
+                        budget -= len(batch)
+                    if budget <= 0:
+                        break
+                remaining = deadline - time.time()
+                if records or remaining <= 0 or consumer._closed:
+                    return records
+                self._condition.wait(remaining)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker() -> MemoryBroker:
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            _broker = MemoryBroker()
+        return _broker
+
+
+class MemoryConsumer:
+    """Subset of ``kafka.KafkaConsumer`` used by the executors, backed by the process-wide ``MemoryBroker``."""
+
+    def __init__(self, *topics, group_id: Optional[str] = None, enable_auto_commit: bool = True,
+                 max_poll_records: int = 500, auto_offset_reset: str = "earliest",
+                 consumer_timeout_ms: float = float("inf"), broker: Optional[MemoryBroker] = None, **configs):
+        self.broker = broker or get_broker()
+        self.group_id = group_id or f"memory-consumer-{id(self)}"
+        self.config = dict(configs, group_id=self.group_id, enable_auto_commit=enable_auto_commit,
+                           max_poll_records=max_poll_records, auto_offset_reset=auto_offset_reset,
+                           consumer_timeout_ms=consumer_timeout_ms)
+        self._subscription = set(topics)
+        self._assignment = set()
+        self._paused = set()
+        self._positions = {}
+        self._closed = False
+        self.broker.join(self)
+
+    def _assign(self, partitions):
+        # called by the broker under its lock
+        for tp in partitions - self._assignment:
+            committed = self.broker._committed.get(self.group_id, {}).get(tp)
+            if committed is not None:
+                self._positions[tp] = committed.offset
+            elif self.config["auto_offset_reset"] == "earliest":
+                self._positions[tp] = 0
+            else:
+                self._positions[tp] = len(self.broker._logs[tp.topic][tp.partition])
+        for tp in self._assignment - partitions:
+            self._positions.pop(tp, None)
+            self._paused.discard(tp)
+        self._assignment = set(partitions)
+
+    def subscription(self):
+        return set(self._subscription)
+
+    def topics(self):
+        return self.broker.topics()
+
+    def assignment(self):
+        return set(self._assignment)
+
+    def poll(self, timeout_ms: int = 0, max_records: Optional[int] = None):
+        records = self.broker.fetch(self, timeout_ms, max_records or self.config["max_poll_records"])
+        if self.config["enable_auto_commit"] and records:
+            self.commit()
+        return records
+
+    def commit(self, offsets=None):
+        if offsets is None:
+            offsets = {tp: OffsetAndMetadata(self._positions[tp], None) for tp in self.assignment()}
+        self.broker.commit(self, offsets)
+
+    def committed(self, tp):
+        committed = self.broker.committed(self.group_id, tp)
+        return committed.offset if committed is not None else None
+
+    def position(self, tp):
+        return self._positions[tp]
+
+    def highwater(self, tp):
+        return self.broker.highwater(tp)
+
+    def pause(self, *partitions):
+        self._paused.update(partitions)
+
+    def resume(self, *partitions):
+        self._paused.difference_update(partitions)
+
+    def paused(self):
+        return set(self._paused)
+
+    def close(self, autocommit: bool = True):
+        if self._closed:
+            return
+        if autocommit and self.config["enable_auto_commit"]:
+            self.commit()
+        self._closed = True
+        self.broker.leave(self)
+
+    def __iter__(self):
+        timeout_ms = self.config["consumer_timeout_ms"]
+        while not self._closed:
+            records = self.poll(timeout_ms=timeout_ms if timeout_ms != float("inf") else 1000)
+            if not records and timeout_ms != float("inf"):
+                return
+            for partition_records in records.values():
+                yield from partition_records
+
+
+class _SendFuture:
+    """Already-resolved stand-in for kafka-python's ``FutureRecordMetadata``."""
+
+    def __init__(self, value=None, exception=None):
+        self.value = value
+        self.exception = exception
+
+    def add_callback(self, fn, *args):
+        if self.exception is None:
+            fn(*args, self.value)
+        return self
+
+    def add_errback(self, fn, *args):
+        if self.exception is not None:
+            fn(*args, self.exception)
+        return self
+
+    def get(self, timeout=None):
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+
+class MemoryProducer:
+    """Subset of ``kafka.KafkaProducer``; sends are appended synchronously, so ``flush`` has nothing to do."""
+
+    def __init__(self, key_serializer=None, value_serializer=None, broker: Optional[MemoryBroker] = None,
+                 **configs):
+        self.broker = broker or get_broker()
+        self.key_serializer = key_serializer
+        self.value_serializer = value_serializer
+        self.config = configs
+
+    def send(self, topic, value=None, key=None):
+        try:
+            if self.key_serializer is not None:
+                key = self.key_serializer(key)
+            if self.value_serializer is not None:
+                value = self.value_serializer(value)
+            return _SendFuture(value=self.broker.append(topic, key, value))
+        except Exception as exc:
+            return _SendFuture(exception=exc)
+
+    def flush(self, timeout=None):
+        pass
+
+    def close(self, timeout=None):
+        pass
@@ -0,0 +1,67 @@
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+from config.logconfig import get_logger
+from utils import heconstants
+
+logger = get_logger()
+
+# from a few ms for cheap stages up to the long Whisper/OpenAI calls
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+
+QUEUE_WAIT_SECONDS = Histogram("executor_queue_wait_seconds",
+                               "Time from publish until a worker starts the task",
+                               ["state"], buckets=LATENCY_BUCKETS)
+PROCESSING_SECONDS = Histogram("executor_processing_seconds",
+                               "Time a worker spends running the task handler",
+                               ["state"], buckets=LATENCY_BUCKETS)
+TASKS_TOTAL = Counter("executor_tasks_total", "Tasks by outcome (completed, retried, failed, skipped)",
+                      ["state", "outcome"])
+IN_FLIGHT = Gauge("executor_in_flight_tasks", "Tasks handed to the worker pool and not finished yet",
+                  ["group"])
+RETRIES_TOTAL = Counter("executor_retries_total", "Tasks scheduled for a delayed retry", ["state", "error"])
+DEAD_LETTERS_TOTAL = Counter("executor_dead_letters_total", "Tasks that ran out of retries", ["state", "error"])
+CONSUMER_LAG = Gauge("executor_consumer_lag", "Messages between the consumer position and the partition end",
+                     ["group", "topic", "partition"])
+
+# counters handlers bump themselves; a process-pool child sends its increments back to the parent,
+# whose registry is the one that is served
+HANDLER_COUNTERS = {"executor_retries": RETRIES_TOTAL, "executor_dead_letters": DEAD_LETTERS_TOTAL}
+
+_server_started = False
+
+
+def start_metrics_server(port=None):
+    global _server_started
+    port = int(port or heconstants.METRICS_PORT or 0)
+    if _server_started or not port:
+        return
+    try:
+        start_http_server(port)
+        _server_started = True
+        logger.info(f"Metrics served on :{port}/metrics")
+    except Exception as exc:
+        logger.error(f"Failed to start metrics server on {port} :: {exc}")
+
+
+def handler_counter_values() -> dict:
+    return {(name, tuple(sorted(sample.labels.items()))): sample.value
+            for name, counter in HANDLER_COUNTERS.items()
+            for metric in counter.collect()
+            for sample in metric.samples if sample.name.endswith("_total")}
+
+
+def handler_counter_increments(before: dict) -> list:
+    """What the handler counters gained since ``before``, as (name, labels, amount)."""
+    return [(name, labels, value - before.get((name, labels), 0))
+            for (name, labels), value in handler_counter_values().items()
+            if value > before.get((name, labels), 0)]
+
+
+def apply_counter_increments(increments: list):
+    for name, labels, amount in increments:
+        HANDLER_COUNTERS[name].labels(**dict(labels)).inc(amount)
+
+
+def record_lag(group_id, lag: dict):
+    for tp, value in lag.items():
+        CONSUMER_LAG.labels(group_id, tp.topic, str(tp.partition)).set(value)
@@ -0,0 +1,204 @@
+import heapq
+import itertools
+import random
+import signal
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+from datetime import datetime
+from typing import Optional
+
+from config.logconfig import get_logger
+from services.kafka.dispatcher import InFlightDispatcher, RedeliveryRequired
+from services.kafka.kafka_service import KafkaService, wait_for_delivery
+from services.kafka import metrics
+from services.kafka.task_message import current_task, decode_message
+from utils import heconstants
+
+logger = get_logger()
+
+
+class RetryPolicy:
+    def __init__(self, max_retries: int = heconstants.RETRY_MAX_ATTEMPTS,
+                 base_delay: float = heconstants.RETRY_BASE_DELAY_SECONDS,
+                 max_delay: float = heconstants.RETRY_MAX_DELAY_SECONDS,
+                 multiplier: float = 2.0, jitter: float = 0.5):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+
+    def delay(self, attempt: int) -> float:
+        # exponential backoff; the jittered share spreads out retries that failed together
+        backoff = min(self.max_delay, self.base_delay * (self.multiplier ** (attempt - 1)))
+        return backoff * (1 - self.jitter) + random.uniform(0, backoff * self.jitter)
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+# keyed by exception class name so that openai/requests don't have to be imported here
+ERROR_RETRY_POLICIES = {
+    "RateLimitError": RetryPolicy(max_retries=5, base_delay=10, max_delay=300),
+    "ServiceUnavailableError": RetryPolicy(max_retries=5, base_delay=5, max_delay=120),
+    "APIConnectionError": RetryPolicy(max_retries=5, base_delay=5, max_delay=120),
+    "Timeout": RetryPolicy(max_retries=4, base_delay=5, max_delay=120),
+    "ConnectionError": RetryPolicy(max_retries=4, base_delay=2, max_delay=60),
+    # bad input does not get better by asking again
+    "InvalidRequestError": RetryPolicy(max_retries=0),
+    "AuthenticationError": RetryPolicy(max_retries=0),
+}
+
+
+def policy_for(exc: Optional[BaseException]) -> RetryPolicy:
+    if exc is not None:
+        for cls in type(exc).__mro__:
+            if cls.__name__ in ERROR_RETRY_POLICIES:
+                return ERROR_RETRY_POLICIES[cls.__name__]
+    return DEFAULT_RETRY_POLICY
+
+
+class RetryScheduler:
+    """
+    Re-drives failed tasks through the delayed retry topic instead of straight back
+    to their stage topic. Tasks that exhausted their policy go to the dead-letter topic.
+
+    Both publishes wait for the broker's ack. When one fails, ``RedeliveryRequired`` leaves
+    the failed task's offset uncommitted, so it is read and run again instead of being lost.
+    """
+
+    def __init__(self, kafka_service: Optional[KafkaService] = None):
+        self.kafka_service = kafka_service or KafkaService()
+
+    def schedule(self, message: dict, exc: Optional[BaseException] = None) -> bool:
+        """Returns False once the task is out of retries and was dead-lettered."""
+        task = current_task.get()
+        if task is not None:
+            # the running task did not complete, the runtime must not mark it done
+            task.rescheduled = True
+        policy = policy_for(exc)
+        attempt = (message.get("retry_count") or 0) + 1
+        if attempt > policy.max_retries:
+            self.dead_letter(message, exc)
+            return False
+
+        metrics.RETRIES_TOTAL.labels(message.get("state"), type(exc).__name__ if exc else "unknown").inc()
+        delay = policy.delay(attempt)
+        retry = dict(message, retry_count=attempt, retry_at=time.time() + delay,
+                     last_error=repr(exc) if exc else None)
+        logger.info(f"Retrying {message.get('state')} for {message.get('request_id')} "
+                    f"in {delay:.1f}s (attempt {attempt}/{policy.max_retries})")
+        self._publish(heconstants.RETRY_TOPIC, retry)
+        return True
+
+    def dead_letter(self, message: dict, exc: Optional[BaseException] = None):
+        logger.error(f"Dead-lettering {message.get('state')} for {message.get('request_id')} :: {exc}")
+        metrics.DEAD_LETTERS_TOTAL.labels(message.get("state"), type(exc).__name__ if exc else "unknown").inc()
+        dead = dict(message, dead_lettered_at=str(datetime.utcnow()),
+                    error=repr(exc) if exc else None,
+                    error_type=type(exc).__name__ if exc else None)
+        dead.pop("retry_at", None)
+        self._publish(heconstants.DEAD_LETTER_TOPIC, dead)
+
+    def _publish(self, topic, message):
+        try:
+            wait_for_delivery(self.kafka_service.publish(topic, message))
+        except Exception as exc:
+            raise RedeliveryRequired(f"{message.get('state')} for {message.get('request_id')} "
+                                     f"could not be published to {topic} :: {exc}") from exc
+
+
+class DelayQueue:
+    """Single timer thread running callbacks at their due time, in due order."""
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="retry-timer", daemon=True)
+        self._thread.start()
+
+    def call_at(self, due: float, fn, *args) -> Future:
+        future = Future()
+        with self._condition:
+            heapq.heappush(self._heap, (due, next(self._counter), future, fn, args))
+            self._condition.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed and (not self._heap or self._heap[0][0] > time.time()):
+                    timeout = self._heap[0][0] - time.time() if self._heap else None
+                    self._condition.wait(timeout)
+                if self._closed:
+                    return
+                _, _, future, fn, args = heapq.heappop(self._heap)
+            try:
+                future.set_result(fn(*args))
+            except Exception as exc:
+                future.set_exception(exc)
+
+    def close(self):
+        # pending retries stay uncommitted on the retry topic and are re-read on restart
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+
+class RetryRelay:
+    """Holds messages from the retry topic until their ``retry_at`` and republishes them to their stage."""
+
+    def __init__(self, group_id: str = "retry", max_in_flight: int = 10000):
+        self.group_id = group_id
+        self.kafka_service = KafkaService(group_id=group_id, topics=[heconstants.RETRY_TOPIC])
+        self.dispatcher = InFlightDispatcher(self.kafka_service.post_consumer, max_in_flight=max_in_flight)
+        self.timer = DelayQueue()
+        self._running = False
+
+    def republish(self, message):
+        message.retry_at = None
+        wait_for_delivery(self.kafka_service.publish_executor_message(message))
+
+    def relay(self, message, relayed: Future, attempt: int = 1):
+        # the record is only done once its stage has the message, a failed publish is tried again later
+        try:
+            self.republish(message)
+            relayed.set_result(None)
+        except Exception as exc:
+            delay = DEFAULT_RETRY_POLICY.delay(attempt)
+            logger.error(f"Republishing {message.get('state')} for {message.get('request_id')} failed, "
+                         f"trying again in {delay:.1f}s :: {exc}")
+            self.timer.call_at(time.time() + delay, self.relay, message, relayed, attempt + 1)
+
+    def stop(self, *args):
+        self._running = False
+
+    def run(self):
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+        metrics.IN_FLIGHT.labels(self.group_id).set_function(lambda: self.dispatcher.in_flight)
+        metrics.start_metrics_server()
+        self._running = True
+        try:
+            while self._running:
+                for record in self.dispatcher.poll(timeout_ms=int(heconstants.CONSUMER_POLL_TIMEOUT)):
+                    future = None
+                    try:
+                        message = decode_message(record.value)
+                        future = Future()
+                        self.timer.call_at(message.retry_at or 0, self.relay, message, future)
+                    except Exception as exc:
+                        msg = "Failed to schedule retry :: {}".format(exc)
+                        trace = traceback.format_exc()
+                        logger.error(msg, trace)
+                    self.dispatcher.track(record, future)
+        finally:
+            self.timer.close()
+            self.dispatcher.commit()
+            self.kafka_service.post_consumer.close(autocommit=False)
+            self.kafka_service.flush()
@@ -0,0 +1,11 @@
+from collections import namedtuple
+
+try:
+    from kafka.structs import OffsetAndMetadata, TopicPartition
+except ImportError:
+    # same shapes as kafka-python, for running on the in-memory broker without it installed
+    TopicPartition = namedtuple("TopicPartition", ["topic", "partition"])
+    OffsetAndMetadata = namedtuple("OffsetAndMetadata", ["offset", "metadata"])
+
+ConsumerRecord = namedtuple("ConsumerRecord", ["topic", "partition", "offset", "timestamp", "key", "value"])
+RecordMetadata = namedtuple("RecordMetadata", ["topic", "partition", "offset", "timestamp"])
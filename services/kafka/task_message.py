@@ -0,0 +1,160 @@
+import contextvars
+import json
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Optional
+
+import msgpack
+
+from utils import heconstants
+
+SCHEMA_VERSION = 1
+
+# wire order of the msgpack encoding: only ever append fields, never reorder or remove them
+FIELDS = (
+    "es_id", "chunk_no", "file_path", "webhook_url", "api_path", "api_type", "req_type", "user_type",
+    "executor_name", "state", "retry_count", "uid", "request_id", "care_req_id", "encounter_id",
+    "provider_id", "review_provider_id", "language", "output_language", "completed", "exec_duration",
+    "start_time", "end_time", "failed_state", "retry_at", "last_error", "run_id",
+)
+
+STAGE_EXECUTORS = {
+    "Init": "FILE_DOWNLOADER",
+    "SpeechToText": "ASR_EXECUTOR",
+    "AiPred": "AI_PRED",
+    "Analytics": "SOAP_EXECUTOR",
+    "Final": "FINAL_EXECUTOR",
+}
+# es_id suffixes that differ from the executor name
+STAGE_ES_SUFFIXES = dict(STAGE_EXECUTORS, Analytics="SOAP")
+
+
+class TaskContext:
+    """
+    The task a handler is running: its run, whether the handler scheduled a retry of it, and
+    the sends of the messages it published, which must be delivered before it counts as done.
+    """
+
+    __slots__ = ("run_id", "rescheduled", "publishes")
+
+    def __init__(self, run_id: Optional[str]):
+        self.run_id = run_id
+        self.rescheduled = False
+        self.publishes = []
+
+
+current_task = contextvars.ContextVar("current_task", default=None)
+
+
+@contextmanager
+def running_task(message):
+    # messages published before run_id existed are told apart by their publish time
+    context = TaskContext(message.get("run_id") or message.get("end_time"))
+    token = current_task.set(context)
+    try:
+        yield context
+    finally:
+        current_task.reset(token)
+
+
+class TaskMessage:
+    """
+    Task handed from one executor stage to the next.
+
+    Known fields live in slots, anything else (``user_name``, ``force_summary`` ...)
+    is kept in ``extra`` so it survives the hop. Reads go through ``get`` like the
+    dicts this replaces; unset fields are None.
+
+    ``run_id`` names one run of a request: a task published while a handler runs carries
+    on the handler's run, any other publish (an API call, a websocket chunk) starts a new one.
+    """
+
+    __slots__ = FIELDS + ("extra",)
+
+    def __init__(self, state: Optional[str] = None, request_id: Optional[str] = None, start_time=None, **fields):
+        for name in FIELDS:
+            setattr(self, name, None)
+        self.extra = {}
+        self.state = state
+        self.request_id = request_id
+        self.care_req_id = request_id
+        if state in STAGE_EXECUTORS:
+            self.executor_name = STAGE_EXECUTORS[state]
+            self.es_id = f"{request_id}_{STAGE_ES_SUFFIXES[state]}"
+        end_time = datetime.utcnow()
+        self.completed = False
+        # time the publishing stage spent on the task, when it passes the start_time it was dispatched at
+        self.exec_duration = (end_time - start_time).total_seconds() if isinstance(start_time, datetime) else 0.0
+        self.start_time = str(start_time or end_time)
+        self.end_time = str(end_time)
+        context = current_task.get()
+        self.run_id = context.run_id if context is not None and context.run_id else uuid.uuid4().hex
+        for name, value in fields.items():
+            self[name] = value
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "TaskMessage":
+        message = cls.__new__(cls)
+        message.extra = {}
+        for name in FIELDS:
+            setattr(message, name, data.get(name))
+        for name, value in data.items():
+            if name not in FIELDS:
+                message.extra[name] = value
+        return message
+
+    def to_dict(self) -> dict:
+        data = {name: getattr(self, name) for name in FIELDS if getattr(self, name) is not None}
+        data.update(self.extra)
+        return data
+
+    def get(self, name, default=None):
+        value = getattr(self, name) if name in FIELDS else self.extra.get(name)
+        return default if value is None else value
+
+    def keys(self):
+        return self.to_dict().keys()
+
+    def __getitem__(self, name):
+        if name in FIELDS:
+            return getattr(self, name)
+        return self.extra[name]
+
+    def __setitem__(self, name, value):
+        if name in FIELDS:
+            setattr(self, name, value)
+        else:
+            self.extra[name] = value
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __repr__(self):
+        return f"TaskMessage({self.to_dict()!r})"
+
+
+def encode_message(data, codec: Optional[str] = None) -> bytes:
+    if isinstance(data, dict):
+        data = TaskMessage.from_dict(data)
+    if (codec or heconstants.MESSAGE_CODEC) == "json":
+        return json.dumps(data.to_dict()).encode('utf-8')
+    return msgpack.packb([SCHEMA_VERSION, [getattr(data, name) for name in FIELDS], data.extra],
+                         use_bin_type=True)
+
+
+def decode_message(value: bytes) -> Optional[TaskMessage]:
+    """Decodes both encodings so consumers keep reading JSON from publishers that are not upgraded yet."""
+    if not value:
+        return None
+    if value[:1] == b"{":
+        return TaskMessage.from_dict(json.loads(value.decode('utf-8')))
+    version, values, extra = msgpack.unpackb(value, raw=False)
+    message = TaskMessage.__new__(TaskMessage)
+    for name in FIELDS:
+        setattr(message, name, None)
+    # newer schema versions only append fields, so a shorter or longer list still lines up
+    for name, field_value in zip(FIELDS, values):
+        setattr(message, name, field_value)
+    message.extra = extra or {}
+    return message
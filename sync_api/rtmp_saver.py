@@ -1,30 +1,28 @@
-import fnmatch
 import io
 import logging
 import re
 import traceback
 from datetime import datetime
-from typing import Optional
 import av
 import time
 import json
 import torch
 import torchaudio
 import wave
-import boto3
-import requests
 from io import BytesIO
 from config.logconfig import get_logger
-from botocore.exceptions import NoCredentialsError
 from gevent import Timeout
 from utils import heconstants
+from utils.send_logs import push_logs, log_shipper
+from utils.s3_operation import S3SERVICE
+from utils.session_state import create_session_store
+from utils.transcription_batcher import transcription_batcher
+from utils.write_behind import WriteBehindBuffer
 
 logger = get_logger()
 logger.setLevel(logging.INFO)
 
 s16_resampler = av.AudioResampler(format="s16", rate="16000", layout="mono")
-s3_client = boto3.client('s3', aws_access_key_id=heconstants.AWS_ACCESS_KEY,
-                         aws_secret_access_key=heconstants.AWS_SECRET_ACCESS_KEY)
 
 # Load Silero VAD
 model, utils = torch.hub.load(repo_or_dir='snakers4/silero-vad', model='silero_vad', force_reload=False)
@@ -36,131 +34,10 @@ pattern = re.compile(
 word_pattern = re.compile(r'\b(?:Thank you|Bye|You)\.')
 
 
-class S3SERVICE:
-    def __init__(self):
-        self.default_bucket = heconstants.ASR_BUCKET
-
-    def upload_to_s3(self, s3_filename, data, bucket_name: Optional[str] = None, is_json: Optional[bool] = False):
-        try:
-            if bucket_name is None:
-                bucket_name = self.default_bucket
-            if is_json:
-                data = json.dumps(data).encode('utf-8')
-            s3_client.put_object(Bucket=bucket_name, Key=s3_filename, Body=data)
-            print(f"Upload Successful: {s3_filename}")
-        except FileNotFoundError:
-            print("The file was not found")
-        except NoCredentialsError:
-            print("Credentials not available")
-
-    def get_json_file(self, s3_filename, bucket_name: Optional[str] = None):
-        try:
-            if bucket_name is None:
-                bucket_name = self.default_bucket
-            s3_object = s3_client.get_object(Bucket=bucket_name, Key=s3_filename)
-            file_content = s3_object['Body'].read().decode('utf-8')
-            json_data = json.loads(file_content)
-            return json_data
-        except FileNotFoundError:
-            print("The file was not found")
-        except NoCredentialsError:
-            print("Credentials not available")
-
-    def get_audio_file(self, s3_filename, bucket_name: Optional[str] = None):
-        try:
-            if bucket_name is None:
-                bucket_name = self.default_bucket
-            s3_object = s3_client.get_object(Bucket=bucket_name, Key=s3_filename)
-            return s3_object
-        except FileNotFoundError:
-            print("The file was not found")
-        except NoCredentialsError:
-            print("Credentials not available")
-
-    def check_file_exists(self, key, bucket_name: Optional[str] = None):
-        try:
-            if bucket_name is None:
-                bucket_name = self.default_bucket
-            s3_client.head_object(Bucket=bucket_name, Key=key)
-            return True
-        except s3_client.exceptions.ClientError:
-            return False
-
-    def get_files_matching_pattern(self, pattern, bucket_name: Optional[str] = None):
-        json_data_list = []
-        try:
-            if bucket_name is None:
-                bucket_name = self.default_bucket
-            # Extract the prefix from the pattern (up to the first wildcard)
-            prefix = pattern.split('*')[0]
-
-            # Paginate through results if there are more files than the max returned in one call
-            paginator = s3_client.get_paginator('list_objects_v2')
-            for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
-                if 'Contents' in page:
-                    # Filter the objects whose keys match the pattern and read each JSON file
-                    for obj in page['Contents']:
-                        if fnmatch.fnmatch(obj['Key'], pattern):
-                            try:
-                                response = s3_client.get_object(Bucket=bucket_name, Key=obj['Key'])
-                                file_content = response['Body'].read().decode('utf-8')
-                                json_data = json.loads(file_content)
-                                json_data_list.append(json_data)
-                            except NoCredentialsError:
-                                print("Credentials not available for file:", obj['Key'])
-                            except s3_client.exceptions.ClientError as e:
-                                print(f"An error occurred with file {obj['Key']}: {e}")
-            json_data_list.sort(key=lambda x: x['chunk_no'])
-            return json_data_list
-        except Exception as exc:
-            self.logger.error(str(exc))
-            return []
-        except NoCredentialsError:
-            print("Credentials not available")
-        except s3_client.exceptions.ClientError as e:
-            print(f"An error occurred: {e}")
-            return []
-
-    def list_files_in_directory(self, directory, bucket_name: Optional[str] = None):
-        try:
-            if bucket_name is None:
-                bucket_name = self.default_bucket
-            response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=directory)
-            return [item['Key'] for item in response.get('Contents', [])]
-        except Exception as e:
-            print(f"Error listing files: {e}")
-
-    def download_from_s3(self, key, local_path, bucket_name: Optional[str] = None):
-        try:
-            if bucket_name is None:
-                bucket_name = self.default_bucket
-            s3_client.download_file(bucket_name, key, local_path)
-            print(f"Download Successful: {local_path}")
-        except Exception as e:
-            print(f"Error downloading file: {e}")
-
-
 s3 = S3SERVICE()
-
-
-def push_logs(care_request_id: str, given_msg: str, he_type: str, req_type: str, source_type: str):
-    try:
-        headers = {
-            'Content-Type': 'application/json'
-        }
-        websocket_data = {
-            "care_request_id": care_request_id,
-            "he_type": he_type,
-            "req_type": req_type,
-            "message": given_msg,
-            "source_type": source_type
-        }
-        response = requests.request("POST", heconstants.HEALIOM_SERVER + "/post_websocket_logs", headers=headers,
-                                    data=json.dumps(websocket_data))
-        logger.info(f"pushed logs :: {response}")
-    except Exception as e:
-        logger.info(f"Couldn't push the log to ES :: {e}")
-        pass
+sessions = create_session_store()
+# transcript.json is rewritten after every chunk, only the latest one per window is stored
+write_behind = WriteBehindBuffer(s3)
 
 
 def retry_with_backoff(function, max_attempts=3):
@@ -318,6 +195,7 @@ def save_rtmp_loop(
         stream_url=heconstants.RTMP_SERVER_URL,
         DATA_DIR="healiom_websocket_asr",
 ):
+    merged_WAV_F = None
     try:
         transcript = ""
         logger.info(f"WS quick loop received rtmp stream :: {websocket}")
@@ -337,12 +215,9 @@ def save_rtmp_loop(
             bytes_per_frame = 2  # Assuming 16-bit audio (2 bytes per frame)
 
             if 1 == 1:
-                # Initialize a buffer for merged audio
-                merged_audio_buffer = io.BytesIO()
-                merged_WAV_F = wave.open(merged_audio_buffer, "wb")
-                merged_WAV_F.setnchannels(1)
-                merged_WAV_F.setsampwidth(2)
-                merged_WAV_F.setframerate(16000)
+                # Stream the merged audio to S3 as it is recorded instead of holding the session in memory
+                merged_audio_key = f"{stream_key}/{stream_key}.wav"
+                merged_WAV_F = s3.open_wav_upload(merged_audio_key)
 
             while True:
                 chunk_start_time = time.time()
@@ -361,9 +236,7 @@ def save_rtmp_loop(
                         data = {"stream_key": stream_key,
                                 "last_processed_end_time": 0,
                                 "stage": "rtmp_saving_started"}
-                        s3_file = f"{stream_key}/{stream_key}.json"
-                        if not s3.check_file_exists(s3_file):
-                            s3.upload_to_s3(s3_file, data, is_json=True)
+                        sessions.update(stream_key, data, expected={"version": None})
                         logger.info(f"Writing chunks started :: {stream_key}")
                         started = True
 
@@ -387,14 +260,11 @@ def save_rtmp_loop(
                 key = f"{stream_key}/{stream_key}_chunk{chunk_count}.wav"
                 filename = key.split("/")[1]
                 unique_id = filename.split(".")[0] + "___" + language
-                wav_buffer.name = filename
-                wav_buffer.seek(0)  # Reset buffer pointer to the beginning
 
                 # logger.info(f"sending chunks for transcription :: {key}")
-                transcription_result = requests.post(
-                    heconstants.AI_SERVER + f"/infer?unique_id={unique_id}",
-                    files={"f1": wav_buffer},
-                ).json()["prediction"][0]
+                transcription_result = transcription_batcher.transcribe(wav_buffer.getvalue(), filename,
+                                                                        path="/infer", language=language,
+                                                                        unique_id=unique_id)
                 chunk_count += 1
                 segments = transcription_result.get("segments")
                 if segments:
@@ -424,7 +294,7 @@ def save_rtmp_loop(
                     websocket.send(json.dumps({"cc": transcript, "success": True}))
                     transcript_key = f"{stream_key}/transcript.json"
                     transcript_data = {"transcript": transcript}
-                    s3.upload_to_s3(transcript_key, transcript_data, is_json=True)
+                    write_behind.put(transcript_key, transcript_data)
                     # with Timeout(2, False):  # Set the timeout to 2 seconds
                     #     websocket.receive()
 
@@ -459,25 +329,24 @@ def save_rtmp_loop(
         else:
             logger.info("rtmp_iterator IS NONE")
 
-        if 1 == 1:
-            # Finalize merged audio and upload
+        if merged_WAV_F is not None:
+            # Finalize merged audio, completes the multipart upload
             merged_WAV_F.close()
-            merged_audio_buffer.seek(0)
-            merged_audio_key = f"{stream_key}/{stream_key}.wav"
-            s3.upload_to_s3(merged_audio_key, merged_audio_buffer.read())
 
+        write_behind.flush(f"{stream_key}/transcript.json")
         # esquery
         logger.info("Stopped writing chunks")
-        key = f"{stream_key}/{stream_key}.json"
-        data = s3.get_json_file(key)
-        if data:
-            data["stage"] = "rtmp_saving_done"
-            s3.upload_to_s3(key, data, is_json=True)
+        sessions.update(stream_key, {"stage": "rtmp_saving_done"}, create=False)
 
     except Exception as exc:
         msg = "Failed rtmp loop saver :: {}".format(exc)
         trace = traceback.format_exc()
         logger.error(msg, trace)
+        if merged_WAV_F is not None:
+            merged_WAV_F.abort()
+    finally:
+        # the saver process ends without running atexit handlers
+        log_shipper.flush()
 
 
 if __name__ == "__main__":
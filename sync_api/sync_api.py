@@ -8,16 +8,21 @@ import traceback
 import logging
 import requests
 from utils.s3_operation import S3SERVICE
+from utils.async_s3 import AsyncS3SERVICE
+from utils.chunk_manifest import ChunkManifest
 from typing import Optional
 from utils import heconstants
-from datetime import datetime
 from config.logconfig import get_logger
 from typing import Optional
 from services.kafka.kafka_service import KafkaService
+from services.kafka.task_message import TaskMessage
 
 logger = get_logger()
 logger.setLevel(logging.INFO)
 s3 = S3SERVICE()
+# storage calls run off the request greenlet, on the process-wide storage pool
+async_s3 = AsyncS3SERVICE(s3)
+manifest = ChunkManifest(s3)
 producer = KafkaService(group_id="sync")
 
 
@@ -67,8 +72,7 @@ def get_merge_ai_preds(conversation_id, only_transcribe: Optional[bool] = False)
         }
         response_json = {}
 
-        conversation_datas = s3.get_files_matching_pattern(
-            pattern=f"{conversation_id}/{conversation_id}_*json")
+        conversation_datas = async_s3.call(manifest.get_chunk_datas, conversation_id).result()
 
         if conversation_datas:
             audio_metas = []
@@ -84,22 +88,25 @@ def get_merge_ai_preds(conversation_id, only_transcribe: Optional[bool] = False)
 
                 response_json["segments"] = merged_segments
 
+            ai_preds_file_path = f"{conversation_id}/ai_preds.json"
+            summary_file = f"{conversation_id}/soap.json"
+            translated_file = f"{conversation_id}/translated_transcript.json"
+            keys = [translated_file] if only_transcribe else [ai_preds_file_path, summary_file, translated_file]
+            artifacts = async_s3.submit("get_jsons_if_exist", keys).result()
+
             if not only_transcribe:
-                ai_preds_file_path = f"{conversation_id}/ai_preds.json"
-                if s3.check_file_exists(ai_preds_file_path):
-                    merged_ai_preds = s3.get_json_file(ai_preds_file_path)
-                    summary_file = f"{conversation_id}/soap.json"
-                    if s3.check_file_exists(summary_file):
-                        summary_content = s3.get_json_file(s3_filename=summary_file)
-                        if summary_content:
-                            summary = {
-                                "summaries": {}
-                            }
-                            for summary_type in ["subjectiveClinicalSummary", "objectiveClinicalSummary",
-                                                 "clinicalAssessment", "carePlanSuggested", "chiefComplaints",
-                                                 "presentIllness", "pastMedicalHistory", "reviewOfSystems"]:
-                                summary["summaries"][summary_type] = summary_content.get(summary_type)
-                            merged_ai_preds.update(summary)
+                if artifacts[ai_preds_file_path] is not None:
+                    merged_ai_preds = artifacts[ai_preds_file_path]
+                    summary_content = artifacts[summary_file]
+                    if summary_content:
+                        summary = {
+                            "summaries": {}
+                        }
+                        for summary_type in ["subjectiveClinicalSummary", "objectiveClinicalSummary",
+                                             "clinicalAssessment", "carePlanSuggested", "chiefComplaints",
+                                             "presentIllness", "pastMedicalHistory", "reviewOfSystems"]:
+                            summary["summaries"][summary_type] = summary_content.get(summary_type)
+                        merged_ai_preds.update(summary)
                     response_json["ai_preds"] = merged_ai_preds
 
             response_json["meta"] = audio_metas
@@ -120,11 +127,9 @@ def get_merge_ai_preds(conversation_id, only_transcribe: Optional[bool] = False)
             #     if punc_transcript:
             #         response_json["transcript"] = punc_transcript
 
-            if s3.check_file_exists(key=f"{conversation_id}/translated_transcript.json"):
-                translated_transcript_content = s3.get_json_file(
-                    s3_filename=f"{conversation_id}/translated_transcript.json")
-                if translated_transcript_content:
-                    response_json["translated_transcript"] = translated_transcript_content.get("transcript")
+            translated_transcript_content = artifacts[translated_file]
+            if translated_transcript_content:
+                response_json["translated_transcript"] = translated_transcript_content.get("transcript")
 
             return response_json
 
@@ -138,39 +143,23 @@ def get_merge_ai_preds(conversation_id, only_transcribe: Optional[bool] = False)
 
 
 def create_task(request_id, webhook_url, audio_url, language, output_language, api_type, clinical_ner_flag):
-    es_id = f"{request_id}_FILE_DOWNLOADER"
-    executor_name = "FILE_DOWNLOADER"
-    state = "Init"
-
-    data = {
-        "es_id": es_id,
-        "webhook_url": webhook_url,
-        "file_path": audio_url,
-        "api_path": f"/{api_type}" if not clinical_ner_flag else f"/{api_type}[clinical_ner]",
-        "api_type": api_type,
-        "req_type": "platform",
-        "user_type": "Provider",
-        "executor_name": executor_name,
-        "state": state,
-        "retry_count": 0,
-        "uid": None,
-        "request_id": request_id,
-        "care_req_id": request_id,
-        "encounter_id": None,
-        "provider_id": None,
-        "review_provider_id": None,
-        "language": language,
-        "output_language": output_language,
-        "completed": False,
-        "exec_duration": 0.0,
-        "start_time": str(datetime.utcnow()),
-        "end_time": str(datetime.utcnow()),
-    }
+    data = TaskMessage(
+        state="Init",
+        request_id=request_id,
+        webhook_url=webhook_url,
+        file_path=audio_url,
+        api_path=f"/{api_type}" if not clinical_ner_flag else f"/{api_type}[clinical_ner]",
+        api_type=api_type,
+        req_type="platform",
+        user_type="Provider",
+        language=language,
+        output_language=output_language,
+    )
     producer.publish_executor_message(data)
     response_json = {"request_id": request_id,
                      "status": "Inprogress"}
     merged_json_key = f"{request_id}/All_Preds.json"
-    s3.upload_to_s3(merged_json_key, response_json, is_json=True)
+    async_s3.submit("upload_to_s3", merged_json_key, response_json, is_json=True).result()
     return {
         "success": True,
         "request_id": request_id
@@ -188,36 +177,26 @@ def create_aipred_task(request_id, webhook_url, text, language, output_language,
         state = "AiPred"
     file_key = f"{request_id}/{request_id}_input.json"
     transcript = {"transcript": text, "language": language}
-    s3.upload_to_s3(s3_filename=file_key, data=transcript, is_json=True)
-    data = {
-        "es_id": es_id,
-        "webhook_url": webhook_url,
-        "file_path": file_key,
-        "api_path": f"/{api_type}" if not clinical_ner_flag else f"/{api_type}[clinical_ner]",
-        "api_type": api_type,
-        "req_type": "platform",
-        "user_type": "Provider",
-        "executor_name": executor_name,
-        "state": state,
-        "retry_count": 0,
-        "uid": None,
-        "request_id": request_id,
-        "care_req_id": request_id,
-        "encounter_id": None,
-        "provider_id": None,
-        "review_provider_id": None,
-        "language": language,
-        "output_language": output_language,
-        "completed": False,
-        "exec_duration": 0.0,
-        "start_time": str(datetime.utcnow()),
-        "end_time": str(datetime.utcnow()),
-    }
+    async_s3.submit("upload_to_s3", s3_filename=file_key, data=transcript, is_json=True).result()
+    data = TaskMessage(
+        state=state,
+        request_id=request_id,
+        es_id=es_id,
+        executor_name=executor_name,
+        webhook_url=webhook_url,
+        file_path=file_key,
+        api_path=f"/{api_type}" if not clinical_ner_flag else f"/{api_type}[clinical_ner]",
+        api_type=api_type,
+        req_type="platform",
+        user_type="Provider",
+        language=language,
+        output_language=output_language,
+    )
     producer.publish_executor_message(data)
     response_json = {"request_id": request_id,
                      "status": "Inprogress"}
     merged_json_key = f"{request_id}/All_Preds.json"
-    s3.upload_to_s3(merged_json_key, response_json, is_json=True)
+    async_s3.submit("upload_to_s3", merged_json_key, response_json, is_json=True).result()
     return {
         "success": True,
         "request_id": request_id
@@ -230,7 +209,7 @@ class History(object):
         only_transcribe = req.params.get("only_transcribe")
         uid = req.params.get("uid")
         if uid:
-            resp.media = s3.get_dirs_matching_pattern(pattern=f"copilot__{uid}*")
+            resp.media = async_s3.submit("get_dirs_matching_pattern", pattern=f"copilot__{uid}*").result()
         else:
             if not conversation_id:
                 self.logger.error("Bad Request with missing conversation_id")
@@ -269,21 +248,20 @@ class clinicalNotes(object):
             while True:
                 file_path = f"{request_id}/All_Preds.json"
                 resp.set_header('Request-ID', request_id)
-                if s3.check_file_exists(file_path):
-                    merged_ai_preds = s3.get_json_file(file_path)
-                    if merged_ai_preds:
-                        status = merged_ai_preds.get("status")
-                        if status:
-                            if status == "Completed":
-                                success = merged_ai_preds.get("success")
-                                del merged_ai_preds['status']
-                                del merged_ai_preds['success']
-                                del merged_ai_preds['request_id']
-                                resp.media = {"request_id": request_id,
-                                              "status": status,
-                                              "results": merged_ai_preds,
-                                              "success": success}
-                                break
+                merged_ai_preds = async_s3.submit("get_json_if_exists", file_path).result()
+                if merged_ai_preds:
+                    status = merged_ai_preds.get("status")
+                    if status:
+                        if status == "Completed":
+                            success = merged_ai_preds.get("success")
+                            del merged_ai_preds['status']
+                            del merged_ai_preds['success']
+                            del merged_ai_preds['request_id']
+                            resp.media = {"request_id": request_id,
+                                          "status": status,
+                                          "results": merged_ai_preds,
+                                          "success": success}
+                            break
 
 
 class Transcription(object):
@@ -315,21 +293,20 @@ class Transcription(object):
             while True:
                 file_path = f"{request_id}/All_Preds.json"
                 resp.set_header('Request-ID', request_id)
-                if s3.check_file_exists(file_path):
-                    merged_ai_preds = s3.get_json_file(file_path)
-                    if merged_ai_preds:
-                        status = merged_ai_preds.get("status")
-                        if status:
-                            if status == "Completed":
-                                success = merged_ai_preds.get("success")
-                                del merged_ai_preds['status']
-                                del merged_ai_preds['success']
-                                del merged_ai_preds['request_id']
-                                resp.media = {"request_id": request_id,
-                                              "status": status,
-                                              "results": merged_ai_preds,
-                                              "success": success}
-                                break
+                merged_ai_preds = async_s3.submit("get_json_if_exists", file_path).result()
+                if merged_ai_preds:
+                    status = merged_ai_preds.get("status")
+                    if status:
+                        if status == "Completed":
+                            success = merged_ai_preds.get("success")
+                            del merged_ai_preds['status']
+                            del merged_ai_preds['success']
+                            del merged_ai_preds['request_id']
+                            resp.media = {"request_id": request_id,
+                                          "status": status,
+                                          "results": merged_ai_preds,
+                                          "success": success}
+                            break
 
 
 class AiPred(object):
@@ -363,21 +340,20 @@ class AiPred(object):
             while True:
                 file_path = f"{request_id}/All_Preds.json"
                 resp.set_header('Request-ID', request_id)
-                if s3.check_file_exists(file_path):
-                    merged_ai_preds = s3.get_json_file(file_path)
-                    if merged_ai_preds:
-                        status = merged_ai_preds.get("status")
-                        if status:
-                            if status == "Completed":
-                                success = merged_ai_preds.get("success")
-                                del merged_ai_preds['status']
-                                del merged_ai_preds['success']
-                                del merged_ai_preds['request_id']
-                                resp.media = {"request_id": request_id,
-                                              "status": status,
-                                              "results": merged_ai_preds,
-                                              "success": success}
-                                break
+                merged_ai_preds = async_s3.submit("get_json_if_exists", file_path).result()
+                if merged_ai_preds:
+                    status = merged_ai_preds.get("status")
+                    if status:
+                        if status == "Completed":
+                            success = merged_ai_preds.get("success")
+                            del merged_ai_preds['status']
+                            del merged_ai_preds['success']
+                            del merged_ai_preds['request_id']
+                            resp.media = {"request_id": request_id,
+                                          "status": status,
+                                          "results": merged_ai_preds,
+                                          "success": success}
+                            break
 
 
 class Summary(object):
@@ -411,21 +387,20 @@ class Summary(object):
             while True:
                 file_path = f"{request_id}/All_Preds.json"
                 resp.set_header('Request-ID', request_id)
-                if s3.check_file_exists(file_path):
-                    merged_ai_preds = s3.get_json_file(file_path)
-                    if merged_ai_preds:
-                        status = merged_ai_preds.get("status")
-                        if status:
-                            if status == "Completed":
-                                success = merged_ai_preds.get("success")
-                                del merged_ai_preds['status']
-                                del merged_ai_preds['success']
-                                del merged_ai_preds['request_id']
-                                resp.media = {"request_id": request_id,
-                                              "status": status,
-                                              "results": merged_ai_preds,
-                                              "success": success}
-                                break
+                merged_ai_preds = async_s3.submit("get_json_if_exists", file_path).result()
+                if merged_ai_preds:
+                    status = merged_ai_preds.get("status")
+                    if status:
+                        if status == "Completed":
+                            success = merged_ai_preds.get("success")
+                            del merged_ai_preds['status']
+                            del merged_ai_preds['success']
+                            del merged_ai_preds['request_id']
+                            resp.media = {"request_id": request_id,
+                                          "status": status,
+                                          "results": merged_ai_preds,
+                                          "success": success}
+                            break
 
 
 class Status(object):
@@ -433,33 +408,32 @@ class Status(object):
         request_id = req.params.get("request_id")
         file_path = f"{request_id}/All_Preds.json"
         resp.set_header('Request-ID', request_id)
-        if s3.check_file_exists(file_path):
-            merged_ai_preds = s3.get_json_file(file_path)
-            if merged_ai_preds:
-                status = merged_ai_preds.get("status")
-                if status:
-                    if status == "Completed":
-                        success = merged_ai_preds.get("success")
-                        del merged_ai_preds['status']
-                        del merged_ai_preds['success']
-                        del merged_ai_preds['request_id']
-                        resp.media = {"request_id": request_id,
-                                      "status": status,
-                                      "results": merged_ai_preds,
-                                      "success": success}
-                    elif status == "Inprogress":
-                        resp.media = {
-                            "request_id": request_id,
-                            "status": status
-                        }
-                    else:
-                        resp.media = {"success": False,
-                                      "request_id": request_id,
-                                      "issue": [{
-                                          "error-code": "HE-101",
-                                          "message": "Failed to process the request."
-                                      }]
-                                      }
+        merged_ai_preds = async_s3.submit("get_json_if_exists", file_path).result()
+        if merged_ai_preds:
+            status = merged_ai_preds.get("status")
+            if status:
+                if status == "Completed":
+                    success = merged_ai_preds.get("success")
+                    del merged_ai_preds['status']
+                    del merged_ai_preds['success']
+                    del merged_ai_preds['request_id']
+                    resp.media = {"request_id": request_id,
+                                  "status": status,
+                                  "results": merged_ai_preds,
+                                  "success": success}
+                elif status == "Inprogress":
+                    resp.media = {
+                        "request_id": request_id,
+                        "status": status
+                    }
+                else:
+                    resp.media = {"success": False,
+                                  "request_id": request_id,
+                                  "issue": [{
+                                      "error-code": "HE-101",
+                                      "message": "Failed to process the request."
+                                  }]
+                                  }
         else:
             resp.media = {"success": False,
                           "request_id": request_id,
@@ -11,79 +11,53 @@ import uuid
 import wave
 import requests
 import traceback
+from functools import partial
 from gevent.pywsgi import WSGIServer
 from gevent import Timeout
 from _ws import WebSocketHandler
 import logging
 import rtmp_saver
 from utils import heconstants
+from utils.send_logs import push_logs
 from config.logconfig import get_logger
 from utils.s3_operation import S3SERVICE
+from utils.async_s3 import AsyncS3SERVICE
+from utils.session_state import SessionWatch, create_session_store
+from utils.transcription_batcher import transcription_batcher
 from services.kafka.kafka_service import KafkaService
-from datetime import datetime
+from services.kafka.task_message import TaskMessage
 from io import BytesIO
 from pydub import AudioSegment
 
 s3 = S3SERVICE()
+async_s3 = AsyncS3SERVICE(s3)
+sessions = create_session_store()
 producer = KafkaService(group_id="soap")
 logger = get_logger()
 logger.setLevel(logging.INFO)
 
 
-def push_logs(care_request_id: str, given_msg: str, he_type: str, req_type: str, source_type: str):
-    try:
-        headers = {
-            'Content-Type': 'application/json'
-        }
-        websocket_data = {
-            "care_request_id": care_request_id,
-            "he_type": he_type,
-            "req_type": req_type,
-            "message": given_msg,
-            "source_type": source_type
-        }
-        response = requests.request("POST", heconstants.HEALIOM_SERVER + "/post_websocket_logs", headers=headers,
-                                    data=json.dumps(websocket_data))
-
-    except:
-        pass
-
-
 # check if PID is running python
 def check_and_start_rtmp(connection_id, language="en", output_language="en"):
-    key = f"{connection_id}/{connection_id}.json"
-    IS_FILE_EXIST = s3.check_file_exists(key)
-    if IS_FILE_EXIST:
-        current_stream_key_info = s3.get_json_file(f"{connection_id}/{connection_id}.json")
+    current_stream_key_info = sessions.get(connection_id)
+    if current_stream_key_info is not None:
         if current_stream_key_info:
             state = current_stream_key_info.get("state")
             if state == "rtmp_saving_started":
                 logger.info("Already running")
                 return True
     else:
-        data = {
-            "es_id": f"{connection_id}_FILE_DOWNLOADER",
-            "file_path": None,
-            "api_path": "clinical_notes",
-            "api_type": "clinical_notes",
-            "req_type": "encounter",
-            "user_type": "Provider",
-            "executor_name": "FILE_DOWNLOADER",
-            "state": "Init",
-            "retry_count": 0,
-            "uid": None,
-            "request_id": connection_id,
-            "care_req_id": connection_id,
-            "encounter_id": None,
-            "provider_id": None,
-            "review_provider_id": None,
-            "language": language,
-            "output_language": output_language,
-            "completed": False,
-            "exec_duration": 0.0,
-            "start_time": str(datetime.utcnow()),
-            "end_time": str(datetime.utcnow()),
-        }
+        data = TaskMessage(
+            state="Init",
+            request_id=connection_id,
+            file_path=None,
+            api_path="clinical_notes",
+            api_type="clinical_notes",
+            req_type="encounter",
+            user_type="Provider",
+            language=language,
+            output_language=output_language,
+        )
         producer.publish_executor_message(data)
         return False
 
@@ -95,8 +69,7 @@ def check_and_start_rtmp_for_connection_id(connection_id, user_type, ws, languag
     try:
         # esquery
         logger.info("searching pid")
-        key = f"{connection_id}/{connection_id}.json"
-        data = s3.get_json_file(key)
+        data = sessions.get(connection_id)
         pid_for_connection_id = data.get("pid")
     except:
         pass
@@ -124,8 +97,7 @@ def check_and_start_rtmp_for_connection_id(connection_id, user_type, ws, languag
             args=(connection_id, user_type, ws, language),
         )
         if data:
-            data["pid"] = process.pid
-            s3.upload_to_s3(key, data, is_json=True)
+            sessions.update(connection_id, {"pid": process.pid})
 
         return False
 
@@ -196,9 +168,8 @@ def websocket_handler(env, start_response):
             data = {"stream_key": connection_id,
                     "last_processed_end_time": 0,
                     "stage": "rtmp_saving_started"}
-            s3_file = f"{connection_id}/{connection_id}.json"
-            if not s3.check_file_exists(s3_file):
-                s3.upload_to_s3(s3_file, data, is_json=True)
+            # only the first connection of the session creates it
+            sessions.update(connection_id, data, expected={"version": None})
             logger.info(f"Writing chunks started :: {connection_id}")
 
         logger.info(f"SENDING EMPTY AI PREDS TO WS :: {ws}")
@@ -225,12 +196,15 @@ def websocket_handler(env, start_response):
         # for healiom copilot
         chunk_iteration = 0
         chunk_count = 0
+        # upload + publish of the last chunk, the next one is queued behind it to keep chunk order
+        chunk_upload = None
         combine_wav = AudioSegment.silent(duration=0)
         recording_status = True
+        # re-read on change notifications (or every few seconds from s3), not on every iteration
+        session_watch = SessionWatch(sessions, connection_id)
         while True:
             try:
-                key = f"{connection_id}/{connection_id}.json"
-                current_stream_key_info = s3.get_json_file(key)
+                current_stream_key_info = session_watch.state
                 if user_type not in {"provider", "inclinic"}:
                     transcript_key = f"{connection_id}/transcript.json"
                     transcript = s3.get_json_file(transcript_key)
@@ -258,14 +232,12 @@ def websocket_handler(env, start_response):
                         audio.export(wav_buffer, format="wav",
                                      parameters=["-ac", "1", "-ar", "16000", "-sample_fmt", "s16"])
                         unique_id = f"{uuid.uuid4()}___{language}"
-                        wav_buffer.name = unique_id + ".wav"
-                        wav_buffer.seek(0)
                         try:
-                            # Send the wav audio data for transcription
-                            transcription_result = requests.post(
-                                heconstants.AI_SERVER + f"/infer?unique_id={unique_id}",
-                                files={"f1": wav_buffer},
-                            ).json()["prediction"][0]
+                            # Send the wav audio data for transcription, batched with other connections
+                            transcription_result = transcription_batcher.transcribe(
+                                wav_buffer.getvalue(), unique_id + ".wav", path="/infer", language=language,
+                                unique_id=unique_id
+                            )
 
                             segments = transcription_result.get("segments")
                             if segments:
@@ -304,33 +276,22 @@ def websocket_handler(env, start_response):
                                                parameters=["-ac", "1", "-ar", "16000", "-sample_fmt",
                                                            "s16"])
                             chunk_audio_key = f"{connection_id}/{connection_id}_chunk{chunk_count}.wav"
-                            s3.upload_to_s3(chunk_audio_key, combine_wav_buffer.read())
                             combine_wav = AudioSegment.silent(duration=0)
                             chunk_iteration = 0
-                            data = {
-                                "es_id": f"{connection_id}_ASR_EXECUTOR",
-                                "chunk_no": chunk_count,
-                                "file_path": chunk_audio_key,
-                                "api_path": "clinical_notes",
-                                "api_type": "clinical_notes",
-                                "req_type": "encounter",
-                                "executor_name": "ASR_EXECUTOR",
-                                "state": "SpeechToText",
-                                "retry_count": 0,
-                                "uid": None,
-                                "request_id": connection_id,
-                                "care_req_id": connection_id,
-                                "encounter_id": None,
-                                "provider_id": None,
-                                "review_provider_id": None,
-                                "language": language,
-                                "output_language": output_language,
-                                "completed": False,
-                                "exec_duration": 0.0,
-                                "start_time": str(datetime.utcnow()),
-                                "end_time": str(datetime.utcnow()),
-                            }
-                            producer.publish_executor_message(data)
+                            data = TaskMessage(
+                                state="SpeechToText",
+                                request_id=connection_id,
+                                chunk_no=chunk_count,
+                                file_path=chunk_audio_key,
+                                api_path="clinical_notes",
+                                api_type="clinical_notes",
+                                req_type="encounter",
+                                language=language,
+                                output_language=output_language,
+                            )
+                            chunk_upload = async_s3.upload_then(chunk_audio_key, combine_wav_buffer.read(),
+                                                                then=partial(producer.publish_executor_message, data),
+                                                                previous=chunk_upload)
                     else:
                         # Handle non-binary messages (optional)
                         if ws_message:
@@ -345,33 +306,22 @@ def websocket_handler(env, start_response):
                                                    parameters=["-ac", "1", "-ar", "16000", "-sample_fmt",
                                                                "s16"])
                                 chunk_audio_key = f"{connection_id}/{connection_id}_chunk{chunk_count}.wav"
-                                s3.upload_to_s3(chunk_audio_key, combine_wav_buffer.read())
                                 combine_wav = AudioSegment.silent(duration=0)
                                 chunk_iteration = 0
-                                data = {
-                                    "es_id": f"{connection_id}_ASR_EXECUTOR",
-                                    "chunk_no": chunk_count,
-                                    "file_path": chunk_audio_key,
-                                    "api_path": "clinical_notes",
-                                    "api_type": "clinical_notes",
-                                    "req_type": "encounter",
-                                    "executor_name": "ASR_EXECUTOR",
-                                    "state": "SpeechToText",
-                                    "retry_count": 0,
-                                    "uid": None,
-                                    "request_id": connection_id,
-                                    "care_req_id": connection_id,
-                                    "encounter_id": None,
-                                    "provider_id": None,
-                                    "review_provider_id": None,
-                                    "language": language,
-                                    "output_language": output_language,
-                                    "completed": False,
-                                    "exec_duration": 0.0,
-                                    "start_time": str(datetime.utcnow()),
-                                    "end_time": str(datetime.utcnow()),
-                                }
-                                producer.publish_executor_message(data)
+                                data = TaskMessage(
+                                    state="SpeechToText",
+                                    request_id=connection_id,
+                                    chunk_no=chunk_count,
+                                    file_path=chunk_audio_key,
+                                    api_path="clinical_notes",
+                                    api_type="clinical_notes",
+                                    req_type="encounter",
+                                    language=language,
+                                    output_language=output_language,
+                                )
+                                chunk_upload = async_s3.upload_then(chunk_audio_key, combine_wav_buffer.read(),
+                                                                    then=partial(producer.publish_executor_message, data),
+                                                                    previous=chunk_upload)
                                 logger.info("Merged final chunks")
             except:
                 time.sleep(2)
@@ -400,8 +350,7 @@ def websocket_handler(env, start_response):
                     is_rtmp_done = True
                 if is_rtmp_done:
                     logger.info(f"current_stage: {current_stage}, is_rtmp_done: {is_rtmp_done}")
-                    current_stream_key_info["stage"] = "finished"
-                    s3.upload_to_s3(s3_filename=key, data=current_stream_key_info, is_json=True)
+                    sessions.update(connection_id, {"stage": "finished"})
                     logger.info(f"finished AI rtmp: {connection_id}")
                     push_logs(care_request_id=connection_id,
                               given_msg=f"finished AI rtmp: {connection_id}",
@@ -447,6 +396,7 @@ def websocket_handler(env, start_response):
                                     latest_ai_preds_resp['transcript'] = long_transcript
                                 ws.send(json.dumps(latest_ai_preds_resp))
                                 merged_json_key = f"{connection_id}/All_Preds.json"
+                                # written through: the final stage writes its status to the same key
                                 s3.upload_to_s3(merged_json_key, latest_ai_preds_resp, is_json=True)
                                 # with Timeout(2, False):  # Set the timeout to 2 seconds
                                 #     message = ws.receive()
@@ -488,6 +438,8 @@ def websocket_handler(env, start_response):
                 ws.send(json.dumps({"success": False, "issue": "time-exceeded", "message": msg}))
                 ws.close()
 
+        session_watch.close()
+
 
 if __name__ == "__main__":
     # logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
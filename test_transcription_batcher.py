@@ -0,0 +1,186 @@
+import io
+import threading
+import time
+import uuid
+from unittest import mock
+
+import pytest
+import requests
+
+from utils import heconstants
+from utils.transcription_batcher import TranscriptionBatcher
+
+AUDIO = b"RIFF\x24\x00\x00\x00WAVEfmt " + bytes(28)
+PREDICTION = {"segments": [{"text": "hello"}]}
+
+
+def post_through(batcher, **kwargs):
+    response = mock.Mock()
+    response.json.return_value = {"prediction": [PREDICTION]}
+    with mock.patch("utils.transcription_batcher.requests.post", return_value=response) as post:
+        assert batcher.transcribe(AUDIO, **kwargs) == PREDICTION
+    post.assert_called_once()
+    return post.call_args
+
+
+def prepared(url, files):
+    with mock.patch("urllib3.filepost.choose_boundary", return_value="boundary"):
+        return requests.Request("POST", url, files=files).prepare()
+
+
+def assert_same_request(call, url, wav_buffer):
+    # what the callers posted before batching: the whole buffer as f1, named after its .name
+    wav_buffer.seek(0)
+    before = prepared(url, {"f1": wav_buffer})
+    after = prepared(*call.args, **call.kwargs)
+    assert call.args == (url,)
+    assert set(call.kwargs) == {"files"}
+    assert (after.url, after.body, after.headers) == (before.url, before.body, before.headers)
+
+
+def named_buffer(name):
+    wav_buffer = io.BytesIO(AUDIO)
+    wav_buffer.name = name
+    return wav_buffer
+
+
+def test_batch_of_one_is_the_rtmp_saver_request():
+    filename = "stream_chunk3.wav"
+    unique_id = filename.split(".")[0] + "___" + "en"
+    call = post_through(TranscriptionBatcher(max_batch_size=1), filename=filename, path="/infer",
+                        language="en", unique_id=unique_id)
+    assert_same_request(call, heconstants.AI_SERVER + f"/infer?unique_id={unique_id}", named_buffer(filename))
+
+
+def test_batch_of_one_is_the_websocket_request():
+    unique_id = f"{uuid.uuid4()}___en"
+    call = post_through(TranscriptionBatcher(max_batch_size=1), filename=unique_id + ".wav", path="/infer",
+                        language="en", unique_id=unique_id)
+    assert_same_request(call, heconstants.AI_SERVER + f"/infer?unique_id={unique_id}",
+                        named_buffer(unique_id + ".wav"))
+
+
+def test_batch_of_one_is_the_asr_executor_request():
+    filename = "request_chunk1.wav"
+    unique_id = filename.split(".")[0] + "___" + "en"
+    call = post_through(TranscriptionBatcher(max_batch_size=1), filename=filename, language="en",
+                        unique_id=unique_id)
+    assert_same_request(call, heconstants.AI_SERVER + f"/transcribe/infer?unique_id={unique_id}",
+                        named_buffer(filename))
+
+
+def test_batch_of_one_is_the_grpc_request():
+    call = post_through(TranscriptionBatcher(max_batch_size=1), filename="stream_chunk1.wav")
+    assert_same_request(call, heconstants.AI_SERVER + "/transcribe/infer", named_buffer("stream_chunk1.wav"))
+
+
+class FakeServer:
+    """Stands in for requests.post: records each batch and holds the first one until ``release``."""
+
+    def __init__(self, short_by=0):
+        self.short_by = short_by
+        self.calls = []
+        self.first_sent = threading.Event()
+        self.gate = threading.Event()
+        self.lock = threading.Lock()
+
+    def post(self, url, files, **kwargs):
+        with self.lock:
+            self.calls.append((url, [(field, name) for field, (name, _) in files.items()]))
+            first = len(self.calls) == 1
+        if first:
+            self.first_sent.set()
+            assert self.gate.wait(5)
+        names = [name for name, _ in files.values()]
+        if len(names) > 1:
+            names = names[:len(names) - self.short_by]
+        response = mock.Mock()
+        response.json.return_value = {"prediction": [{"text": name} for name in names]}
+        return response
+
+    def release(self):
+        self.gate.set()
+
+
+def busy_batcher(server, **kwargs):
+    # the first clip goes out alone and stays in flight, so the next clips have to batch up behind it
+    batcher = TranscriptionBatcher(max_in_flight=1, **kwargs)
+    first = batcher.submit(AUDIO, "c0.wav", language="en", unique_id="c0___en")
+    assert server.first_sent.wait(5)
+    return batcher, first
+
+
+def dispatched(batcher, batches):
+    # batches are cut while the first one is still in flight; the server only sees them once it returns
+    deadline = time.time() + 5
+    while batcher.stats()["batches"] < batches or batcher.stats()["pending"]:
+        assert time.time() < deadline
+        time.sleep(0.01)
+    return True
+
+
+def test_full_batch_is_one_request_fanned_out_in_order():
+    server = FakeServer()
+    with mock.patch("utils.transcription_batcher.requests.post", side_effect=server.post):
+        batcher, first = busy_batcher(server, max_batch_size=4, max_wait=60)
+        futures = [batcher.submit(AUDIO, f"c{i}.wav", language="en", unique_id=f"c{i}___en") for i in range(1, 5)]
+        assert dispatched(batcher, 2)
+        server.release()
+        results = [future.result(5) for future in futures]
+        assert first.result(5) == {"text": "c0.wav"}
+
+    assert results == [{"text": f"c{i}.wav"} for i in range(1, 5)]
+    assert server.calls[0] == (heconstants.AI_SERVER + "/transcribe/infer?unique_id=c0___en", [("f1", "c0.wav")])
+    url, files = server.calls[1]
+    # a batch has a unique_id of its own that still carries the language
+    assert url.startswith(heconstants.AI_SERVER + "/transcribe/infer?unique_id=") and url.endswith("___en")
+    assert "c1___en" not in url
+    assert files == [("f1", "c1.wav"), ("f2", "c2.wav"), ("f3", "c3.wav"), ("f4", "c4.wav")]
+    assert batcher.stats() == {"batches": 2, "clips": 5, "in_flight": 0, "pending": 0}
+
+
+def test_partial_batch_is_sent_after_max_wait():
+    server = FakeServer()
+    with mock.patch("utils.transcription_batcher.requests.post", side_effect=server.post):
+        batcher, first = busy_batcher(server, max_batch_size=8, max_wait=0.05)
+        futures = [batcher.submit(AUDIO, f"c{i}.wav", language="en") for i in (1, 2)]
+        assert dispatched(batcher, 2)
+        server.release()
+        assert [future.result(5) for future in futures] == [{"text": "c1.wav"}, {"text": "c2.wav"}]
+        first.result(5)
+
+    assert server.calls[1][1] == [("f1", "c1.wav"), ("f2", "c2.wav")]
+
+
+def test_clips_of_other_languages_are_not_batched_together():
+    server = FakeServer()
+    with mock.patch("utils.transcription_batcher.requests.post", side_effect=server.post):
+        batcher, first = busy_batcher(server, max_batch_size=2, max_wait=60)
+        futures = [batcher.submit(AUDIO, name, language=language)
+                   for name, language in (("en1.wav", "en"), ("es1.wav", "es"), ("en2.wav", "en"), ("es2.wav", "es"))]
+        assert dispatched(batcher, 3)
+        server.release()
+        assert [future.result(5) for future in futures] == [{"text": name} for name in
+                                                            ("en1.wav", "es1.wav", "en2.wav", "es2.wav")]
+        first.result(5)
+
+    batches = sorted((url.rsplit("___", 1)[1], files) for url, files in server.calls[1:])
+    assert batches == [("en", [("f1", "en1.wav"), ("f2", "en2.wav")]),
+                       ("es", [("f1", "es1.wav"), ("f2", "es2.wav")])]
+
+
+def test_prediction_count_mismatch_fails_every_clip_of_the_batch():
+    server = FakeServer(short_by=1)
+    with mock.patch("utils.transcription_batcher.requests.post", side_effect=server.post):
+        batcher, first = busy_batcher(server, max_batch_size=2, max_wait=60)
+        futures = [batcher.submit(AUDIO, f"c{i}.wav", language="en") for i in (1, 2)]
+        assert dispatched(batcher, 2)
+        server.release()
+        for future in futures:
+            with pytest.raises(ValueError, match="1 predictions for a batch of 2 clips"):
+                future.result(5)
+        # the failed batch does not affect the one in flight, nor the ones after it
+        assert first.result(5) == {"text": "c0.wav"}
+        assert batcher.transcribe(AUDIO, "c3.wav", language="en") == {"text": "c3.wav"}
+
+    assert batcher.stats()["in_flight"] == 0
@@ -0,0 +1,93 @@
+import asyncio
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable, Optional
+
+from config.logconfig import get_logger
+from utils import heconstants
+from utils.s3_operation import S3SERVICE
+
+logger = get_logger()
+
+# bounds the storage calls in flight for the whole process; under gevent's monkey patching
+# these workers are greenlets, so a waiting call costs a greenlet instead of an OS thread
+io_pool = ThreadPoolExecutor(max_workers=heconstants.S3_ASYNC_WORKERS, thread_name_prefix="s3-async")
+
+ASYNC_METHODS = (
+    "upload_to_s3",
+    "upload_stream",
+    "get_json_file",
+    "get_audio_file",
+    "check_file_exists",
+    "get_json_if_exists",
+    "get_jsons_if_exist",
+    "get_json_files",
+    "get_files_matching_pattern",
+    "get_dirs_matching_pattern",
+    "list_files_in_directory",
+    "download_from_s3",
+)
+
+
+class AsyncS3SERVICE:
+    """
+    ``S3SERVICE`` for servers that must not hold a request on storage latency.
+
+    Every method in ``ASYNC_METHODS`` is a coroutine with the ``S3SERVICE`` signature for
+    asyncio code. Gevent and thread code use ``submit`` instead, which returns a
+    ``concurrent.futures.Future`` right away; ``result()`` only blocks the calling greenlet.
+    """
+
+    def __init__(self, s3: Optional[S3SERVICE] = None, executor: Optional[ThreadPoolExecutor] = None):
+        self.s3 = s3 or S3SERVICE()
+        self.executor = executor or io_pool
+
+    def submit(self, method: str, *args, **kwargs) -> Future:
+        if method not in ASYNC_METHODS:
+            raise AttributeError(f"{method} is not an asynchronous S3SERVICE method")
+        return self.executor.submit(getattr(self.s3, method), *args, **kwargs)
+
+    def call(self, fn: Callable, *args, **kwargs) -> Future:
+        """Runs ``fn``, which makes storage calls of its own (e.g. a ``ChunkManifest`` read), on the same pool."""
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def upload_then(self, s3_filename, data, then: Optional[Callable] = None, previous: Optional[Future] = None,
+                    is_json: bool = False) -> Future:
+        """
+        Uploads ``data`` off the calling greenlet and calls ``then()`` once it is stored, e.g. to
+        publish the task that reads it. Passing the future of a stream's previous call as
+        ``previous`` keeps that stream's uploads and follow-ups in order.
+        """
+
+        def run():
+            if previous is not None:
+                # the pool is FIFO, so ``previous`` is already running or done
+                wait([previous])
+            self.s3.upload_to_s3(s3_filename, data, is_json=is_json)
+            if then is not None:
+                return then()
+
+        future = self.executor.submit(run)
+        future.add_done_callback(_log_failure)
+        return future
+
+
+def _log_failure(future):
+    exc = future.exception()
+    if exc is not None:
+        msg = "Background upload failed :: {}".format(exc)
+        trace = "".join(traceback.format_exception(type(exc), exc, exc.__traceback__))
+        logger.error(msg, trace)
+
+
+def _coroutine(method):
+    async def call(self, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(method, *args, **kwargs))
+
+    call.__name__ = method
+    call.__doc__ = getattr(S3SERVICE, method).__doc__
+    return call
+
+
+for _method in ASYNC_METHODS:
+    setattr(AsyncS3SERVICE, _method, _coroutine(_method))
@@ -0,0 +1,101 @@
+import threading
+from collections import defaultdict
+from typing import Optional
+
+from config.logconfig import get_logger
+from utils.s3_operation import S3SERVICE
+from utils.storage import PreconditionFailed
+
+logger = get_logger()
+
+
+class ChunkManifest:
+    """
+    Per-conversation index of transcribed chunks kept at ``{conversation_id}/manifest.json``.
+
+    Each entry holds ``chunk_no``, ``duration``, ``offset`` (audio time before the chunk),
+    ``language`` and ``key`` of the chunk's segment JSON, sorted by ``chunk_no``.
+    Only successfully transcribed chunks are indexed. Readers get the whole index in one
+    GET instead of listing the prefix and downloading every chunk. Conversations without
+    a manifest fall back to the prefix scan, and the first ``append`` seeds the manifest from it.
+
+    Writes for one conversation are serialized by a lock in this process, and across
+    processes by writing only if the manifest still has the ETag it was read with.
+    """
+
+    max_attempts = 10
+
+    def __init__(self, s3: Optional[S3SERVICE] = None):
+        self.s3 = s3 or S3SERVICE()
+        self._locks = defaultdict(threading.Lock)
+        self._locks_lock = threading.Lock()
+
+    @staticmethod
+    def manifest_key(conversation_id):
+        return f"{conversation_id}/manifest.json"
+
+    @staticmethod
+    def chunk_pattern(conversation_id):
+        return f"{conversation_id}/{conversation_id}_*json"
+
+    def _lock(self, conversation_id):
+        with self._locks_lock:
+            return self._locks[conversation_id]
+
+    def load(self, conversation_id):
+        return self.s3.get_json_if_exists(self.manifest_key(conversation_id))
+
+    def _scan(self, conversation_id):
+        # entries for the chunk JSON written before this conversation had a manifest; failed chunks
+        # are left out as append leaves them out
+        return [{"chunk_no": d["chunk_no"], "duration": d["duration"], "language": d.get("language"),
+                 "key": d["audio_path"].replace("wav", "json")}
+                for d in self.s3.get_files_matching_pattern(pattern=self.chunk_pattern(conversation_id))
+                if d.get("success")]
+
+    def append(self, conversation_id, chunk_no, duration, language, key):
+        with self._lock(conversation_id):
+            for _ in range(self.max_attempts):
+                manifest, etag = self.s3.get_json_versioned(self.manifest_key(conversation_id))
+                if manifest is None:
+                    manifest = {"conversation_id": conversation_id, "chunks": self._scan(conversation_id)}
+                # a retried chunk replaces its earlier entry
+                chunks = [c for c in manifest["chunks"] if c["chunk_no"] != chunk_no]
+                chunks.append({"chunk_no": chunk_no, "duration": duration, "language": language, "key": key})
+                chunks.sort(key=lambda c: c["chunk_no"])
+                offset = 0
+                for chunk in chunks:
+                    chunk["offset"] = offset
+                    offset += chunk["duration"]
+                manifest["chunks"] = chunks
+                manifest["total_duration"] = offset
+                try:
+                    self.s3.put_json_if(self.manifest_key(conversation_id), manifest, etag)
+                    return manifest
+                except PreconditionFailed:
+                    logger.info(f"manifest of {conversation_id} changed while appending chunk {chunk_no}, retrying")
+            raise PreconditionFailed(self.manifest_key(conversation_id))
+
+    def get_chunks(self, conversation_id, after: Optional[int] = None):
+        """Manifest entries with ``chunk_no`` greater than ``after``; None when there is no manifest."""
+        manifest = self.load(conversation_id)
+        if manifest is None:
+            return None
+        return [c for c in manifest["chunks"] if after is None or c["chunk_no"] > after]
+
+    def duration_before(self, conversation_id, chunk_no: Optional[int] = None):
+        """
+        Audio time of the chunks before ``chunk_no``, i.e. the offset of its segments. A redelivered
+        chunk and chunks after it that were already transcribed are not counted.
+        """
+        manifest = self.load(conversation_id)
+        chunks = manifest["chunks"] if manifest is not None else self._scan(conversation_id)
+        return sum(c["duration"] for c in chunks if chunk_no is None or c["chunk_no"] < chunk_no)
+
+    def get_chunk_datas(self, conversation_id, after: Optional[int] = None):
+        """Segment JSON of every chunk (after ``after``) in ``chunk_no`` order."""
+        chunks = self.get_chunks(conversation_id, after)
+        if chunks is None:
+            datas = self.s3.get_files_matching_pattern(pattern=self.chunk_pattern(conversation_id))
+            return [d for d in datas if after is None or d["chunk_no"] > after]
+        return self.s3.get_json_files([chunk["key"] for chunk in chunks])
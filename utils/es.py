@@ -1,7 +1,11 @@
+import atexit
 import json
 import logging
+import threading
+import time
 import traceback
 from typing import Optional
+from elasticsearch.helpers import streaming_bulk
 from elasticsearch_dsl import Search
 from utils import heconstants
 from config.logconfig import get_logger
@@ -9,34 +13,162 @@ from config.logconfig import get_logger
 logger = get_logger()
 
 
+class BulkWriter:
+    """
+    Buffers index and update actions and sends them through the bulk API without a refresh.
+
+    A flush happens once ``max_actions`` or ``max_bytes`` are buffered, ``interval`` seconds
+    after the first buffered action, on ``flush()`` and at exit. Items rejected with 429 are
+    retried with exponential backoff; every other failed item is logged and counted, and
+    ``flush`` returns them.
+    """
+
+    def __init__(self, client=None, max_actions: int = heconstants.ES_BULK_MAX_ACTIONS,
+                 max_bytes: int = heconstants.ES_BULK_MAX_BYTES,
+                 interval: float = heconstants.ES_BULK_FLUSH_INTERVAL_SECONDS,
+                 max_retries: int = heconstants.ES_BULK_MAX_RETRIES):
+        self._client = client
+        self.max_actions = max_actions
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.max_retries = max_retries
+        self.sent = 0
+        self.failed = 0
+        self._actions = []
+        self._bytes = 0
+        self._first_at = None
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        atexit.register(self.close)
+
+    @property
+    def client(self):
+        return self._client or heconstants.es_client
+
+    def index(self, index, source, id: Optional[str] = None):
+        action = {"_op_type": "index", "_index": index, "_source": source}
+        if id:
+            action["_id"] = id
+        self._add(action, source)
+
+    def update(self, index, id, body):
+        # body is the update request, i.e. {"doc": ...} or {"script": ...}
+        self._add({"_op_type": "update", "_index": index, "_id": id, **body}, body)
+
+    def _add(self, action, body):
+        size = len(json.dumps(body, default=str))
+        with self._condition:
+            self._actions.append(action)
+            self._bytes += size
+            full = len(self._actions) >= self.max_actions or self._bytes >= self.max_bytes
+            if self._first_at is None:
+                self._first_at = time.time()
+                self._condition.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="es-bulk-writer", daemon=True)
+                self._thread.start()
+        if full:
+            self.flush()
+
+    def flush(self, refresh=False):
+        """Sends everything buffered; ``refresh="wait_for"`` returns once it is searchable."""
+        with self._flush_lock:
+            with self._condition:
+                actions, self._actions = self._actions, []
+                self._bytes = 0
+                self._first_at = None
+            if not actions:
+                return []
+            failures = []
+            try:
+                for ok, item in streaming_bulk(self.client, actions, chunk_size=self.max_actions,
+                                               max_chunk_bytes=self.max_bytes, raise_on_error=False,
+                                               raise_on_exception=False, max_retries=self.max_retries,
+                                               refresh=refresh):
+                    if not ok:
+                        failures.append(item)
+            except Exception as exc:
+                msg = "Bulk request of {} actions failed :: {}".format(len(actions), exc)
+                trace = traceback.format_exc()
+                logger.error(msg, trace)
+                failures = actions
+            with self._condition:
+                self.sent += len(actions) - len(failures)
+                self.failed += len(failures)
+            if failures:
+                logger.error(f"{len(failures)} of {len(actions)} bulk actions failed :: {failures[:5]}")
+            return failures
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self.flush()
+
+    def stats(self):
+        with self._condition:
+            return {"sent": self.sent, "failed": self.failed, "buffered": len(self._actions)}
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed and (self._first_at is None or self._first_at + self.interval > time.time()):
+                    self._condition.wait(max(0.0, self._first_at + self.interval - time.time())
+                                         if self._first_at is not None else None)
+                if self._closed:
+                    return
+            self.flush()
+
+
+bulk_writer = BulkWriter()
+
+
 class Index:
 
-    def __init__(self):
-        pass
+    def __init__(self, bulk: Optional[BulkWriter] = None):
+        self.bulk = bulk or bulk_writer
+
+    def flush(self, refresh=False):
+        return self.bulk.flush(refresh=refresh)
+
+    @staticmethod
+    def _source(s, source_include):
+        if source_include:
+            if isinstance(source_include, str):
+                source_include = [source_include]
+            elif not isinstance(source_include, list):
+                raise ValueError("_source_include must be a string or a list of strings")
+            s = s.source(includes=source_include)
+        return s
 
-    def search(self, search_query, sort_by=None, source_include: Optional = None, index: Optional[str] = None):
+    @staticmethod
+    def _sort(sort_by):
+        if not isinstance(sort_by, tuple) or len(sort_by) != 2:
+            raise ValueError("sort_by must be a tuple of (field, order)")
+        field, order = sort_by
+        return {f"{field}": {"order": f"{order}"}}
+
+    def search(self, search_query, sort_by=None, source_include: Optional = None, index: Optional[str] = None,
+               size: int = 1000):
+        """The first ``size`` hits as a list, ``iter_search`` streams over all of them."""
         try:
             if index:
                 s = Search(using=heconstants.es_client, index=index)
             else:
                 s = Search(using=heconstants.es_client, index=heconstants.transcript_index)
             s = s.query(search_query)
-
-            if source_include:
-                if isinstance(source_include, str):
-                    source_include = [source_include]
-                elif not isinstance(source_include, list):
-                    raise ValueError("_source_include must be a string or a list of strings")
-                s = s.source(includes=source_include)
+            s = self._source(s, source_include)
 
             if sort_by:
-                if not isinstance(sort_by, tuple) or len(sort_by) != 2:
-                    raise ValueError("sort_by must be a tuple of (field, order)")
-                field, order = sort_by
-                s = s.sort({f"{field}": {"order": f"{order}"}})
+                s = s.sort(self._sort(sort_by))
 
-            s = s.extra(from_=0, size=1000)  # Consider parameterizing these values
+            s = s.extra(from_=0, size=size)
             response = s.execute().to_dict()
+            total = response['hits']['total']
+            if isinstance(total, dict) and (total.get('relation') == 'gte' or total.get('value', 0) > size):
+                logger.info(f"search returned the first {size} hits only, use iter_search for all of them")
             return response['hits']['hits']
         except:
             logger.info(
@@ -44,18 +176,68 @@ class Index:
             )
             pass
 
-    def update(self, script_body, doc_id, index: Optional[str] = None):
+    def iter_search(self, search_query, sort_by=None, source_include: Optional = None, index: Optional[str] = None,
+                    page_size: int = heconstants.ES_SEARCH_PAGE_SIZE, point_in_time: bool = True):
+        """
+        Yields every hit of the query, one page of ``page_size`` in memory at a time.
+
+        Pages follow each other with ``search_after`` on a point in time, so documents
+        indexed meanwhile do not shift them. ``point_in_time=False`` is for clusters older
+        than 7.12; its pages are then ordered by ``_id`` as the tiebreaker instead.
+        """
+        index = index or heconstants.transcript_index
+        client = heconstants.es_client
+        sort = [self._sort(sort_by)] if sort_by else []
+        pit_id = None
+        if point_in_time:
+            pit_id = client.open_point_in_time(index=index, keep_alive=heconstants.ES_PIT_KEEP_ALIVE)["id"]
+            s = Search(using=client)
+            sort.append({"_shard_doc": "asc"})
+        else:
+            s = Search(using=client, index=index)
+            sort.append({"_id": "asc"})
+        s = self._source(s.query(search_query), source_include).sort(*sort).extra(size=page_size)
+        try:
+            search_after = None
+            while True:
+                page = s
+                if pit_id:
+                    page = page.extra(pit={"id": pit_id, "keep_alive": heconstants.ES_PIT_KEEP_ALIVE})
+                if search_after:
+                    page = page.extra(search_after=search_after)
+                response = page.execute().to_dict()
+                # the id may change between pages
+                pit_id = response.get("pit_id", pit_id)
+                hits = response['hits']['hits']
+                yield from hits
+                if len(hits) < page_size:
+                    return
+                search_after = hits[-1]['sort']
+        finally:
+            if pit_id:
+                try:
+                    client.close_point_in_time(body={"id": pit_id})
+                except Exception as exc:
+                    msg = "Failed to close point in time :: {}".format(exc)
+                    trace = traceback.format_exc()
+                    logger.error(msg, trace)
+
+    def update(self, script_body, doc_id, index: Optional[str] = None, refresh=False):
+        """Buffered in the bulk writer unless ``refresh`` is True or "wait_for", which callers reading their own write need."""
+        if not refresh:
+            self.bulk.update(index or heconstants.transcript_index, doc_id, script_body)
+            return
         try:
             # logger.info(f"updating document: {doc_id} :: {script_body}")
 
             if index:
                 update_response = heconstants.es_client.update(index=index,
                                                                id=doc_id,
-                                                               body=script_body, refresh=True)
+                                                               body=script_body, refresh=refresh)
             else:
                 update_response = heconstants.es_client.update(index=heconstants.transcript_index,
                                                                id=doc_id,
-                                                               body=script_body, refresh=True)
+                                                               body=script_body, refresh=refresh)
             esresult = update_response["result"]
             # logger.info(f"update document: {esresult}")
             if esresult not in ["created", "updated", "noop"]:
@@ -73,19 +255,23 @@ class Index:
             logger.error(msg, trace)
             pass
 
-    def add(self, data, id: Optional[str] = None, index: Optional[str] = None):
+    def add(self, data, id: Optional[str] = None, index: Optional[str] = None, refresh=False):
+        """Buffered in the bulk writer unless ``refresh`` is True or "wait_for", see ``update``."""
+        if not index:
+            index = heconstants.transcript_index
+        if not refresh:
+            self.bulk.index(index, data, id=id)
+            return
         try:
             # logger.info(f"adding document :: {id}")
-            if not index:
-                index = heconstants.transcript_index
 
             if id:
                 res = heconstants.es_client.index(index=index,
                                                   doc_type=heconstants.es_type, body=json.dumps(data),
-                                                  id=id, refresh=True)
+                                                  id=id, refresh=refresh)
             else:
                 res = heconstants.es_client.index(index=index,
-                                                  doc_type=heconstants.es_type, body=json.dumps(data), refresh=True)
+                                                  doc_type=heconstants.es_type, body=json.dumps(data), refresh=refresh)
             # logger.info(f"adding document resp :: {res}")
             esresult = res.get("result")
             # logger.info(f"add document: {esresult}")
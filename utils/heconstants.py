@@ -6,14 +6,20 @@ from botocore.exceptions import ClientError
 from elasticsearch import Elasticsearch
 
 
-AWS_ACCESS_KEY = os.environ["AWS_ACCESS_KEY"]
-AWS_SECRET_ACCESS_KEY = os.environ["AWS_SECRET_ACCESS_KEY"]
-env = os.environ["ENVIRONMENT"]
+AWS_ACCESS_KEY = os.environ.get("AWS_ACCESS_KEY")
+AWS_SECRET_ACCESS_KEY = os.environ.get("AWS_SECRET_ACCESS_KEY")
+env = os.environ.get("ENVIRONMENT")
+# a local JSON file with the same keys as the secret, for running without AWS
+SECRETS_FILE = os.getenv("SECRETS_FILE")
 
 logger = logging.getLogger("heconstants")
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 
 def get_secret():
+    if SECRETS_FILE:
+        with open(SECRETS_FILE) as f:
+            return f.read()
+
     secret_name = f"{env}/healiom"
     region_name = "us-east-2"
 
@@ -143,12 +149,80 @@ AI_SERVER = secret_values.get("AI_SERVER")
 HEALIOM_SERVER = secret_values.get("HEALIOM_SERVER")
 transcript_index = secret_values.get("TRANSCRIPTION_META_INDEX")
 websocket_logs_index = secret_values.get("WEBSOCKET_LOGS_INDEX")
+# read size when streaming S3 audio into /transcribe/infer
+ASR_STREAM_CHUNK_SIZE = int(secret_values.get("ASR_STREAM_CHUNK_SIZE", 64 * 1024))
+# client side batching of transcription clips, opt-in: the default 1 posts every clip on its own as before
+ASR_BATCH_MAX_SIZE = int(secret_values.get("ASR_BATCH_MAX_SIZE", 1))
+ASR_BATCH_MAX_WAIT_SECONDS = float(secret_values.get("ASR_BATCH_MAX_WAIT_SECONDS", 0.05))
+# batches sent without waiting for more clips, further clips collect until one of them returns
+ASR_BATCH_MAX_IN_FLIGHT = int(secret_values.get("ASR_BATCH_MAX_IN_FLIGHT", 2))
+ASR_BATCH_TIMEOUT_SECONDS = float(secret_values.get("ASR_BATCH_TIMEOUT_SECONDS", 120))
+# websocket log events are shipped from a bounded queue, sampled once it is half full and dropped when full
+LOG_SHIPPER_QUEUE_SIZE = int(secret_values.get("LOG_SHIPPER_QUEUE_SIZE", 10000))
+LOG_SHIPPER_SAMPLE_EVERY = int(secret_values.get("LOG_SHIPPER_SAMPLE_EVERY", 10))
+LOG_SHIPPER_BATCH_SIZE = int(secret_values.get("LOG_SHIPPER_BATCH_SIZE", 100))
+LOG_SHIPPER_FLUSH_INTERVAL_SECONDS = float(secret_values.get("LOG_SHIPPER_FLUSH_INTERVAL_SECONDS", 1))
+LOG_SHIPPER_TIMEOUT_SECONDS = float(secret_values.get("LOG_SHIPPER_TIMEOUT_SECONDS", 5))
+# path on HEALIOM_SERVER taking a list of events, unset posts each event to /post_websocket_logs
+LOG_SHIPPER_BULK_PATH = secret_values.get("LOG_SHIPPER_BULK_PATH")
+# page size of Index.iter_search and how long its point in time is kept between two pages
+ES_SEARCH_PAGE_SIZE = int(secret_values.get("ES_SEARCH_PAGE_SIZE", 1000))
+ES_PIT_KEEP_ALIVE = secret_values.get("ES_PIT_KEEP_ALIVE", "1m")
+# buffered bulk indexing of Index.add/update, flushed on whichever limit is hit first
+ES_BULK_MAX_ACTIONS = int(secret_values.get("ES_BULK_MAX_ACTIONS", 500))
+ES_BULK_MAX_BYTES = int(secret_values.get("ES_BULK_MAX_BYTES", 5 * 1024 * 1024))
+ES_BULK_FLUSH_INTERVAL_SECONDS = float(secret_values.get("ES_BULK_FLUSH_INTERVAL_SECONDS", 1))
+# retries of items rejected with 429, with exponential backoff
+ES_BULK_MAX_RETRIES = int(secret_values.get("ES_BULK_MAX_RETRIES", 3))
 RTMP_SERVER_URL = secret_values.get("RTMP_SERVER_URL")
 OPENAI_APIKEY = secret_values.get("OPENAI_APIKEY")
 API_KEY = "test_key"
 GPT_MODELS = ["gpt-3.5-turbo-0613", "gpt-3.5-turbo-16k-0613", "gpt-4-0613"]
 EXECUTOR_TOPIC = secret_values.get("EXECUTOR_TOPIC")
+# Each executor stage consumes its own topic, keyed by care_req_id so that all
+# chunks of one conversation land on the same partition.
+STAGE_TOPICS = {
+    "Init": secret_values.get("INIT_TOPIC", f"{EXECUTOR_TOPIC}.init"),
+    "SpeechToText": secret_values.get("SPEECH_TO_TEXT_TOPIC", f"{EXECUTOR_TOPIC}.speech_to_text"),
+    "AiPred": secret_values.get("AI_PRED_TOPIC", f"{EXECUTOR_TOPIC}.ai_pred"),
+    "Analytics": secret_values.get("ANALYTICS_TOPIC", f"{EXECUTOR_TOPIC}.analytics"),
+    "Final": secret_values.get("FINAL_TOPIC", f"{EXECUTOR_TOPIC}.final"),
+}
+RETRY_TOPIC = secret_values.get("RETRY_TOPIC", f"{EXECUTOR_TOPIC}.retry")
+DEAD_LETTER_TOPIC = secret_values.get("DEAD_LETTER_TOPIC", f"{EXECUTOR_TOPIC}.dead_letter")
+RETRY_MAX_ATTEMPTS = int(secret_values.get("RETRY_MAX_ATTEMPTS", 3))
+RETRY_BASE_DELAY_SECONDS = float(secret_values.get("RETRY_BASE_DELAY_SECONDS", 2))
+RETRY_MAX_DELAY_SECONDS = float(secret_values.get("RETRY_MAX_DELAY_SECONDS", 60))
 ASR_BUCKET = secret_values.get("ASR_BUCKET")
+# "s3", "local" (files under STORAGE_LOCAL_ROOT, shared by executors on one node) or "memory"
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', secret_values.get('STORAGE_BACKEND', 's3'))
+STORAGE_LOCAL_ROOT = os.getenv('STORAGE_LOCAL_ROOT', secret_values.get('STORAGE_LOCAL_ROOT', '/tmp/tsukuyomi_storage'))
+S3_MAX_POOL_CONNECTIONS = int(secret_values.get("S3_MAX_POOL_CONNECTIONS", 50))
+S3_FETCH_WORKERS = int(secret_values.get("S3_FETCH_WORKERS", 16))
+# S3 rejects multipart parts under 5MB, except the last one
+S3_MULTIPART_PART_SIZE = max(int(secret_values.get("S3_MULTIPART_PART_SIZE", 8 * 1024 * 1024)), 5 * 1024 * 1024)
+# parts of one upload in flight at a time, a writer holds at most this many + 1 parts in memory
+S3_MULTIPART_CONCURRENCY = int(secret_values.get("S3_MULTIPART_CONCURRENCY", 4))
+S3_UPLOAD_WORKERS = int(secret_values.get("S3_UPLOAD_WORKERS", 16))
+# storage calls in flight per server process through utils.async_s3
+S3_ASYNC_WORKERS = int(secret_values.get("S3_ASYNC_WORKERS", 64))
+# repeated writes of a live session's transcript JSON within this window become one PUT, 0 writes through.
+# The websocket server shows that JSON as live captions, so the window defaults to the quick loop's chunk
+# cadence: captions lag by at most one chunk
+S3_WRITE_BEHIND_WINDOW_SECONDS = float(secret_values.get("S3_WRITE_BEHIND_WINDOW_SECONDS",
+                                                         secret_values.get("QUICK_LOOP_CHUNK_DURATION", 2)))
+# delay before a failed write-behind PUT is retried when there is no window
+S3_WRITE_BEHIND_RETRY_SECONDS = float(secret_values.get("S3_WRITE_BEHIND_RETRY_SECONDS", 5))
+# "gzip" or "zstd" for JSON artifacts, readers sniff the encoding so enable it only once every reader is upgraded
+S3_JSON_COMPRESSION = secret_values.get("S3_JSON_COMPRESSION", "none")
+S3_JSON_COMPRESSION_LEVEL = int(secret_values.get("S3_JSON_COMPRESSION_LEVEL", 3))
+S3_JSON_COMPRESSION_MIN_BYTES = int(secret_values.get("S3_JSON_COMPRESSION_MIN_BYTES", 1024))
+S3_JSON_MAX_DECODED_BYTES = int(secret_values.get("S3_JSON_MAX_DECODED_BYTES", 256 * 1024 * 1024))
+# optional in-process cache of JSON reads, revalidated by ETag; off unless enabled
+S3_JSON_CACHE_ENABLED = str(secret_values.get("S3_JSON_CACHE_ENABLED", False)).lower() == "true"
+S3_JSON_CACHE_MAX_BYTES = int(secret_values.get("S3_JSON_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+# 0 revalidates every read with a conditional GET, raise it to serve recent entries without a request
+S3_JSON_CACHE_TTL_SECONDS = float(secret_values.get("S3_JSON_CACHE_TTL_SECONDS", 0))
 SYNC_SERVER = secret_values.get("SYNC_SERVER")
 BOOTSTRAP_SERVERS = secret_values.get("BOOTSTRAP_SERVERS")
 GROUP_ID = secret_values.get('GROUP_ID')
@@ -158,6 +232,39 @@ RETRY_BACKOFF_MS = secret_values.get('RETRY_BACKOFF_MS')
 HEARTBEAT_INTERVAL_MS = secret_values.get('HEARTBEAT_INTERVAL_MS')
 SESSION_TIMEOUT_MS = secret_values.get('SESSION_TIMEOUT_MS')
 KAFKA_SLEEP_TIME = secret_values.get('KAFKA_SLEEP_TIME')
+MAX_IN_FLIGHT_TASKS = secret_values.get('MAX_IN_FLIGHT_TASKS')
+# on SIGTERM, seconds to wait for in-flight tasks before committing and stopping, below the pod's grace period
+EXECUTOR_DRAIN_TIMEOUT_SECONDS = float(secret_values.get('EXECUTOR_DRAIN_TIMEOUT_SECONDS', 25))
+# per-state overrides, e.g. {"SpeechToText": 8, "Analytics": 4}
+STAGE_MAX_WORKERS = secret_values.get('STAGE_MAX_WORKERS') or {}
+# per-state "thread", "asyncio" or "process", e.g. {"Analytics": "process"}
+STAGE_EXECUTION_MODES = secret_values.get('STAGE_EXECUTION_MODES') or {}
+PRODUCER_LINGER_MS = int(secret_values.get('PRODUCER_LINGER_MS', 20))
+PRODUCER_BATCH_SIZE = int(secret_values.get('PRODUCER_BATCH_SIZE', 64 * 1024))
+PRODUCER_COMPRESSION_TYPE = secret_values.get('PRODUCER_COMPRESSION_TYPE', 'lz4')
+PRODUCER_FLUSH_TIMEOUT = int(secret_values.get('PRODUCER_FLUSH_TIMEOUT', 10))
+# 'msgpack' only once every consumer can decode it, decoders read both
+MESSAGE_CODEC = secret_values.get('MESSAGE_CODEC', 'json')
+# "kafka" or "memory" (in-process broker for running the whole pipeline in one process)
+BROKER_BACKEND = os.getenv('BROKER_BACKEND', secret_values.get('BROKER_BACKEND', 'kafka'))
+# "memory", "sqlite", "redis" or "none"
+IDEMPOTENCY_BACKEND = secret_values.get('IDEMPOTENCY_BACKEND', 'memory')
+IDEMPOTENCY_TTL_SECONDS = int(secret_values.get('IDEMPOTENCY_TTL_SECONDS', 24 * 60 * 60))
+IDEMPOTENCY_MAX_ENTRIES = int(secret_values.get('IDEMPOTENCY_MAX_ENTRIES', 100000))
+IDEMPOTENCY_SQLITE_PATH = secret_values.get('IDEMPOTENCY_SQLITE_PATH', '/tmp/executor_idempotency.db')
+IDEMPOTENCY_REDIS_URL = secret_values.get('IDEMPOTENCY_REDIS_URL', 'redis://localhost:6379/0')
+# live session stage/pid: "s3" (the per-session json, shared by every container, polled by watchers) or
+# "redis" (shared, microsecond updates, watchers are notified of changes); "sqlite" and "memory" only when
+# the websocket server, its rtmp savers and the file downloader run on one host
+SESSION_STATE_BACKEND = os.getenv('SESSION_STATE_BACKEND', secret_values.get('SESSION_STATE_BACKEND', 's3'))
+SESSION_STATE_SQLITE_PATH = secret_values.get('SESSION_STATE_SQLITE_PATH', '/tmp/session_state.db')
+SESSION_STATE_REDIS_URL = secret_values.get('SESSION_STATE_REDIS_URL', 'redis://localhost:6379/0')
+SESSION_STATE_TTL_SECONDS = int(secret_values.get('SESSION_STATE_TTL_SECONDS', 24 * 60 * 60))
+# how often a session watch re-reads a store without change notifications (s3)
+SESSION_STATE_POLL_INTERVAL_SECONDS = float(secret_values.get('SESSION_STATE_POLL_INTERVAL_SECONDS', 2))
+# prometheus endpoint of each executor, 0 disables it
+METRICS_PORT = int(secret_values.get('METRICS_PORT', 9100))
+METRICS_LAG_INTERVAL_SECONDS = int(secret_values.get('METRICS_LAG_INTERVAL_SECONDS', 15))
 EXECUTOR_LOGGER_NAME = secret_values.get('EXECUTOR_LOGGER_NAME')
 TIME_IN_SEC = secret_values.get('TIME_IN_SEC')
 MAX_TIME = secret_values.get('MAX_TIME')
@@ -0,0 +1,66 @@
+import gzip
+import json
+from typing import Optional, Tuple
+
+from utils import heconstants
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+CONTENT_ENCODINGS = ("gzip", "zstd")
+
+
+def dumps(data) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # e.g. integers beyond 64 bits, which json handles
+            pass
+    return json.dumps(data).encode('utf-8')
+
+
+def loads(body: bytes):
+    if orjson is not None:
+        try:
+            return orjson.loads(body)
+        except orjson.JSONDecodeError:
+            # json.dumps writes NaN and Infinity, which orjson rejects
+            pass
+    return json.loads(body.decode('utf-8'))
+
+
+def encode_json(data, compression: Optional[str] = None) -> Tuple[bytes, Optional[str]]:
+    """
+    The JSON body for ``data`` and its content encoding, None when it is left uncompressed.
+    Bodies under ``S3_JSON_COMPRESSION_MIN_BYTES`` are not worth a compression frame.
+    """
+    body = dumps(data)
+    compression = compression or heconstants.S3_JSON_COMPRESSION
+    if compression not in CONTENT_ENCODINGS or len(body) < heconstants.S3_JSON_COMPRESSION_MIN_BYTES:
+        return body, None
+    if compression == "zstd":
+        if zstandard is None:
+            raise ValueError("S3_JSON_COMPRESSION is zstd but the zstandard package is not installed")
+        return zstandard.ZstdCompressor(level=heconstants.S3_JSON_COMPRESSION_LEVEL).compress(body), "zstd"
+    return gzip.compress(body, compresslevel=heconstants.S3_JSON_COMPRESSION_LEVEL), "gzip"
+
+
+def decode_json(body: bytes):
+    """Parses a body written by ``encode_json`` or by plain ``json.dumps``; the encoding is sniffed from its magic."""
+    if body[:2] == GZIP_MAGIC:
+        body = gzip.decompress(body)
+    elif body[:4] == ZSTD_MAGIC:
+        if zstandard is None:
+            raise ValueError("zstd compressed JSON but the zstandard package is not installed")
+        body = zstandard.ZstdDecompressor().decompress(body, max_output_size=heconstants.S3_JSON_MAX_DECODED_BYTES)
+    return loads(body)
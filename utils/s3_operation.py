@@ -1,40 +1,90 @@
-import json
 import os
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
 import fnmatch
-import boto3
 from botocore.exceptions import NoCredentialsError
 from utils import heconstants
+from utils.json_codec import decode_json, encode_json
+from utils.storage import ObjectNotFound, get_storage
+from utils.wav import WAV_HEADER_SIZE, wav_header
 
-# Setup S3 client
-s3_client = boto3.client('s3', aws_access_key_id=heconstants.AWS_ACCESS_KEY,
-                         aws_secret_access_key=heconstants.AWS_SECRET_ACCESS_KEY)
+# shared by all bulk fetches so concurrent callers cannot open more than this many GETs
+fetch_pool = ThreadPoolExecutor(max_workers=heconstants.S3_FETCH_WORKERS, thread_name_prefix="s3-fetch")
+
+
+class WavUploadWriter:
+    """
+    16-bit PCM WAV streamed through a storage writer with the ``wave.Wave_write`` calls the
+    recorders use. The header goes out with zero sizes and is patched on ``close``, while the
+    writer still holds the first part.
+    """
+
+    def __init__(self, upload, channels: int = 1, sample_width: int = 2, framerate: int = 16000):
+        self.upload = upload
+        self.channels = channels
+        self.sample_width = sample_width
+        self.framerate = framerate
+        self.upload.write(wav_header(0, channels, sample_width, framerate))
+
+    def writeframes(self, data):
+        self.upload.write(data)
+
+    def close(self):
+        if self.upload.closed:
+            return
+        data_size = self.upload.bytes_written - WAV_HEADER_SIZE
+        self.upload.patch(0, wav_header(data_size, self.channels, self.sample_width, self.framerate))
+        self.upload.close()
+
+    def abort(self):
+        self.upload.abort()
 
 
 class S3SERVICE:
-    def __init__(self):
+    def __init__(self, storage=None):
         self.default_bucket = heconstants.ASR_BUCKET
+        # S3, local disk or memory, see utils.storage
+        self.storage = storage or get_storage()
 
     def upload_to_s3(self, s3_filename, data, bucket_name: Optional[str] = None, is_json: Optional[bool] = False):
         try:
             if bucket_name is None:
                 bucket_name = self.default_bucket
+            if hasattr(data, "read"):
+                return self.upload_stream(s3_filename, data, bucket_name)
+            content_encoding = None
             if is_json:
-                data = json.dumps(data).encode('utf-8')
-            s3_client.put_object(Bucket=bucket_name, Key=s3_filename, Body=data)
+                data, content_encoding = encode_json(data)
+            self.storage.put(bucket_name, s3_filename, data, cache=is_json, content_encoding=content_encoding)
             print(f"Upload Successful: {s3_filename}")
         except FileNotFoundError:
             print("The file was not found")
         except NoCredentialsError:
             print("Credentials not available")
 
+    def open_upload(self, s3_filename, bucket_name: Optional[str] = None, part_size: Optional[int] = None,
+                    concurrency: Optional[int] = None, hold_first_part: bool = False):
+        if bucket_name is None:
+            bucket_name = self.default_bucket
+        return self.storage.open_writer(bucket_name, s3_filename, part_size, concurrency, hold_first_part)
+
+    def open_wav_upload(self, s3_filename, bucket_name: Optional[str] = None, channels: int = 1,
+                        sample_width: int = 2, framerate: int = 16000):
+        upload = self.open_upload(s3_filename, bucket_name, hold_first_part=True)
+        return WavUploadWriter(upload, channels, sample_width, framerate)
+
+    def upload_stream(self, s3_filename, fileobj, bucket_name: Optional[str] = None):
+        """Copies a readable file object to S3 one part at a time."""
+        with self.open_upload(s3_filename, bucket_name) as upload:
+            for block in iter(lambda: fileobj.read(upload.part_size), b""):
+                upload.write(block)
+        print(f"Upload Successful: {s3_filename}")
+
     def get_json_file(self, s3_filename, bucket_name: Optional[str] = None):
         try:
             if bucket_name is None:
                 bucket_name = self.default_bucket
-            s3_object = s3_client.get_object(Bucket=bucket_name, Key=s3_filename)
-            file_content = s3_object['Body'].read().decode('utf-8')
-            json_data = json.loads(file_content)
+            json_data = decode_json(self.storage.get(bucket_name, s3_filename, cache=True))
             return json_data
         except FileNotFoundError:
             print("The file was not found")
@@ -45,8 +95,7 @@ class S3SERVICE:
         try:
             if bucket_name is None:
                 bucket_name = self.default_bucket
-            s3_object = s3_client.get_object(Bucket=bucket_name, Key=s3_filename)
-            return s3_object
+            return {"Body": self.storage.open(bucket_name, s3_filename)}
         except FileNotFoundError:
             print("The file was not found")
         except NoCredentialsError:
@@ -56,11 +105,63 @@ class S3SERVICE:
         try:
             if bucket_name is None:
                 bucket_name = self.default_bucket
-            s3_client.head_object(Bucket=bucket_name, Key=key)
-            return True
-        except s3_client.exceptions.ClientError:
+            return self.storage.exists(bucket_name, key)
+        except Exception:
             return False
 
+    def get_json_if_exists(self, key, bucket_name: Optional[str] = None):
+        """The parsed JSON at ``key``, or None when it does not exist; one request instead of HEAD + GET."""
+        if bucket_name is None:
+            bucket_name = self.default_bucket
+        try:
+            return decode_json(self.storage.get(bucket_name, key, cache=True))
+        except ObjectNotFound:
+            return None
+
+    def get_json_versioned(self, key, bucket_name: Optional[str] = None):
+        """The parsed JSON at ``key`` and its ETag for ``put_json_if``; (None, None) when it does not exist."""
+        if bucket_name is None:
+            bucket_name = self.default_bucket
+        try:
+            body, etag = self.storage.get_versioned(bucket_name, key)
+        except ObjectNotFound:
+            return None, None
+        return decode_json(body), etag
+
+    def put_json_if(self, key, data, etag: Optional[str], bucket_name: Optional[str] = None):
+        """Writes ``data`` only if ``key`` still has ``etag``; raises PreconditionFailed otherwise."""
+        if bucket_name is None:
+            bucket_name = self.default_bucket
+        body, content_encoding = encode_json(data)
+        return self.storage.put_if(bucket_name, key, body, etag, content_encoding=content_encoding)
+
+    def get_jsons_if_exist(self, keys: Iterable[str], bucket_name: Optional[str] = None):
+        """``{key: json_data or None}`` for several optional files, fetched concurrently."""
+        keys = list(keys)
+        return dict(zip(keys, fetch_pool.map(lambda key: self.get_json_if_exists(key, bucket_name), keys)))
+
+    def _get_json_or_none(self, key, bucket_name):
+        try:
+            return decode_json(self.storage.get(bucket_name, key, cache=True))
+        except NoCredentialsError:
+            print("Credentials not available for file:", key)
+        except Exception as e:
+            print(f"An error occurred with file {key}: {e}")
+
+    def iter_json_files(self, keys: Iterable[str], bucket_name: Optional[str] = None):
+        """
+        Fetches ``keys`` concurrently on the shared fetch pool and yields ``(key, json_data)``
+        in the order of ``keys`` as soon as each one (and all before it) has arrived.
+        Files that fail to download yield None.
+        """
+        if bucket_name is None:
+            bucket_name = self.default_bucket
+        keys = list(keys)
+        yield from zip(keys, fetch_pool.map(lambda key: self._get_json_or_none(key, bucket_name), keys))
+
+    def get_json_files(self, keys: Iterable[str], bucket_name: Optional[str] = None):
+        return [data for _, data in self.iter_json_files(keys, bucket_name) if data is not None]
+
     def get_files_matching_pattern(self, pattern, bucket_name: Optional[str] = None):
         json_data_list = []
         try:
@@ -69,22 +170,8 @@ class S3SERVICE:
             # Extract the prefix from the pattern (up to the first wildcard)
             prefix = pattern.split('*')[0]
 
-            # Paginate through results if there are more files than the max returned in one call
-            paginator = s3_client.get_paginator('list_objects_v2')
-            for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
-                if 'Contents' in page:
-                    # Filter the objects whose keys match the pattern and read each JSON file
-                    for obj in page['Contents']:
-                        if fnmatch.fnmatch(obj['Key'], pattern):
-                            try:
-                                response = s3_client.get_object(Bucket=bucket_name, Key=obj['Key'])
-                                file_content = response['Body'].read().decode('utf-8')
-                                json_data = json.loads(file_content)
-                                json_data_list.append(json_data)
-                            except NoCredentialsError:
-                                print("Credentials not available for file:", obj['Key'])
-                            except s3_client.exceptions.ClientError as e:
-                                print(f"An error occurred with file {obj['Key']}: {e}")
+            keys = [key for key in self.storage.list_keys(bucket_name, prefix) if fnmatch.fnmatch(key, pattern)]
+            json_data_list = self.get_json_files(keys, bucket_name)
             json_data_list.sort(key=lambda x: x['chunk_no'])
             return json_data_list
         except Exception as exc:
@@ -93,9 +180,6 @@ class S3SERVICE:
         except NoCredentialsError:
             print("Credentials not available")
             return []
-        except s3_client.exceptions.ClientError as e:
-            print(f"An error occurred: {e}")
-            return []
 
     def sort_dirs_by_time(self, dirs_list):
         # Function to extract the timestamp from each directory name
@@ -117,15 +201,10 @@ class S3SERVICE:
             # Extract the prefix from the pattern (up to the first wildcard)
             prefix = pattern.split('*')[0]
 
-            # Paginate through results if there are more objects than the max returned in one call
-            paginator = s3_client.get_paginator('list_objects_v2')
-            for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
-                if 'Contents' in page:
-                    # Filter the objects whose keys match the pattern and check if they represent directories
-                    for obj in page['Contents']:
-                        if fnmatch.fnmatch(obj['Key'], pattern):
-                            dirname = os.path.dirname(obj['Key'])
-                            dirs_matching_pattern.add(dirname)
+            # Filter the objects whose keys match the pattern and check if they represent directories
+            for key in self.storage.list_keys(bucket_name, prefix):
+                if fnmatch.fnmatch(key, pattern):
+                    dirs_matching_pattern.add(os.path.dirname(key))
 
             # Convert the set of directory names to a list
             dirs_list = list(dirs_matching_pattern)
@@ -137,16 +216,12 @@ class S3SERVICE:
         except NoCredentialsError:
             print("Credentials not available")
             return []
-        except s3_client.exceptions.ClientError as e:
-            print(f"An error occurred: {e}")
-            return []
 
     def list_files_in_directory(self, directory, bucket_name: Optional[str] = None):
         try:
             if bucket_name is None:
                 bucket_name = self.default_bucket
-            response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=directory)
-            return [item['Key'] for item in response.get('Contents', [])]
+            return list(self.storage.list_keys(bucket_name, directory))
         except Exception as e:
             print(f"Error listing files: {e}")
 
@@ -154,7 +229,7 @@ class S3SERVICE:
         try:
             if bucket_name is None:
                 bucket_name = self.default_bucket
-            s3_client.download_file(bucket_name, key, local_path)
+            self.storage.download(bucket_name, key, local_path)
             print(f"Download Successful: {local_path}")
         except Exception as e:
             print(f"Error downloading file: {e}")
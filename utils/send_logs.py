@@ -1,29 +1,137 @@
+import atexit
 import json
+import os
+import queue
+import threading
+import time
 import requests
+from typing import Optional
 from utils import heconstants
 import logging
 
 logger = logging.getLogger("push_logs")
 
 
-def push_logs(care_request_id: str, given_msg: str, he_type: str, req_type: str, source_type: str):
-    try:
+class LogShipper:
+    """
+    Ships websocket log events to HEALIOM_SERVER from a background thread.
+
+    ``push`` only enqueues, so it never blocks the audio path. Once the queue is half full
+    only every ``sample_every``-th event is kept, and events are dropped when it is full.
+    The thread sends batches of up to ``batch_size`` events, at least every ``flush_interval``
+    seconds, as one POST of a JSON list to ``bulk_path`` when it is set, otherwise as one POST
+    per event over a kept-alive session. Queued events are flushed at exit and on ``close``.
+    """
+
+    def __init__(self, max_queue: int = heconstants.LOG_SHIPPER_QUEUE_SIZE,
+                 batch_size: int = heconstants.LOG_SHIPPER_BATCH_SIZE,
+                 flush_interval: float = heconstants.LOG_SHIPPER_FLUSH_INTERVAL_SECONDS,
+                 timeout: float = heconstants.LOG_SHIPPER_TIMEOUT_SECONDS,
+                 sample_every: int = heconstants.LOG_SHIPPER_SAMPLE_EVERY,
+                 bulk_path: Optional[str] = heconstants.LOG_SHIPPER_BULK_PATH):
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.sample_every = max(1, sample_every)
+        self.bulk_path = bulk_path
+        self.pushed = 0
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._thread_pid = None
+        atexit.register(self.close)
+
+    def push(self, event: dict):
+        with self._lock:
+            self.pushed += 1
+            sampled_out = self._queue.qsize() >= self.max_queue // 2 and self.pushed % self.sample_every
+            if self._thread is None or self._thread_pid != os.getpid():
+                # rtmp savers are forked, the parent's thread and queued events are not theirs
+                if self._thread is not None:
+                    self._queue = queue.Queue(maxsize=self.max_queue)
+                self._thread = threading.Thread(target=self._run, name="log-shipper", daemon=True)
+                self._thread.start()
+                self._thread_pid = os.getpid()
+        if sampled_out:
+            self._drop()
+            return
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self._drop()
+
+    def flush(self, timeout: float = heconstants.LOG_SHIPPER_TIMEOUT_SECONDS):
+        """Waits up to ``timeout`` seconds for the queued events to be sent."""
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks and time.time() < deadline and self._thread_pid == os.getpid():
+            time.sleep(0.05)
+
+    def close(self):
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {"pushed": self.pushed, "sent": self.sent, "dropped": self.dropped, "failed": self.failed,
+                    "queued": self._queue.qsize()}
+
+    def _drop(self):
+        with self._lock:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.info(f"log shipper is overloaded, {self.dropped} events dropped so far")
+
+    def _run(self):
+        session = requests.Session()
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.time())))
+                except queue.Empty:
+                    break
+            try:
+                self._send(session, batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _send(self, session, batch):
         headers = {
             'Content-Type': 'application/json'
         }
-        websocket_data = {
-            "care_request_id": care_request_id,
-            "he_type": he_type,
-            "req_type": req_type,
-            "message": given_msg,
-            "source_type": source_type
-        }
-        response = requests.request("POST", heconstants.HEALIOM_SERVER + "/post_websocket_logs", headers=headers,
-                                    data=json.dumps(websocket_data))
+        if self.bulk_path:
+            posts = [(self.bulk_path, batch, len(batch))]
+        else:
+            posts = [("/post_websocket_logs", event, 1) for event in batch]
+        for path, data, count in posts:
+            try:
+                response = session.post(heconstants.HEALIOM_SERVER + path, headers=headers, data=json.dumps(data),
+                                        timeout=self.timeout)
+                response.raise_for_status()
+                with self._lock:
+                    self.sent += count
+            except Exception as e:
+                with self._lock:
+                    self.failed += count
+                logger.info(f"Couldn't push the log to ES :: {e}")
+
 
-    except Exception as e:
-        logger.info(f"Couldn't push the log to ES :: {e}")
-        pass
+log_shipper = LogShipper()
+
+
+def push_logs(care_request_id: str, given_msg: str, he_type: str, req_type: str, source_type: str):
+    log_shipper.push({
+        "care_request_id": care_request_id,
+        "he_type": he_type,
+        "req_type": req_type,
+        "message": given_msg,
+        "source_type": source_type
+    })
 
 
 class pushLogs:
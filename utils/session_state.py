@@ -0,0 +1,264 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from config.logconfig import get_logger
+from utils import heconstants
+
+logger = get_logger()
+
+REDIS_UPDATE_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+local state = {}
+if current then state = cjson.decode(current) end
+for field, value in pairs(cjson.decode(ARGV[1])) do
+    if field == 'version' and value == cjson.null then
+        if current then return false end
+    else
+        if value == cjson.null then value = nil end
+        if state[field] ~= value then return false end
+    end
+end
+if not current and ARGV[3] == '0' then return false end
+for field, value in pairs(cjson.decode(ARGV[2])) do
+    if value == cjson.null then state[field] = nil else state[field] = value end
+end
+state['version'] = (state['version'] or 0) + 1
+local encoded = cjson.encode(state)
+redis.call('SET', KEYS[1], encoded, 'EX', ARGV[4])
+redis.call('PUBLISH', KEYS[1], state['version'])
+return encoded
+"""
+
+
+def _matches(state: Optional[dict], expected: Optional[dict]) -> bool:
+    # expected={"version": None} means "does not exist yet": sessions written before the store have no
+    # version field but do exist
+    for field, value in (expected or {}).items():
+        if field == "version" and value is None:
+            if state is not None:
+                return False
+        elif (state or {}).get(field) != value:
+            return False
+    return True
+
+
+def _merge(state: Optional[dict], fields: dict) -> dict:
+    merged = dict(state or {})
+    merged.update(fields)
+    merged["version"] = (state or {}).get("version", 0) + 1
+    return merged
+
+
+class MemorySessionStore:
+    """Session state of this process only, e.g. for the single-process pipeline."""
+
+    poll_interval = 0
+
+    def __init__(self, ttl: int = heconstants.SESSION_STATE_TTL_SECONDS):
+        self.ttl = ttl
+        self._states = {}  # session_id -> (state, expires_at)
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def get(self, session_id) -> Optional[dict]:
+        with self._lock:
+            entry = self._states.get(session_id)
+            if entry is None or entry[1] < time.time():
+                return None
+            return dict(entry[0])
+
+    def update(self, session_id, fields: dict, expected: Optional[dict] = None, create: bool = True) -> Optional[dict]:
+        with self._lock:
+            current = self.get(session_id)
+            if not _matches(current, expected) or (current is None and not create):
+                return None
+            state = _merge(current, fields)
+            self._states[session_id] = (state, time.time() + self.ttl)
+            self._writes += 1
+            if self._writes % 1000 == 0:
+                now = time.time()
+                for expired in [key for key, (_, expires_at) in self._states.items() if expires_at < now]:
+                    del self._states[expired]
+            return dict(state)
+
+
+class SQLiteSessionStore:
+    """
+    Session state shared by the processes of one host, e.g. the websocket server and the
+    RTMP savers it starts. Updates are transactions, so compare-and-set holds across them.
+    """
+
+    poll_interval = 0
+
+    def __init__(self, path: str = heconstants.SESSION_STATE_SQLITE_PATH,
+                 ttl: int = heconstants.SESSION_STATE_TTL_SECONDS):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = None
+        self._conn_pid = None
+        self._writes = 0
+
+    def _connection(self):
+        # savers are forked from the server, a connection must not cross a fork
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS session_state "
+                               "(session_id TEXT PRIMARY KEY, data TEXT, version INTEGER, expires_at REAL)")
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def _read(self, conn, session_id) -> Optional[dict]:
+        row = conn.execute("SELECT data FROM session_state WHERE session_id = ? AND expires_at >= ?",
+                           (session_id, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get(self, session_id) -> Optional[dict]:
+        with self._lock:
+            return self._read(self._connection(), session_id)
+
+    def update(self, session_id, fields: dict, expected: Optional[dict] = None, create: bool = True) -> Optional[dict]:
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                current = self._read(conn, session_id)
+                if not _matches(current, expected) or (current is None and not create):
+                    conn.execute("ROLLBACK")
+                    return None
+                state = _merge(current, fields)
+                conn.execute("INSERT OR REPLACE INTO session_state (session_id, data, version, expires_at) "
+                             "VALUES (?, ?, ?, ?)", (session_id, json.dumps(state), state["version"], now + self.ttl))
+                self._writes += 1
+                if self._writes % 1000 == 0:
+                    conn.execute("DELETE FROM session_state WHERE expires_at < ?", (now,))
+                conn.execute("COMMIT")
+                return state
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+
+class RedisSessionStore:
+    """Session state shared by every host; compare-and-set runs as one script and each write is published."""
+
+    # watchers re-read on notifications, and now and then in case one was lost
+    poll_interval = 30.0
+
+    def __init__(self, url: str = heconstants.SESSION_STATE_REDIS_URL, ttl: int = heconstants.SESSION_STATE_TTL_SECONDS,
+                 prefix: str = "session-state:"):
+        import redis
+
+        self.ttl = ttl
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+        self._update = self._client.register_script(REDIS_UPDATE_SCRIPT)
+
+    def get(self, session_id) -> Optional[dict]:
+        value = self._client.get(self.prefix + session_id)
+        return json.loads(value) if value else None
+
+    def update(self, session_id, fields: dict, expected: Optional[dict] = None, create: bool = True) -> Optional[dict]:
+        value = self._update(keys=[self.prefix + session_id],
+                             args=[json.dumps(expected or {}), json.dumps(fields), int(create), self.ttl])
+        return json.loads(value) if value else None
+
+    def subscribe(self, session_id) -> "RedisSubscription":
+        pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.prefix + session_id)
+        return RedisSubscription(pubsub)
+
+
+class RedisSubscription:
+    def __init__(self, pubsub):
+        self._pubsub = pubsub
+
+    def changed(self) -> bool:
+        """Whether a write was published since the last call; never blocks."""
+        changed = False
+        while self._pubsub.get_message(timeout=0) is not None:
+            changed = True
+        return changed
+
+    def close(self):
+        self._pubsub.close()
+
+
+class S3SessionStore:
+    """
+    The ``{session_id}/{session_id}.json`` objects used before the store existed, for hosts
+    that share nothing but the bucket. Compare-and-set is only best effort here, and there
+    are no notifications: watchers poll every ``SESSION_STATE_POLL_INTERVAL_SECONDS``.
+    """
+
+    poll_interval = heconstants.SESSION_STATE_POLL_INTERVAL_SECONDS
+
+    def __init__(self, s3=None):
+        from utils.s3_operation import S3SERVICE
+
+        self.s3 = s3 or S3SERVICE()
+
+    @staticmethod
+    def key(session_id):
+        return f"{session_id}/{session_id}.json"
+
+    def get(self, session_id) -> Optional[dict]:
+        return self.s3.get_json_if_exists(self.key(session_id))
+
+    def update(self, session_id, fields: dict, expected: Optional[dict] = None, create: bool = True) -> Optional[dict]:
+        current = self.get(session_id)
+        if not _matches(current, expected) or (current is None and not create):
+            return None
+        state = _merge(current, fields)
+        self.s3.upload_to_s3(self.key(session_id), state, is_json=True)
+        return state
+
+
+class SessionWatch:
+    """
+    The state of one session for a loop that reads it on every iteration. It is read from
+    the store again only when the store notified a change, or once ``poll_interval`` seconds
+    passed, so an iteration normally costs no request. Local stores are read every time.
+    """
+
+    def __init__(self, store, session_id):
+        self.store = store
+        self.session_id = session_id
+        subscribe = getattr(store, "subscribe", None)
+        # subscribed before the first read, so a write in between is not missed
+        self._subscription = subscribe(session_id) if subscribe else None
+        self._state = store.get(session_id)
+        self._read_at = time.time()
+
+    @property
+    def state(self) -> Optional[dict]:
+        changed = self._subscription is not None and self._subscription.changed()
+        if changed or time.time() - self._read_at >= self.store.poll_interval:
+            self._state = self.store.get(self.session_id)
+            self._read_at = time.time()
+        return self._state
+
+    def close(self):
+        if self._subscription is not None:
+            self._subscription.close()
+
+
+SESSION_STORES = {
+    "memory": MemorySessionStore,
+    "sqlite": SQLiteSessionStore,
+    "redis": RedisSessionStore,
+    "s3": S3SessionStore,
+}
+
+
+def create_session_store(backend: Optional[str] = None):
+    backend = backend or heconstants.SESSION_STATE_BACKEND
+    if backend not in SESSION_STORES:
+        raise ValueError(f"session state backend must be one of {sorted(SESSION_STORES)}")
+    return SESSION_STORES[backend]()
@@ -0,0 +1,601 @@
+import fcntl
+import hashlib
+import io
+import mmap
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from utils import heconstants
+
+# multipart part uploads of every S3 writer in the process; each writer bounds its own share
+upload_pool = ThreadPoolExecutor(max_workers=heconstants.S3_UPLOAD_WORKERS, thread_name_prefix="s3-upload")
+
+
+class ObjectNotFound(Exception):
+    pass
+
+
+class PreconditionFailed(Exception):
+    """A conditional put found the object changed (or created) since its ETag was read."""
+
+
+class JsonCache:
+    """
+    Size-bounded LRU of raw JSON bodies by (bucket, key) with their ETag.
+
+    Entries younger than ``ttl`` seconds are served as is; older ones are revalidated
+    with a conditional GET, so a 304 costs a request but no body transfer.
+    """
+
+    def __init__(self, client, max_bytes: int, ttl: float):
+        self.client = client
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # (bucket, key) -> (etag, body, stored_at)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, bucket, key):
+        with self._lock:
+            entry = self._entries.get((bucket, key))
+            if entry is not None:
+                self._entries.move_to_end((bucket, key))
+            return entry
+
+    def put(self, bucket, key, etag, body: bytes):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop((bucket, key), None)
+            if old is not None:
+                self._size -= len(old[1])
+            self._entries[(bucket, key)] = (etag, body, time.time())
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                _, (_, evicted, _) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def invalidate(self, bucket, key):
+        with self._lock:
+            old = self._entries.pop((bucket, key), None)
+            if old is not None:
+                self._size -= len(old[1])
+
+    def fetch(self, bucket, key) -> bytes:
+        entry = self.get(bucket, key)
+        if entry is not None:
+            etag, body, stored_at = entry
+            if time.time() - stored_at < self.ttl:
+                self.hits += 1
+                return body
+            try:
+                response = self.client.get_object(Bucket=bucket, Key=key, IfNoneMatch=etag)
+            except self.client.exceptions.ClientError as e:
+                if e.response.get('Error', {}).get('Code') not in ('304', 'NotModified'):
+                    raise
+                self.revalidated += 1
+                self.put(bucket, key, etag, body)
+                return body
+        else:
+            response = self.client.get_object(Bucket=bucket, Key=key)
+        self.misses += 1
+        body = response['Body'].read()
+        self.put(bucket, key, response.get('ETag'), body)
+        return body
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "revalidated": self.revalidated, "misses": self.misses,
+                    "entries": len(self._entries), "bytes": self._size}
+
+
+class MultipartUploadWriter:
+    """
+    Write-only file object streaming to ``key`` as an S3 multipart upload.
+
+    Writes are buffered until ``part_size`` bytes are available and every full part is
+    sent on the upload pool while the caller keeps writing. ``write`` blocks once
+    ``concurrency`` parts are in flight, so memory stays around ``(concurrency + 1) * part_size``
+    however long the stream is. A stream that never fills a part is sent with one ``put_object``.
+
+    With ``hold_first_part`` the first part is kept back until ``close`` so that ``patch`` can
+    still rewrite its leading bytes, e.g. a header whose sizes are only known at the end.
+    """
+
+    def __init__(self, storage: "S3Storage", bucket, key, part_size: Optional[int] = None,
+                 concurrency: Optional[int] = None, hold_first_part: bool = False):
+        self.storage = storage
+        self.client = storage.client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size or heconstants.S3_MULTIPART_PART_SIZE, 5 * 1024 * 1024)
+        self.hold_first_part = hold_first_part
+        self.upload_id = None
+        self.bytes_written = 0
+        self.closed = False
+        self._buffer = bytearray()
+        self._first_part = None
+        self._next_part_number = 1
+        self._parts = []  # (part_number, future of its ETag)
+        self._slots = threading.BoundedSemaphore(concurrency or heconstants.S3_MULTIPART_CONCURRENCY)
+        self._error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def writable(self):
+        return True
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError(f"write to closed upload of {self.key}")
+        self._buffer += data
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            self._add_part(part)
+        return len(data)
+
+    def patch(self, offset, data):
+        """Overwrites already written bytes, possible only while they are still held in memory."""
+        if self._first_part is not None:
+            target = self._first_part
+        elif self._next_part_number == 1:
+            target = self._buffer
+        else:
+            raise ValueError(f"bytes at {offset} of {self.key} are already uploaded")
+        if offset + len(data) > len(target):
+            raise ValueError(f"patch of {len(data)} bytes at {offset} is past the held data of {self.key}")
+        target[offset:offset + len(data)] = data
+
+    def _add_part(self, body: bytes):
+        part_number = self._next_part_number
+        self._next_part_number += 1
+        if part_number == 1 and self.hold_first_part:
+            self._first_part = bytearray(body)
+            return
+        self._submit(part_number, body)
+
+    def _submit(self, part_number, body):
+        if self._error is not None:
+            raise self._error
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        self._slots.acquire()
+        future = upload_pool.submit(self._upload_part, part_number, body)
+        future.add_done_callback(self._on_part_done)
+        self._parts.append((part_number, future))
+
+    def _upload_part(self, part_number, body):
+        response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                           PartNumber=part_number, Body=body)
+        return response['ETag']
+
+    def _on_part_done(self, future):
+        self._slots.release()
+        if future.exception() is not None and self._error is None:
+            self._error = future.exception()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.upload_id is None:
+                body = bytes(self._first_part or b"") + bytes(self._buffer)
+                self.client.put_object(Bucket=self.bucket, Key=self.key, Body=body)
+            else:
+                if self._buffer:
+                    self._submit(self._next_part_number, bytes(self._buffer))
+                if self._first_part is not None:
+                    self._submit(1, bytes(self._first_part))
+                parts = [{"PartNumber": number, "ETag": future.result()} for number, future in sorted(self._parts)]
+                self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                      MultipartUpload={"Parts": parts})
+        except Exception:
+            self._abort_upload()
+            raise
+        finally:
+            self._buffer = bytearray()
+            self._first_part = None
+            if self.storage.cache is not None:
+                self.storage.cache.invalidate(self.bucket, self.key)
+
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._buffer = bytearray()
+        self._first_part = None
+        self._abort_upload()
+
+    def _abort_upload(self):
+        if self.upload_id is None:
+            return
+        for _, future in self._parts:
+            future.cancel()
+        for _, future in self._parts:
+            if not future.cancelled():
+                future.exception()
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except self.client.exceptions.ClientError as e:
+            print(f"Failed to abort multipart upload of {self.key}: {e}")
+        self.upload_id = None
+
+
+class S3Storage:
+    """Objects in S3 through one boto3 client per process, small JSON bodies cached by ETag."""
+
+    def __init__(self):
+        import boto3
+        from botocore.config import Config
+
+        # the pool must cover the bulk-fetch workers of every thread in the process
+        self.client = boto3.client('s3', aws_access_key_id=heconstants.AWS_ACCESS_KEY,
+                                   aws_secret_access_key=heconstants.AWS_SECRET_ACCESS_KEY,
+                                   config=Config(max_pool_connections=heconstants.S3_MAX_POOL_CONNECTIONS))
+        self.cache = JsonCache(self.client, max_bytes=heconstants.S3_JSON_CACHE_MAX_BYTES,
+                               ttl=heconstants.S3_JSON_CACHE_TTL_SECONDS) if heconstants.S3_JSON_CACHE_ENABLED else None
+
+    def put(self, bucket, key, body: bytes, cache: bool = False, content_encoding: Optional[str] = None):
+        extra = {"ContentEncoding": content_encoding} if content_encoding else {}
+        response = self.client.put_object(Bucket=bucket, Key=key, Body=body, **extra)
+        if self.cache is not None:
+            # write-through, so this process reads back its own write without a GET
+            if cache:
+                self.cache.put(bucket, key, response.get('ETag'), body)
+            else:
+                self.cache.invalidate(bucket, key)
+
+    def get(self, bucket, key, cache: bool = False) -> bytes:
+        try:
+            if cache and self.cache is not None:
+                return self.cache.fetch(bucket, key)
+            return self.client.get_object(Bucket=bucket, Key=key)['Body'].read()
+        except self.client.exceptions.NoSuchKey:
+            if self.cache is not None:
+                self.cache.invalidate(bucket, key)
+            raise ObjectNotFound(key)
+
+    def get_versioned(self, bucket, key):
+        """The body with its ETag, always from S3 since it is read for a conditional put."""
+        try:
+            response = self.client.get_object(Bucket=bucket, Key=key)
+        except self.client.exceptions.NoSuchKey:
+            raise ObjectNotFound(key)
+        return response['Body'].read(), response.get('ETag')
+
+    def put_if(self, bucket, key, body: bytes, etag: Optional[str], content_encoding: Optional[str] = None):
+        """Stores ``body`` only if the object still has ``etag``, or does not exist when it is None."""
+        extra = {"ContentEncoding": content_encoding} if content_encoding else {}
+        if etag is None:
+            extra["IfNoneMatch"] = "*"
+        else:
+            extra["IfMatch"] = etag
+        try:
+            response = self.client.put_object(Bucket=bucket, Key=key, Body=body, **extra)
+        except self.client.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise PreconditionFailed(key)
+            raise
+        if self.cache is not None:
+            self.cache.put(bucket, key, response.get('ETag'), body)
+        return response.get('ETag')
+
+    def open(self, bucket, key):
+        try:
+            return self.client.get_object(Bucket=bucket, Key=key)['Body']
+        except self.client.exceptions.NoSuchKey:
+            raise ObjectNotFound(key)
+
+    def exists(self, bucket, key) -> bool:
+        try:
+            self.client.head_object(Bucket=bucket, Key=key)
+            return True
+        except self.client.exceptions.ClientError:
+            return False
+
+    def list_keys(self, bucket, prefix):
+        # Paginate through results if there are more objects than the max returned in one call
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                yield obj['Key']
+
+    def download(self, bucket, key, local_path):
+        self.client.download_file(bucket, key, local_path)
+
+    def open_writer(self, bucket, key, part_size: Optional[int] = None, concurrency: Optional[int] = None,
+                    hold_first_part: bool = False):
+        return MultipartUploadWriter(self, bucket, key, part_size, concurrency, hold_first_part)
+
+
+class LocalFileWriter:
+    """Writes to a temporary file next to ``path`` that replaces it on ``close``."""
+
+    def __init__(self, path, part_size: Optional[int] = None):
+        self.path = path
+        self.part_size = part_size or heconstants.S3_MULTIPART_PART_SIZE
+        self.bytes_written = 0
+        self.closed = False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._tmp_path = f"{path}.{uuid.uuid4().hex}{LocalStorage.PARTIAL_SUFFIX}"
+        self._file = open(self._tmp_path, "wb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def writable(self):
+        return True
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError(f"write to closed file {self.path}")
+        self._file.write(data)
+        self.bytes_written += len(data)
+        return len(data)
+
+    def patch(self, offset, data):
+        position = self._file.tell()
+        self._file.seek(offset)
+        self._file.write(data)
+        self._file.seek(position)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._file.close()
+            os.replace(self._tmp_path, self.path)
+        except Exception:
+            self._remove_tmp()
+            raise
+
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._file.close()
+        self._remove_tmp()
+
+    def _remove_tmp(self):
+        try:
+            os.remove(self._tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+class LocalStorage:
+    """
+    Objects as files under ``root/<bucket>/<key>``, for executors sharing one node and runs without S3.
+
+    Every write goes to a temporary file in the target directory and is renamed into place,
+    so a reader sees the old or the new object but never a partial one. Reads are memory
+    mapped; a mapping stays valid when the object is replaced while it is being read.
+    """
+
+    PARTIAL_SUFFIX = ".partial"
+
+    def __init__(self, root: Optional[str] = None):
+        self.root = os.path.abspath(root or heconstants.STORAGE_LOCAL_ROOT)
+        self.cache = None
+
+    def _path(self, bucket, key):
+        base = os.path.join(self.root, bucket or "default")
+        path = os.path.abspath(os.path.join(base, key))
+        if not path.startswith(base + os.sep):
+            raise ValueError(f"key {key} is outside of bucket {bucket}")
+        return path
+
+    def put(self, bucket, key, body: bytes, cache: bool = False, content_encoding: Optional[str] = None):
+        with self.open_writer(bucket, key) as writer:
+            writer.write(body)
+
+    def get(self, bucket, key, cache: bool = False) -> bytes:
+        body = self.open(bucket, key)
+        try:
+            return body.read()
+        finally:
+            body.close()
+
+    def get_versioned(self, bucket, key):
+        body = self.get(bucket, key)
+        return body, hashlib.md5(body).hexdigest()
+
+    def put_if(self, bucket, key, body: bytes, etag: Optional[str], content_encoding: Optional[str] = None):
+        os.makedirs(self.root, exist_ok=True)
+        # conditional puts of every process on the node take turns, the check and the rename are one step
+        with open(os.path.join(self.root, ".put_if.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                current = self.get_versioned(bucket, key)[1]
+            except ObjectNotFound:
+                current = None
+            if current != etag:
+                raise PreconditionFailed(key)
+            self.put(bucket, key, body)
+        return hashlib.md5(body).hexdigest()
+
+    def open(self, bucket, key):
+        try:
+            with open(self._path(bucket, key), "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return io.BytesIO()
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            raise ObjectNotFound(key)
+
+    def exists(self, bucket, key) -> bool:
+        return os.path.isfile(self._path(bucket, key))
+
+    def list_keys(self, bucket, prefix):
+        base = os.path.join(self.root, bucket or "default")
+        start = os.path.join(base, os.path.dirname(prefix))
+        keys = []
+        for dirpath, _, filenames in os.walk(start):
+            for filename in filenames:
+                if filename.endswith(self.PARTIAL_SUFFIX):
+                    continue
+                key = os.path.relpath(os.path.join(dirpath, filename), base).replace(os.sep, "/")
+                if key.startswith(prefix):
+                    keys.append(key)
+        # same order as an S3 listing
+        return iter(sorted(keys))
+
+    def download(self, bucket, key, local_path):
+        try:
+            shutil.copyfile(self._path(bucket, key), local_path)
+        except FileNotFoundError:
+            raise ObjectNotFound(key)
+
+    def open_writer(self, bucket, key, part_size: Optional[int] = None, concurrency: Optional[int] = None,
+                    hold_first_part: bool = False):
+        return LocalFileWriter(self._path(bucket, key), part_size)
+
+
+class MemoryWriter:
+    """Collects the object in memory and stores it on ``close``."""
+
+    def __init__(self, storage: "MemoryStorage", bucket, key, part_size: Optional[int] = None):
+        self.storage = storage
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size or heconstants.S3_MULTIPART_PART_SIZE
+        self.bytes_written = 0
+        self.closed = False
+        self._buffer = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def writable(self):
+        return True
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError(f"write to closed object {self.key}")
+        self._buffer += data
+        self.bytes_written += len(data)
+        return len(data)
+
+    def patch(self, offset, data):
+        self._buffer[offset:offset + len(data)] = data
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.storage.put(self.bucket, self.key, bytes(self._buffer))
+        self._buffer = bytearray()
+
+    def abort(self):
+        self.closed = True
+        self._buffer = bytearray()
+
+
+class MemoryStorage:
+    """Objects in a dict of this process, for benchmarks and the single-process pipeline. Nothing is persisted."""
+
+    def __init__(self):
+        self.cache = None
+        self._objects = {}  # (bucket, key) -> bytes
+        self._lock = threading.Lock()
+
+    def put(self, bucket, key, body: bytes, cache: bool = False, content_encoding: Optional[str] = None):
+        with self._lock:
+            self._objects[(bucket, key)] = bytes(body)
+
+    def get(self, bucket, key, cache: bool = False) -> bytes:
+        with self._lock:
+            try:
+                return self._objects[(bucket, key)]
+            except KeyError:
+                raise ObjectNotFound(key)
+
+    def get_versioned(self, bucket, key):
+        body = self.get(bucket, key)
+        return body, hashlib.md5(body).hexdigest()
+
+    def put_if(self, bucket, key, body: bytes, etag: Optional[str], content_encoding: Optional[str] = None):
+        with self._lock:
+            current = self._objects.get((bucket, key))
+            if (hashlib.md5(current).hexdigest() if current is not None else None) != etag:
+                raise PreconditionFailed(key)
+            self._objects[(bucket, key)] = bytes(body)
+        return hashlib.md5(body).hexdigest()
+
+    def open(self, bucket, key):
+        return io.BytesIO(self.get(bucket, key))
+
+    def exists(self, bucket, key) -> bool:
+        with self._lock:
+            return (bucket, key) in self._objects
+
+    def list_keys(self, bucket, prefix):
+        with self._lock:
+            keys = [key for (b, key) in self._objects if b == bucket and key.startswith(prefix)]
+        return iter(sorted(keys))
+
+    def download(self, bucket, key, local_path):
+        with open(local_path, "wb") as f:
+            f.write(self.get(bucket, key))
+
+    def open_writer(self, bucket, key, part_size: Optional[int] = None, concurrency: Optional[int] = None,
+                    hold_first_part: bool = False):
+        return MemoryWriter(self, bucket, key, part_size)
+
+
+STORAGE_BACKENDS = {
+    "s3": S3Storage,
+    "local": LocalStorage,
+    "memory": MemoryStorage,
+}
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def create_storage(backend: Optional[str] = None):
+    backend = backend or heconstants.STORAGE_BACKEND
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f"storage backend must be one of {sorted(STORAGE_BACKENDS)}")
+    return STORAGE_BACKENDS[backend]()
+
+
+def get_storage():
+    # one backend per process, so every S3SERVICE shares the client, the cache and the in-memory objects
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            _storage = create_storage()
+        return _storage
@@ -0,0 +1,140 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+
+import requests
+
+from config.logconfig import get_logger
+from utils import heconstants
+
+logger = get_logger()
+
+
+class TranscriptionBatcher:
+    """
+    Collects concurrent transcription requests of any thread or conversation into batched
+    inference calls on AI_SERVER.
+
+    With ``max_batch_size`` 1, the default, every clip is posted from the calling thread as
+    the single ``f1`` file, exactly as the callers did before batching existed.
+
+    Otherwise requests are grouped by endpoint and language. A group is sent as one POST with
+    the clips as files f1..fN, whose ``prediction`` list is fanned back to the callers in order.
+    It is sent right away while fewer than ``max_in_flight`` batches are being inferred, so
+    a lone caller waits for nothing; otherwise it waits until a batch returns, it holds
+    ``max_batch_size`` clips or its oldest clip has waited ``max_wait`` seconds.
+    """
+
+    def __init__(self, max_batch_size: int = heconstants.ASR_BATCH_MAX_SIZE,
+                 max_wait: float = heconstants.ASR_BATCH_MAX_WAIT_SECONDS,
+                 max_in_flight: int = heconstants.ASR_BATCH_MAX_IN_FLIGHT,
+                 timeout: float = heconstants.ASR_BATCH_TIMEOUT_SECONDS):
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.max_in_flight = max(1, max_in_flight)
+        self.timeout = timeout
+        self.batches = 0
+        self.clips = 0
+        self._pending = {}  # (path, language) -> [(filename, audio, unique_id, future)]
+        self._first_at = {}  # (path, language) -> arrival of its oldest pending clip
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._thread = None
+        self._pool = None
+        self._pid = None
+
+    def submit(self, audio: bytes, filename: str, path: str = "/transcribe/infer",
+               language: Optional[str] = None, unique_id: Optional[str] = None) -> Future:
+        """The future prediction of one WAV clip, as ``requests.post(...).json()["prediction"][0]`` was."""
+        future = Future()
+        if self.max_batch_size == 1:
+            try:
+                future.set_result(self._post(path, unique_id, {"f1": (filename, audio)})[0])
+            except Exception as exc:
+                future.set_exception(exc)
+            return future
+        key = (path, language)
+        with self._condition:
+            if self._pid != os.getpid():
+                # rtmp savers are forked, the parent's threads and pending clips are not theirs
+                self._pending, self._first_at, self._in_flight = {}, {}, 0
+                self._pool = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix="asr-batch")
+                self._thread = threading.Thread(target=self._run, name="asr-batcher", daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+            self._pending.setdefault(key, []).append((filename, audio, unique_id, future))
+            self._first_at.setdefault(key, time.time())
+            self._condition.notify()
+        return future
+
+    def transcribe(self, audio: bytes, filename: str, path: str = "/transcribe/infer",
+                   language: Optional[str] = None, unique_id: Optional[str] = None):
+        future = self.submit(audio, filename, path=path, language=language, unique_id=unique_id)
+        return future.result(timeout=self.timeout)
+
+    def stats(self):
+        with self._condition:
+            return {"batches": self.batches, "clips": self.clips, "in_flight": self._in_flight,
+                    "pending": sum(len(items) for items in self._pending.values())}
+
+    def _ready(self, now):
+        for key, items in self._pending.items():
+            if len(items) >= self.max_batch_size or self._in_flight < self.max_in_flight \
+                    or now - self._first_at[key] >= self.max_wait:
+                return key
+        return None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                key = self._ready(time.time())
+                while key is None:
+                    timeout = None
+                    if self._first_at:
+                        timeout = max(0.0, min(self._first_at.values()) + self.max_wait - time.time())
+                    self._condition.wait(timeout)
+                    key = self._ready(time.time())
+                items = self._pending[key]
+                batch, rest = items[:self.max_batch_size], items[self.max_batch_size:]
+                if rest:
+                    self._pending[key] = rest
+                else:
+                    del self._pending[key]
+                    del self._first_at[key]
+                self._in_flight += 1
+                self.batches += 1
+                self.clips += len(batch)
+            self._pool.submit(self._send, key, batch)
+
+    @staticmethod
+    def _post(path, unique_id, files, **kwargs):
+        url = heconstants.AI_SERVER + path
+        if unique_id:
+            url += f"?unique_id={unique_id}"
+        return requests.post(url, files=files, **kwargs).json()["prediction"]
+
+    def _send(self, key, batch):
+        path, language = key
+        try:
+            # the server reads the language off unique_id; the clips keep their own names as file names
+            unique_id = batch[0][2] if len(batch) == 1 else (f"{uuid.uuid4()}___{language}" if language else None)
+            files = {f"f{i + 1}": (filename, audio) for i, (filename, audio, _, _) in enumerate(batch)}
+            predictions = self._post(path, unique_id, files, timeout=self.timeout)
+            if len(predictions) != len(batch):
+                raise ValueError(f"{len(predictions)} predictions for a batch of {len(batch)} clips")
+            for (_, _, _, future), prediction in zip(batch, predictions):
+                future.set_result(prediction)
+        except Exception as exc:
+            logger.error(f"Batched transcription of {len(batch)} clips failed :: {exc}")
+            for _, _, _, future in batch:
+                future.set_exception(exc)
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify()
+
+
+transcription_batcher = TranscriptionBatcher()
@@ -0,0 +1,48 @@
+import struct
+from typing import Optional, Tuple
+
+WAV_HEADER_SIZE = 44
+
+
+def wav_header(data_size: int, channels: int = 1, sample_width: int = 2, framerate: int = 16000) -> bytes:
+    """Canonical 44 byte PCM RIFF/WAVE header for ``data_size`` bytes of frames."""
+    block_align = channels * sample_width
+    return struct.pack("<4sI4s4sIHHIIHH4sI",
+                       b"RIFF", 36 + data_size, b"WAVE",
+                       b"fmt ", 16, 1, channels, framerate, framerate * block_align, block_align, sample_width * 8,
+                       b"data", data_size)
+
+
+def _read_exact(stream, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise ValueError("WAV header is truncated")
+        data += chunk
+    return data
+
+
+def read_wav_header(stream) -> Tuple[bytes, int, Optional[int]]:
+    """
+    Reads ``stream`` up to the first frame, so the rest of it can be passed on unread.
+    Returns the bytes read, the byte rate of the fmt chunk and the size of the data chunk,
+    None when the writer left it unset as streaming writers do.
+    """
+    header = _read_exact(stream, 12)
+    if header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+        raise ValueError("not a RIFF/WAVE stream")
+    byte_rate = None
+    while True:
+        chunk_header = _read_exact(stream, 8)
+        header += chunk_header
+        chunk_id, size = struct.unpack("<4sI", chunk_header)
+        if chunk_id == b"data":
+            if not byte_rate:
+                raise ValueError("WAV data chunk without a fmt chunk before it")
+            return header, byte_rate, None if size in (0, 0xFFFFFFFF) else size
+        # chunks are padded to an even size
+        body = _read_exact(stream, size + (size & 1))
+        header += body
+        if chunk_id == b"fmt ":
+            byte_rate = struct.unpack("<I", body[8:12])[0]
@@ -0,0 +1,119 @@
+import atexit
+import heapq
+import threading
+import time
+import traceback
+from typing import Optional
+
+from config.logconfig import get_logger
+from utils import heconstants
+from utils.json_codec import decode_json, encode_json
+from utils.s3_operation import S3SERVICE
+
+logger = get_logger()
+
+
+class WriteBehindBuffer:
+    """
+    Coalesces frequent rewrites of the same JSON object.
+
+    ``put`` only records the value. The first put of a key schedules one write ``window``
+    seconds later, which stores whatever value is the latest at that moment. Writes of one
+    key are serialized and always take the newest value, so the last ``put`` wins.
+    ``flush`` writes pending keys right away, e.g. when a session ends; everything still
+    pending is flushed at exit. A ``window`` of 0 writes every put through. A failed write
+    is retried after the window, or after ``retry_delay`` when there is none.
+    """
+
+    def __init__(self, s3: Optional[S3SERVICE] = None, window: float = heconstants.S3_WRITE_BEHIND_WINDOW_SECONDS,
+                 retry_delay: float = heconstants.S3_WRITE_BEHIND_RETRY_SECONDS):
+        self.s3 = s3 or S3SERVICE()
+        self.window = window
+        self.retry_delay = retry_delay
+        self.puts = 0
+        self.writes = 0
+        self._pending = {}  # (bucket, key) -> (latest body, its content encoding)
+        self._due = []  # heap of (due_at, bucket, key)
+        self._condition = threading.Condition()
+        # striped so a slow write only holds back keys sharing its stripe, without a lock per key ever seen
+        self._write_locks = [threading.Lock() for _ in range(64)]
+        self._thread = None
+        self._closed = False
+        atexit.register(self.close)
+
+    def put(self, s3_filename, data, bucket_name: Optional[str] = None):
+        item = (bucket_name or self.s3.default_bucket, s3_filename)
+        body = encode_json(data)
+        with self._condition:
+            self.puts += 1
+            if item not in self._pending and self.window > 0:
+                self._schedule(item, self.window)
+            self._pending[item] = body
+        if self.window <= 0:
+            self._flush_item(item)
+
+    def get(self, s3_filename, bucket_name: Optional[str] = None):
+        """The pending value of ``s3_filename``, None when it has no unwritten put."""
+        with self._condition:
+            body = self._pending.get((bucket_name or self.s3.default_bucket, s3_filename))
+        return decode_json(body[0]) if body is not None else None
+
+    def flush(self, *s3_filenames, bucket_name: Optional[str] = None):
+        """Writes the given keys, or every pending key, now."""
+        with self._condition:
+            if s3_filenames:
+                items = [(bucket_name or self.s3.default_bucket, key) for key in s3_filenames]
+            else:
+                items = list(self._pending)
+        for item in items:
+            self._flush_item(item)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self.flush()
+
+    def stats(self):
+        with self._condition:
+            return {"puts": self.puts, "writes": self.writes, "pending": len(self._pending)}
+
+    def _schedule(self, item, delay):
+        # called holding the condition
+        heapq.heappush(self._due, (time.time() + delay, *item))
+        self._condition.notify()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="s3-write-behind", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed and (not self._due or self._due[0][0] > time.time()):
+                    self._condition.wait(max(0.0, self._due[0][0] - time.time()) if self._due else None)
+                if self._closed:
+                    return
+                _, bucket, key = heapq.heappop(self._due)
+            self._flush_item((bucket, key))
+
+    def _flush_item(self, item):
+        # the body is taken under the write lock, so a later flush of the key can only write a newer one
+        with self._write_locks[hash(item) % len(self._write_locks)]:
+            with self._condition:
+                body = self._pending.pop(item, None)
+            if body is None:
+                return
+            bucket, key = item
+            try:
+                self.s3.storage.put(bucket, key, body[0], cache=True, content_encoding=body[1])
+                with self._condition:
+                    self.writes += 1
+            except Exception as exc:
+                msg = "Write behind of {} failed :: {}".format(key, exc)
+                trace = traceback.format_exc()
+                logger.error(msg, trace)
+                with self._condition:
+                    # retried later unless a newer put already replaced it
+                    if item not in self._pending and not self._closed:
+                        self._pending[item] = body
+                        self._schedule(item, self.window if self.window > 0 else self.retry_delay)